@@ -0,0 +1,241 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import h5py
+import numpy as np
+from six.moves import cPickle as pickle
+
+
+def file_hash(file_name, block_size=2**20):
+    """ Returns the md5 hex digest of a file's contents. """
+
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def parameter_fingerprint(params):
+    """ Returns a short digest identifying a dictionary of parameters.
+    Values that are not JSON-serializable are fingerprinted by their repr.
+    """
+
+    encoded = json.dumps(params, sort_keys=True, default=repr)
+    return hashlib.md5(encoded.encode('utf-8')).hexdigest()[:16]
+
+
+class CheckpointStore(object):
+    """ HDF5 file of intermediate analysis results that are saved as soon as they
+    are computed, so that an interrupted analysis can pick up where it left off.
+
+    Results are stored under /nwb_<hash>/<stage>/params_<fingerprint>/<name>,
+    where hash identifies the contents of the NWB file the results came from
+    and fingerprint identifies the parameters they were computed with.  A
+    result computed from a different file or with different parameters is
+    never returned.
+
+    Numeric arrays are stored as datasets and tuples as groups of their items.
+    Anything else (e.g. pd.DataFrames or dictionaries) is pickled.
+
+    A checkpoint file that cannot be opened (e.g. one truncated by a crash
+    during a write) is treated as empty.  It is moved aside to
+    <path>.corrupt the next time a result is stored, and a fresh file is
+    started.
+
+    Parameters
+    ----------
+    path: string
+        Path of the HDF5 checkpoint file.  It is created if it does not exist.
+
+    nwb_file: string
+        NWB file the results are computed from.
+
+    nwb_hash: string (optional)
+        Precomputed hash of nwb_file.  Defaults to file_hash(nwb_file).
+    """
+
+    _log = logging.getLogger('allensdk.brain_observatory.checkpoint_store')
+
+    PICKLE_PROTOCOL = 2
+
+    def __init__(self, path, nwb_file, nwb_hash=None):
+        self.path = path
+        self.nwb_file = nwb_file
+        self.nwb_hash = file_hash(nwb_file) if nwb_hash is None else nwb_hash
+        self._lock = threading.Lock()
+
+        save_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+    def key(self, stage, name, params=None):
+        """ Path within the checkpoint file of one result. """
+
+        return '/'.join(['nwb_%s' % self.nwb_hash,
+                         stage,
+                         'params_%s' % parameter_fingerprint(params or {}),
+                         name])
+
+    def has(self, stage, name, params=None):
+        key = self.key(stage, name, params)
+
+        with self._lock:
+            if not os.path.exists(self.path):
+                return False
+
+            try:
+                with h5py.File(self.path, 'r') as f:
+                    return key in f
+            except (IOError, OSError) as e:
+                self._log.warning("could not read checkpoint file %s: %s", self.path, e)
+                return False
+
+    def get(self, stage, name, params=None):
+        """ Returns a stored result.  Raises KeyError if it is not present
+        or the checkpoint file cannot be read. """
+
+        key = self.key(stage, name, params)
+
+        with self._lock:
+            if not os.path.exists(self.path):
+                raise KeyError(key)
+
+            try:
+                f = h5py.File(self.path, 'r')
+            except (IOError, OSError) as e:
+                self._log.warning("could not read checkpoint file %s: %s", self.path, e)
+                raise KeyError(key)
+
+            with f:
+                if key not in f:
+                    raise KeyError(key)
+                return self._read(f[key])
+
+    def put(self, stage, name, value, params=None):
+        """ Stores a result, replacing any previous result with the same key.
+        The result is written under a temporary name and renamed once
+        complete, so an interrupted write never looks like a result.  This
+        protects individual entries only: a crash can still leave the file
+        itself unreadable, in which case it is moved aside and replaced.
+        """
+
+        key = self.key(stage, name, params)
+        partial_key = key + '.partial'
+
+        with self._lock:
+            with self._open_for_writing() as f:
+                for k in partial_key, key:
+                    if k in f:
+                        del f[k]
+
+                self._write(f, partial_key, value)
+                f.move(partial_key, key)
+
+    def _open_for_writing(self):
+        try:
+            return h5py.File(self.path, 'a')
+        except (IOError, OSError) as e:
+            corrupt_path = self.path + '.corrupt'
+            self._log.warning("could not open checkpoint file %s (%s), moving it to %s",
+                              self.path, e, corrupt_path)
+            if os.path.exists(corrupt_path):
+                os.remove(corrupt_path)
+            os.rename(self.path, corrupt_path)
+
+            return h5py.File(self.path, 'w')
+
+    def get_or_compute(self, stage, name, func, params=None):
+        """ Returns a stored result, computing and storing it first if it is
+        not present.
+
+        Parameters
+        ----------
+        stage: string
+            Analysis stage, e.g. a stimulus name.
+
+        name: string
+            Result within the stage.
+
+        func: callable
+            Computes the result.  Takes no arguments.
+
+        params: dictionary (optional)
+            Parameters the result depends on.
+        """
+
+        try:
+            value = self.get(stage, name, params)
+            self._log.info("loaded %s/%s from %s", stage, name, self.path)
+            return value
+        except KeyError:
+            pass
+
+        value = func()
+        self.put(stage, name, value, params)
+
+        return value
+
+    def _write(self, f, key, value):
+        if isinstance(value, tuple):
+            group = f.create_group(key)
+            group.attrs['type'] = 'tuple'
+            for i, item in enumerate(value):
+                self._write(group, str(i), item)
+        elif isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            f.create_dataset(key, data=value)
+        else:
+            data = pickle.dumps(value, protocol=self.PICKLE_PROTOCOL)
+            ds = f.create_dataset(key, data=np.frombuffer(data, dtype=np.uint8))
+            ds.attrs['type'] = 'pickle'
+
+    def _read(self, node):
+        node_type = node.attrs.get('type', None)
+        if isinstance(node_type, bytes):
+            node_type = node_type.decode('utf-8')
+
+        if node_type == 'tuple':
+            return tuple(self._read(node[str(i)]) for i in range(len(node)))
+        elif node_type == 'pickle':
+            return pickle.loads(node[()].tostring())
+        else:
+            return node[()]
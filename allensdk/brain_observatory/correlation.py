@@ -0,0 +1,209 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+import scipy.stats as st
+
+
+def rank_rows(x):
+    """ Ranks the values in each row of a 2-d array, assigning tied values the
+    average of their ranks (scipy.stats.rankdata's 'average' method).  Rows
+    containing NaN are ranked as NaN.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        (# variables, # observations) array
+
+    Returns
+    -------
+    np.ndarray of float ranks, starting at 1
+    """
+    x = np.asarray(x, dtype=float)
+    number_rows, number_columns = x.shape
+    rows = np.arange(number_rows)[:, np.newaxis]
+    positions = np.arange(number_columns)
+
+    order = np.argsort(x, axis=1, kind='mergesort')
+    sorted_x = x[rows, order]
+
+    first = np.ones(x.shape, dtype=bool)
+    first[:, 1:] = sorted_x[:, 1:] != sorted_x[:, :-1]
+    last = np.ones(x.shape, dtype=bool)
+    last[:, :-1] = first[:, 1:]
+
+    # position of the first and last member of each run of tied values
+    tie_start = np.maximum.accumulate(np.where(first, positions, 0), axis=1)
+    tie_end = np.minimum.accumulate(np.where(last, positions, number_columns)[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.empty(x.shape)
+    ranks[rows, order] = (tie_start + tie_end) / 2.0 + 1
+    ranks[np.isnan(x).any(axis=1)] = np.nan
+
+    return ranks
+
+
+def correlation_p_value(r, number_observations):
+    """ Two-sided p value for the null hypothesis of no correlation, from the
+    t-distribution with number_observations - 2 degrees of freedom.  This is
+    the test used by both scipy.stats.pearsonr and scipy.stats.spearmanr.
+
+    Parameters
+    ----------
+    r: np.ndarray
+        correlation coefficients
+
+    number_observations: int
+        number of observations each coefficient was computed from
+
+    Returns
+    -------
+    np.ndarray of p values, NaN where r is NaN
+    """
+    df = number_observations - 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt(df / ((1.0 - r) * (1.0 + r)))
+
+    return 2 * st.t.sf(np.abs(t), df)
+
+
+def _correlate(x, chunk_size, p_value):
+    """ Correlates every pair of rows of x with one product of the normalized rows,
+    computed in blocks of chunk_size rows, and symmetrizes the result. """
+    x = np.asarray(x, dtype=float)
+    number_rows, number_observations = x.shape
+
+    centered = x - x.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = centered / np.sqrt((centered ** 2).sum(axis=1, keepdims=True))
+
+    if chunk_size is None:
+        chunk_size = max(number_rows, 1)
+
+    corr = np.empty((number_rows, number_rows))
+    p = np.empty((number_rows, number_rows))
+
+    for start in range(0, number_rows, chunk_size):
+        block = slice(start, start + chunk_size)
+        with np.errstate(invalid='ignore'):
+            r = np.clip(normalized[block].dot(normalized.T), -1.0, 1.0)
+        corr[block] = r
+        p[block] = p_value(r, number_observations)
+
+    # the product is only symmetric up to rounding
+    upper = np.triu_indices(number_rows, 1)
+    corr.T[upper] = corr[upper]
+    p.T[upper] = p[upper]
+
+    return corr, p
+
+
+def _pearson_p_value(r, number_observations):
+    p = correlation_p_value(r, number_observations)
+
+    # perfect correlations have p = 0.  Undefined ones (e.g. a constant
+    # variable) have p = 1, as older versions of scipy.stats.pearsonr reported,
+    # which keeps previously computed noise correlation tables unchanged.
+    p[np.abs(r) == 1.0] = 0.0
+    p[np.isnan(r)] = 1.0
+
+    return p
+
+
+def pearson_matrix(x, chunk_size=None):
+    """ Computes the Pearson correlation coefficient and its p value between every
+    pair of rows of x.  For pairs with a well-defined correlation this matches
+    scipy.stats.pearsonr applied to each pair.  Pairs involving a constant row
+    or a row containing NaN correlate as NaN with p = 1, regardless of the
+    convention of the installed scipy.
+
+    Rows are normalized once, so the correlation matrix is a single matrix
+    product.  With chunk_size set, the product and p values are computed for
+    blocks of chunk_size rows at a time, bounding the temporary memory needed
+    for large numbers of rows.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        (# variables, # observations) array
+
+    chunk_size: int
+        number of rows processed per block. Default is all rows at once.
+
+    Returns
+    -------
+    tuple: corr, p; each a symmetric (# variables, # variables) np.ndarray
+    """
+    return _correlate(x, chunk_size, _pearson_p_value)
+
+
+def spearman_matrix(x, chunk_size=None):
+    """ Computes the Spearman rank correlation coefficient and its p value between
+    every pair of rows of x, matching scipy.stats.spearmanr applied to each pair:
+    rows containing NaN, or with fewer than two observations, correlate as NaN.
+    See pearson_matrix for parameters. """
+    x = np.asarray(x, dtype=float)
+
+    if x.shape[1] <= 1:
+        return np.full((len(x), len(x)), np.nan), np.full((len(x), len(x)), np.nan)
+
+    return _correlate(rank_rows(x), chunk_size, correlation_p_value)
+
+
+def correlation_matrix(x, corr='spearman', chunk_size=None):
+    """ Computes either Pearson or Spearman correlations between every pair of rows of x.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        (# variables, # observations) array
+
+    corr: string
+        'pearson' or 'spearman'
+
+    chunk_size: int
+        see pearson_matrix
+
+    Returns
+    -------
+    tuple: corr, p
+    """
+    if corr == 'pearson':
+        return pearson_matrix(x, chunk_size=chunk_size)
+    elif corr == 'spearman':
+        return spearman_matrix(x, chunk_size=chunk_size)
+    else:
+        raise Exception('correlation should be pearson or spearman')
@@ -34,29 +34,31 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import scipy.sparse as sparse
+import scipy.sparse.csgraph as csgraph
 import scipy.linalg as linalg
 import numpy as np
 import os
+import multiprocessing as mp
+from functools import partial
 import matplotlib.pyplot as plt
 import logging
 import matplotlib.colors as colors
 from allensdk.config.manifest import Manifest
 
-def demix_time_dep_masks(raw_traces, stack, masks):
+def demix_time_dep_masks(raw_traces, stack, masks, block_size=1000, n_jobs=1):
     '''
 
     :param raw_traces: extracted traces
-    :param stack: movie (same length as traces)
+    :param stack: movie (same length as traces). May be an h5py dataset, which is read block_size frames at a time.
     :param masks: binary roi masks
+    :param block_size: number of frames demixed together
+    :param n_jobs: number of processes to split the blocks of frames across. None uses one per cpu.
     :return: demixed traces
     '''
     N, T = raw_traces.shape
     _, x, y = masks.shape
     P = x * y
 
-    if len(stack.shape) == 3:
-        stack = stack.reshape(T, P)
-
     num_pixels_in_mask = np.sum(masks, axis=(1, 2))
     F = raw_traces.T * num_pixels_in_mask  # shape (T,N)
     F = F.T
@@ -64,34 +66,127 @@ def demix_time_dep_masks(raw_traces, stack, masks):
     flat_masks = masks.reshape(N, P)
     flat_masks = sparse.csr_matrix(flat_masks)
 
-    drop_frames = []
+    # ROIs only need to be demixed together with the ROIs they overlap
+    components = get_overlap_components(flat_masks)
+
+    blocks = ( (t, stack[t:t + block_size].reshape(-1, P), F[:, t:t + block_size])
+               for t in range(0, T, block_size) )
+    demix_block = partial(_demix_block, flat_masks=flat_masks,
+                          num_pixels_in_mask=num_pixels_in_mask, components=components)
+
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    drop_frames = np.zeros(T, dtype=bool)
     demix_traces = np.zeros((N, T))
 
-    for t in range(T):
+    pool = mp.Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        results = pool.imap(demix_block, blocks) if pool is not None else (demix_block(b) for b in blocks)
+        for t, demix_traces_block, drop_frames_block in results:
+            demix_traces[:, t:t + len(drop_frames_block)] = demix_traces_block
+            drop_frames[t:t + len(drop_frames_block)] = drop_frames_block
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return demix_traces, drop_frames.tolist()
+
+
+def get_overlap_components(flat_masks):
+    '''
+    Groups ROIs into connected components of the graph in which ROIs are
+    linked if their masks share a pixel.
+
+    :param flat_masks: sparse matrix of roi masks with shape (N, pixels)
+    :return: list of arrays of roi indices, one per component with more than one roi, and an array of the isolated rois
+    '''
+    overlap = flat_masks.dot(flat_masks.T) != 0
+    num_components, labels = csgraph.connected_components(overlap, directed=False)
+
+    components = [ np.nonzero(labels == c)[0] for c in range(num_components) ]
+    isolated = np.array([ c[0] for c in components if len(c) == 1 ], dtype=int)
+
+    return [ c for c in components if len(c) > 1 ], isolated
+
+
+def _demix_frame(weighted_mask_sum, stack_t, flat_masks, num_pixels_in_mask):
+    norm_mat = sparse.diags(num_pixels_in_mask / weighted_mask_sum, offsets=0)
+    stack_t = sparse.diags(stack_t, offsets=0)
+
+    flat_weighted_masks = norm_mat.dot(flat_masks.dot(stack_t))
 
-        weighted_mask_sum = F[:, t]
-        drop_test = (weighted_mask_sum == 0)
+    overlap = flat_masks.dot(flat_weighted_masks.T).toarray()  # cast to dense numpy array for linear solver because solution is dense
+    return _solve(overlap, weighted_mask_sum)
 
-        if np.sum(drop_test == 0):
-            norm_mat = sparse.diags(num_pixels_in_mask / weighted_mask_sum, offsets=0)
-            stack_t = sparse.diags(stack[t], offsets=0)
 
-            flat_weighted_masks = norm_mat.dot(flat_masks.dot(stack_t))
+def _solve(overlap, weighted_mask_sum):
+    try:
+        return linalg.solve(overlap, weighted_mask_sum)
+    except linalg.LinAlgError as e:
+        logging.warning("singular matrix, using least squares")
+        x, _, _, _ = linalg.lstsq(overlap, weighted_mask_sum)
+        return x
+
+
+def _demix_block(block, flat_masks, num_pixels_in_mask, components, max_chunk_elements=2**22):
+    '''
+    Demixes a block of frames.  Frames in which every roi has a nonzero
+    weighted mask sum are demixed one overlap component at a time, with the
+    systems of all frames solved together.  Other frames fall back to
+    solving the full system frame by frame.
+    '''
+    t, stack, F = block
+    N, B = F.shape
+    overlapping, isolated = components
+
+    drop_frames = ~np.any(F != 0, axis=0)
+    demix_traces = np.zeros((N, B))
+
+    for b in np.nonzero(~drop_frames & np.any(F == 0, axis=0))[0]:
+        demix_traces[:, b] = _demix_frame(F[:, b], stack[b], flat_masks, num_pixels_in_mask)
+
+    frames = np.nonzero(np.all(F != 0, axis=0))[0]
+    if len(frames) == 0:
+        return t, demix_traces, drop_frames
+
+    stack = stack[frames].astype(float)
+    F = F[:, frames]
+    norm = num_pixels_in_mask[:, np.newaxis] / F  # shape (N, frames)
+
+    # an isolated roi's system is a single equation
+    if len(isolated) > 0:
+        isolated_masks = flat_masks[isolated]
+        overlap = isolated_masks.multiply(isolated_masks).dot(stack.T) * norm[isolated]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            demix_traces[np.ix_(isolated, frames)] = np.where(overlap == 0, 0.0, F[isolated] / overlap)
+
+    for component in overlapping:
+        component_masks = flat_masks[component]
+        pixels = np.unique(component_masks.indices)
+        component_masks = component_masks[:, pixels].toarray()
+
+        # overlap[b, i, j] = norm[j, b] * sum_p mask_i(p) * mask_j(p) * stack_b(p)
+        F_component = F[component].T
+        x = np.zeros(F_component.shape)
+
+        step = max(1, max_chunk_elements // component_masks.size)
+        for start in range(0, len(frames), step):
+            chunk = slice(start, start + step)
+            weighted_masks = component_masks[np.newaxis, :, :] * stack[chunk, np.newaxis, pixels]
+            overlap = np.matmul(weighted_masks, component_masks.T)
+            overlap *= norm[component, chunk].T[:, np.newaxis, :]
 
-            overlap = flat_masks.dot(flat_weighted_masks.T).toarray()  # cast to dense numpy array for linear solver because solution is dense
             try:
-                demix_traces[:, t] = linalg.solve(overlap, F[:, t])
-            except linalg.LinAlgError as e:
-                logging.warning("singular matrix, using least squares")
-                x, _, _, _ = linalg.lstsq(overlap, F[:, t])
-                demix_traces[:, t] = x
+                x[chunk] = np.linalg.solve(overlap, F_component[chunk, :, np.newaxis])[:, :, 0]
+            except np.linalg.LinAlgError:
+                x[chunk] = [ _solve(o, f) for o, f in zip(overlap, F_component[chunk]) ]
 
-            drop_frames.append(False)
+        demix_traces[np.ix_(component, frames)] = x.T
 
-        else:
-            drop_frames.append(True)
+    return t, demix_traces, drop_frames
 
-    return demix_traces, drop_frames
 
 def plot_traces(raw_trace, demix_trace, roi_id, roi_ind, save_file):
     fig, ax = plt.subplots()
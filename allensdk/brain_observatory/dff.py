@@ -38,6 +38,7 @@ import os
 import argparse
 import matplotlib.pyplot as plt
 import warnings
+import multiprocessing as mp
 import h5py
 import numpy as np
 from functools import partial
@@ -45,43 +46,37 @@ from scipy.ndimage.filters import median_filter
 
 from allensdk.core.brain_observatory_nwb_data_set import BrainObservatoryNwbDataSet
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 GAUSSIAN_MAD_STD_SCALE = 1.4826
 
 
-def movingmode_fast(x, kernelsize, y):
-    """Compute the windowed mode of an array.  A running mode is initialized
-    with a histogram of values over the initial kernelsize/2 values.  The mode
-    is then updated as the kernel moves by adding and subtracting values from
-    the histogram.
+def _movingmode_loop(x, halfsize, histo, y):
+    """Run the windowed mode over one trace, given the histogram of its
+    first half kernel.  This is the reference implementation of
+    :func:`movingmode_fast`; it is compiled with numba when available.
 
     Parameters
     ----------
     x : np.ndarray
-        Array to be analyzed
-    kernelsize : int
-        Size of the moving window
+        Non-negative integer array to be analyzed
+    halfsize : int
+        Half the size of the moving window
+    histo : np.ndarray
+        Histogram of x[:halfsize]. Updated in place.
     y : np.ndarray
         Output array to store the results
     """
 
-    # offset so that the trace is non-negative
-    minval = min(x.min(), 0)
-    if minval < 0:
-        x = x - minval
-
-    maxval = x.max()
-
-    # compute a histogram of a half kernel
-    halfsize = int(kernelsize / 2)
-    histo = np.bincount(np.rint(x[:halfsize]).astype(
-        np.uint32), minlength=int(maxval + 2))
-
     # find the mode of the first half kernel
     mode = np.argmax(histo)
 
     # here initial mode is available
     for m in range(0, halfsize):
-        q = int(round(x[halfsize + m]))
+        q = x[halfsize + m]
 
         histo[q] += 1
 
@@ -91,14 +86,14 @@ def movingmode_fast(x, kernelsize, y):
         y[m] = mode
 
     for m in range(halfsize, x.shape[0] - halfsize):
-        p = int(round(x[m - halfsize]))
+        p = x[m - halfsize]
         histo[p] -= 1
 
         # need to find possibly new mode value
         if p == mode:
             mode = np.argmax(histo)
 
-        q = int(round(x[m + halfsize]))
+        q = x[m + halfsize]
 
         histo[q] += 1
 
@@ -108,7 +103,7 @@ def movingmode_fast(x, kernelsize, y):
         y[m] = mode
 
     for m in range(x.shape[0] - halfsize, x.shape[0]):
-        p = int(round(x[m - halfsize]))
+        p = x[m - halfsize]
         histo[p] -= 1
 
         # need to find possibly new mode value
@@ -117,9 +112,117 @@ def movingmode_fast(x, kernelsize, y):
 
         y[m] = mode
 
+
+if numba is not None:
+    _movingmode_loop_compiled = numba.njit(_movingmode_loop)
+else:
+    _movingmode_loop_compiled = None
+
+
+def _movingmode_lockstep(x, halfsize, histo, y):
+    """Run the windowed mode over many traces at once, stepping all of
+    them through time together.  Equivalent to calling
+    :func:`_movingmode_loop` on each row.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        2D non-negative integer array of traces to be analyzed
+    halfsize : int
+        Half the size of the moving window
+    histo : np.ndarray
+        2D array of histograms of x[:, :halfsize]. Updated in place.
+    y : np.ndarray
+        2D output array to store the results
+    """
+
+    num_rows, num_samples = x.shape
+    num_bins = histo.shape[1]
+
+    # work on flat histogram indices, one column of x per time step
+    row_offsets = np.arange(num_rows) * num_bins
+    flat_histo = histo.reshape(-1)
+    x = np.ascontiguousarray(x.T) + row_offsets
+
+    mode = histo.argmax(axis=1) + row_offsets
+    modes = np.empty((num_samples, num_rows), dtype=mode.dtype)
+
+    def add(q, mode):
+        flat_histo[q] += 1
+        return np.where(flat_histo[q] > flat_histo[mode], q, mode)
+
+    def remove(p, mode):
+        flat_histo[p] -= 1
+
+        # need to find possibly new mode value
+        reset = p == mode
+        if reset.any():
+            mode[reset] = histo[reset].argmax(axis=1) + row_offsets[reset]
+        return mode
+
+    for m in range(0, halfsize):
+        mode = add(x[halfsize + m], mode)
+        modes[m] = mode
+
+    for m in range(halfsize, num_samples - halfsize):
+        mode = remove(x[m - halfsize], mode)
+        mode = add(x[m + halfsize], mode)
+        modes[m] = mode
+
+    for m in range(num_samples - halfsize, num_samples):
+        mode = remove(x[m - halfsize], mode)
+        modes[m] = mode
+
+    y[:] = (modes - row_offsets).T
+
+
+def movingmode_fast(x, kernelsize, y):
+    """Compute the windowed mode of an array.  A running mode is initialized
+    with a histogram of values over the initial kernelsize/2 values.  The mode
+    is then updated as the kernel moves by adding and subtracting values from
+    the histogram.
+
+    A 2D array is treated as a set of traces, one per row, which are
+    processed together.  The per-sample update runs as compiled code if numba
+    is installed.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Array to be analyzed, or 2D array with one trace per row
+    kernelsize : int
+        Size of the moving window
+    y : np.ndarray
+        Output array to store the results
+    """
+
+    x2d = x if x.ndim == 2 else x[np.newaxis, :]
+    y2d = y if y.ndim == 2 else y[np.newaxis, :]
+
+    # offset so that each trace is non-negative
+    minval = np.minimum(x2d.min(axis=1), 0)
+    x2d = np.where((minval < 0)[:, np.newaxis], x2d - minval[:, np.newaxis], x2d)
+
+    maxval = x2d.max()
+
+    # compute a histogram of a half kernel
+    halfsize = int(kernelsize / 2)
+    xi = np.rint(x2d).astype(np.intp)
+    histo = np.array([ np.bincount(row[:halfsize], minlength=int(maxval + 2))
+                       for row in xi ])
+
+    if _movingmode_loop_compiled is not None:
+        for row, row_histo, row_y in zip(xi, histo, y2d):
+            _movingmode_loop_compiled(row, halfsize, row_histo, row_y)
+    elif len(xi) == 1:
+        _movingmode_loop(xi[0], halfsize, histo[0], y2d[0])
+    else:
+        _movingmode_lockstep(xi, halfsize, histo, y2d)
+
     # undo the offset
-    if minval < 0:
-        y += minval
+    for row_minval, row_y in zip(minval, y2d):
+        if row_minval < 0:
+            row_y += row_minval
 
     return 0
 
@@ -127,30 +230,56 @@ def movingmode_fast(x, kernelsize, y):
 def movingaverage(x, kernelsize, y):
     """Compute the windowed average of an array.
 
+    The running sum is accumulated in the same order as a sample-by-sample
+    update, so that a 2D array with one trace per row can be processed with
+    cumulative sums.
+
     Parameters
     ----------
     x : np.ndarray
-        Array to be analyzed
+        Array to be analyzed, or 2D array with one trace per row
     kernelsize : int
         Size of the moving window
     y : np.ndarray
         Output array to store the results
     """
 
-    halfsize = int(kernelsize / 2)
-    sumkernel = np.sum(x[0:halfsize])
-    for m in range(0, halfsize):
-        sumkernel = sumkernel + x[m + halfsize]
-        y[m] = sumkernel / (halfsize + m)
+    x2d = x if x.ndim == 2 else x[np.newaxis, :]
+    y2d = y if y.ndim == 2 else y[np.newaxis, :]
+    num_samples = x2d.shape[1]
 
-    sumkernel = np.sum(x[0:kernelsize])
-    for m in range(halfsize, x.shape[0] - halfsize):
-        sumkernel = sumkernel - x[m - halfsize] + x[m + halfsize]
-        y[m] = sumkernel / kernelsize
+    # accumulate in the same type as a running sum of the input would use
+    x2d = x2d.astype(np.add.reduce(x2d[:, :0], axis=1).dtype, copy=False)
 
-    for m in range(x.shape[0] - halfsize, x.shape[0]):
-        sumkernel = sumkernel - x[m - halfsize]
-        y[m] = sumkernel / (halfsize - 1 + (x.shape[0] - m))
+    halfsize = int(kernelsize / 2)
+    num_middle = num_samples - 2 * halfsize
+
+    # divisors are integer arrays so that sums are promoted to float the
+    # same way as when dividing a scalar sum by an int
+
+    # growing kernel at the start
+    sumkernel = np.empty((x2d.shape[0], halfsize + 1), dtype=x2d.dtype)
+    sumkernel[:, 0] = [ np.sum(row[0:halfsize]) for row in x2d ]
+    sumkernel[:, 1:] = x2d[:, halfsize:2 * halfsize]
+    np.cumsum(sumkernel, axis=1, out=sumkernel)
+    y2d[:, 0:halfsize] = sumkernel[:, 1:] / np.arange(halfsize, 2 * halfsize)
+
+    # full kernel, one subtraction then one addition per sample
+    sumkernel = np.empty((x2d.shape[0], 2 * num_middle + 1), dtype=x2d.dtype)
+    sumkernel[:, 0] = [ np.sum(row[0:kernelsize]) for row in x2d ]
+    sumkernel[:, 1::2] = -x2d[:, 0:num_middle]
+    sumkernel[:, 2::2] = x2d[:, 2 * halfsize:num_samples]
+    np.cumsum(sumkernel, axis=1, out=sumkernel)
+    y2d[:, halfsize:num_samples - halfsize] = sumkernel[:, 2::2] / np.full(num_middle, kernelsize)
+
+    # shrinking kernel at the end
+    last = sumkernel[:, -1]
+    sumkernel = np.empty((x2d.shape[0], halfsize + 1), dtype=last.dtype)
+    sumkernel[:, 0] = last
+    sumkernel[:, 1:] = -x2d[:, num_middle:num_samples - halfsize]
+    np.cumsum(sumkernel, axis=1, out=sumkernel)
+    y2d[:, num_samples - halfsize:] = \
+        sumkernel[:, 1:] / np.arange(2 * halfsize - 1, halfsize - 1, -1)
 
     return 0
 
@@ -186,7 +315,8 @@ def plot_onetrace(dff, fc):
 
 def compute_dff_windowed_mode(traces,
                               mode_kernelsize=5400,
-                              mean_kernelsize=3000):
+                              mean_kernelsize=3000,
+                              batch_size=50):
     """Compute dF/F of a set of traces using a low-pass windowed-mode operator.
 
     The operation is basically:
@@ -203,6 +333,9 @@ def compute_dff_windowed_mode(traces,
         Window size to use for windowed_mode.
     mean_kernelsize : int
         Window size to use for windowed_mean.
+    batch_size : int
+        Number of traces to run through the windowed operators at once.
+        Larger batches are faster but use more memory.
 
     Returns
     -------
@@ -220,27 +353,36 @@ def compute_dff_windowed_mode(traces,
     if mode_kernelsize == 0 or mean_kernelsize == 0:
         raise ValueError("Kernel length is 0!")
 
+    if batch_size < 1:
+        raise ValueError("Batch size must be positive!")
+
     logging.debug("trace matrix shape: %d %d" %
                   (traces.shape[0], traces.shape[1]))
 
-    modeline = np.zeros(traces.shape[1])
-    modelineLP = np.zeros(traces.shape[1])
     dff = np.zeros((traces.shape[0], traces.shape[1]))
 
     logging.debug("computing df/f")
 
+    rois = []
     for n in range(0, traces.shape[0]):
         if np.any(np.isnan(traces[n])):
             logging.warning(
                 "trace for roi %d contains NaNs, setting to NaN", n)
             dff[n, :] = np.nan
-            continue
+        else:
+            rois.append(n)
+
+    for start in range(0, len(rois), batch_size):
+        batch = rois[start:start + batch_size]
 
-        movingmode_fast(traces[n, :], mode_kernelsize, modeline[:])
-        movingaverage(modeline[:], mean_kernelsize, modelineLP[:])
-        dff[n, :] = (traces[n, :] - modelineLP[:]) / modelineLP[:]
+        modeline = np.zeros((len(batch), traces.shape[1]))
+        modelineLP = np.zeros((len(batch), traces.shape[1]))
 
-        logging.debug("finished trace %d/%d" % (n + 1, traces.shape[0]))
+        movingmode_fast(traces[batch, :], mode_kernelsize, modeline)
+        movingaverage(modeline, mean_kernelsize, modelineLP)
+        dff[batch, :] = (traces[batch, :] - modelineLP) / modelineLP
+
+        logging.debug("finished trace %d/%d" % (batch[-1] + 1, traces.shape[0]))
 
     return dff
 
@@ -250,6 +392,8 @@ def compute_dff_windowed_median(traces,
                                 median_kernel_short=101,
                                 noise_stds=None,
                                 n_small_baseline_frames=None,
+                                n_jobs=1,
+                                median_kernel_long_step=1,
                                 **kwargs):
     """Compute dF/F of a set of traces with median filter detrending.
 
@@ -278,6 +422,13 @@ def compute_dff_windowed_median(traces,
         List that will contain the number of frames for each trace where
         the long-timescale median window is less than noise_std(T). The
         value for each trace will be appended to the list if provided.
+    n_jobs : int
+        Number of processes to split the traces across. None uses one
+        per cpu.
+    median_kernel_long_step : int
+        If greater than 1, the long timescale median is approximated with
+        :func:`strided_median_filter` using this step. See that function
+        for the error bound.
     kwargs:
         Additional keyword arguments are passed to :func:`noise_std` .
 
@@ -289,31 +440,125 @@ def compute_dff_windowed_median(traces,
     _check_kernel(median_kernel_long, traces.shape[1])
     _check_kernel(median_kernel_short, traces.shape[1])
 
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    if n_jobs > 1 and traces.shape[0] > 1:
+        chunks = np.array_split(traces, min(n_jobs, traces.shape[0]))
+
+        pool = mp.Pool(len(chunks))
+        try:
+            results = pool.map(partial(_compute_dff_windowed_median_chunk,
+                                       median_kernel_long=median_kernel_long,
+                                       median_kernel_short=median_kernel_short,
+                                       median_kernel_long_step=median_kernel_long_step,
+                                       **kwargs),
+                               chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for _, chunk_noise_stds, chunk_small_baseline_frames in results:
+            if noise_stds is not None:
+                noise_stds.extend(chunk_noise_stds)
+            if n_small_baseline_frames is not None:
+                n_small_baseline_frames.extend(chunk_small_baseline_frames)
+
+        return np.concatenate([ dff for dff, _, _ in results ])
+
     dff_traces = np.copy(traces)
 
-    for dff in dff_traces:
-        sigma_f = noise_std(dff, **kwargs)
+    # noise estimates are applied in the precision of the traces
+    sigma_f = np.array([ noise_std(dff, **kwargs) for dff in dff_traces ])
+    sigma_f = sigma_f.astype(dff_traces.dtype)[:, np.newaxis]
 
-        # long timescale median filter for baseline subtraction
-        tf = median_filter(dff, median_kernel_long, mode='constant')
-        dff -= tf
-        dff /= np.maximum(tf, sigma_f)
+    # long timescale median filter for baseline subtraction
+    if median_kernel_long_step > 1:
+        tf = strided_median_filter(dff_traces, median_kernel_long,
+                                   median_kernel_long_step)
+    else:
+        tf = median_filter(dff_traces, (1, median_kernel_long), mode='constant')
+    dff_traces -= tf
+    dff_traces /= np.maximum(tf, sigma_f)
 
-        if n_small_baseline_frames is not None:
-            n_small_baseline_frames.append(np.sum(tf <= sigma_f))
+    if n_small_baseline_frames is not None:
+        n_small_baseline_frames.extend(np.sum(tf <= sigma_f, axis=1))
 
-        sigma_dff = noise_std(dff, **kwargs)
-        if noise_stds is not None:
-            noise_stds.append(sigma_dff)
+    sigma_dff = np.array([ noise_std(dff, **kwargs) for dff in dff_traces ])
+    if noise_stds is not None:
+        noise_stds.extend(sigma_dff)
 
-        # short timescale detrending
-        tf = median_filter(dff, median_kernel_short, mode='constant')
-        tf = np.minimum(tf, 2.5*sigma_dff)
-        dff -= tf
+    # short timescale detrending
+    tf = median_filter(dff_traces, (1, median_kernel_short), mode='constant')
+    tf = np.minimum(tf, (2.5*sigma_dff).astype(dff_traces.dtype)[:, np.newaxis])
+    dff_traces -= tf
 
     return dff_traces
 
 
+def _compute_dff_windowed_median_chunk(traces, **kwargs):
+    noise_stds = []
+    n_small_baseline_frames = []
+    dff = compute_dff_windowed_median(traces,
+                                      noise_stds=noise_stds,
+                                      n_small_baseline_frames=n_small_baseline_frames,
+                                      **kwargs)
+    return dff, noise_stds, n_small_baseline_frames
+
+
+def strided_median_filter(traces, kernel_size, step, max_chunk_elements=2**22):
+    """Approximate a median filter by evaluating it only at the center of
+    each block of `step` samples and holding that value across the block.
+    Samples beyond the ends of the traces are treated as zero, as with
+    `median_filter(..., mode='constant')`.
+
+    Each sample is at most step // 2 samples from the center of its block,
+    so its window and the evaluated window differ by at most step // 2
+    samples added and removed.  The approximate value is therefore bounded
+    by the order statistics of the sample's exact window whose ranks are
+    within step // 2 of the median, i.e. it lies between the
+    (0.5 - (step // 2) / kernel_size) and (0.5 + (step // 2) / kernel_size)
+    quantiles of the exact window.
+
+    Parameters
+    ----------
+    traces : np.ndarray
+        2D array of traces to be filtered.
+    kernel_size : int
+        Odd window size of the median filter.
+    step : int
+        Number of samples per block.
+    max_chunk_elements : int
+        Upper bound on the number of window samples gathered at once.
+
+    Returns
+    -------
+    np.ndarray
+        Array of the same shape as traces.
+    """
+    num_samples = traces.shape[1]
+    halfsize = kernel_size // 2
+
+    # the last block may be too short to hold its center
+    centers = np.arange(step // 2, num_samples + step - 1, step)[:(num_samples + step - 1) // step]
+    centers[-1] = min(centers[-1], num_samples - 1)
+
+    padded = np.zeros((traces.shape[0], num_samples + 2 * halfsize))
+    padded[:, halfsize:halfsize + num_samples] = traces
+
+    # evaluate a limited number of windows at a time
+    centers_per_chunk = max(1, max_chunk_elements // kernel_size)
+
+    filtered = np.empty((traces.shape[0], len(centers)))
+    for row, padded_row in enumerate(padded):
+        for start in range(0, len(centers), centers_per_chunk):
+            chunk = centers[start:start + centers_per_chunk]
+            windows = padded_row[chunk[:, np.newaxis] + np.arange(kernel_size)]
+            filtered[row, start:start + len(chunk)] = np.median(windows, axis=1)
+
+    return np.repeat(filtered, step, axis=1)[:, :num_samples]
+
+
 def _check_kernel(kernel_size, data_size):
     if kernel_size % 2 == 0 or kernel_size <= 0 or kernel_size >= data_size:
         raise ValueError("Invalid kernel length {} for data length {}. Kernel "
@@ -346,7 +591,7 @@ def robust_std(x):
     return GAUSSIAN_MAD_STD_SCALE*median_absolute_deviation
 
 
-def calculate_dff(traces, dff_computation_cb=None, save_plot_dir=None):
+def calculate_dff(traces, dff_computation_cb=None, save_plot_dir=None, n_jobs=1):
     """Apply dF/F computation to a set of traces.
 
     The default computation method is :func:`compute_dff_windowed_median`
@@ -361,6 +606,9 @@ def calculate_dff(traces, dff_computation_cb=None, save_plot_dir=None):
         of the same shape that is the calculated dF/F.
     save_plot_dir : str
         Directory to save dF/F plots to. By default no plots are saved.
+    n_jobs : int
+        Number of processes used by the default computation. None uses
+        one per cpu. Ignored if dff_computation_cb is provided.
 
     Returns
     -------
@@ -368,7 +616,7 @@ def calculate_dff(traces, dff_computation_cb=None, save_plot_dir=None):
         2D array of dF/F traces.
     """
     if dff_computation_cb is None:
-        dff_computation_cb = compute_dff_windowed_median
+        dff_computation_cb = partial(compute_dff_windowed_median, n_jobs=n_jobs)
 
     dff = dff_computation_cb(traces)
 
@@ -431,6 +679,7 @@ def main():
     parser.add_argument("output_h5")
     parser.add_argument("--plot_dir")
     parser.add_argument("--log_level", default=logging.INFO)
+    parser.add_argument("--n_jobs", type=int, default=1)
 
     args = parser.parse_args()
 
@@ -445,7 +694,7 @@ def main():
         traces = input_h5["data"].value
         input_h5.close()
 
-    dff = calculate_dff(traces, save_plot_dir=args.plot_dir)
+    dff = calculate_dff(traces, save_plot_dir=args.plot_dir, n_jobs=args.n_jobs)
 
     # write to "data"
     output_h5 = h5py.File(args.output_h5, "w")
@@ -34,11 +34,11 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 from .stimulus_analysis import StimulusAnalysis
+from .correlation import correlation_matrix
 import scipy.stats as st
 import pandas as pd
 import numpy as np
 import h5py
-from math import sqrt
 import logging
 from . import observatory_plots as oplots
 from . import circle_plots as cplots
@@ -116,26 +116,14 @@ class DriftingGratings(StimulusAnalysis):
         '''
         DriftingGratings._log.info("Calculating mean responses")
 
-        response = np.empty(
-            (self.number_ori, self.number_tf, self.numbercells + 1, 3))
-
-        def ptest(x):
-            return len(np.where(x < (0.05 / (8 * 5)))[0])
-
-        for ori in self.orivals:
-            ori_pt = np.where(self.orivals == ori)[0][0]
-            for tf in self.tfvals:
-                tf_pt = np.where(self.tfvals == tf)[0][0]
-                subset_response = self.mean_sweep_response[
-                    (self.stim_table.temporal_frequency == tf) & (self.stim_table.orientation == ori)]
-                subset_pval = self.pval[(self.stim_table.temporal_frequency == tf) & (
-                    self.stim_table.orientation == ori)]
-                response[ori_pt, tf_pt, :, 0] = subset_response.mean(axis=0)
-                response[ori_pt, tf_pt, :, 1] = subset_response.std(
-                    axis=0) / sqrt(len(subset_response))
-                response[ori_pt, tf_pt, :, 2] = subset_pval.apply(
-                    ptest, axis=0)
-        return response
+        codes = self.get_condition_codes(self.stim_table,
+                                         [('orientation', self.orivals),
+                                          ('temporal_frequency', self.tfvals)])
+        membership = self.get_condition_membership(codes, self.number_ori * self.number_tf)
+
+        response = self.get_condition_response(membership, 0.05 / (8 * 5))
+
+        return response.reshape(self.number_ori, self.number_tf, self.numbercells + 1, 3)
 
     def get_peak(self):
         ''' Computes metrics related to each cell's peak response condition.
@@ -157,92 +145,82 @@ class DriftingGratings(StimulusAnalysis):
         '''
         DriftingGratings._log.info('Calculating peak response properties')
 
-        peak = pd.DataFrame(index=range(self.numbercells), columns=('ori_dg', 'tf_dg', 'reliability_dg',
-                                                                    'osi_dg', 'dsi_dg', 'peak_dff_dg', 
-                                                                    'ptest_dg', 'p_run_dg', 'run_modulation_dg', 
-                                                                    'cv_os_dg', 'cv_ds_dg', 'tf_index_dg', 
-                                                                    'cell_specimen_id'))
+        numbercells = self.numbercells
+        cells = np.arange(numbercells)
         cids = self.data_set.get_cell_specimen_ids()
 
-        orivals_rad = np.deg2rad(self.orivals)        
-        for nc in range(self.numbercells):
-            cell_peak = np.where(self.response[:, 1:, nc, 0] == np.nanmax(
-                self.response[:, 1:, nc, 0]))
-            prefori = cell_peak[0][0]
-            preftf = cell_peak[1][0] + 1
-            peak.cell_specimen_id.iloc[nc] = cids[nc]
-            peak.ori_dg.iloc[nc] = prefori
-            peak.tf_dg.iloc[nc] = preftf
-
-            pref = self.response[prefori, preftf, nc, 0]
-            orth1 = self.response[np.mod(prefori + 2, 8), preftf, nc, 0]
-            orth2 = self.response[np.mod(prefori - 2, 8), preftf, nc, 0]
-            orth = (orth1 + orth2) / 2
-            null = self.response[np.mod(prefori + 4, 8), preftf, nc, 0]
-
-            tuning = self.response[:, preftf, nc, 0]
-            tuning = np.where(tuning>0, tuning, 0)
-            #new circular variance below
-            CV_top_os = np.empty((8), dtype=np.complex128)
-            CV_top_ds = np.empty((8), dtype=np.complex128)
-            for i in range(8):
-                CV_top_os[i] = (tuning[i]*np.exp(1j*2*orivals_rad[i]))
-                CV_top_ds[i] = (tuning[i]*np.exp(1j*orivals_rad[i]))
-            peak.cv_os_dg.iloc[nc] = np.abs(CV_top_os.sum())/tuning.sum()
-            peak.cv_ds_dg.iloc[nc] = np.abs(CV_top_ds.sum())/tuning.sum()
-            
-            peak.osi_dg.iloc[nc] = (pref - orth) / (pref + orth)
-            peak.dsi_dg.iloc[nc] = (pref - null) / (pref + null)
-            peak.peak_dff_dg.iloc[nc] = pref
-
-            groups = []
-            for ori in self.orivals:
-                for tf in self.tfvals[1:]:
-                    groups.append(self.mean_sweep_response[(self.stim_table.temporal_frequency == tf) & (
-                        self.stim_table.orientation == ori)][str(nc)])
-            groups.append(self.mean_sweep_response[
-                          self.stim_table.temporal_frequency == 0][str(nc)])
-            _, p = st.f_oneway(*groups)
-            peak.ptest_dg.iloc[nc] = p
-
-            subset = self.mean_sweep_response[(self.stim_table.temporal_frequency == self.tfvals[
-                                               preftf]) & (self.stim_table.orientation == self.orivals[prefori])]
-            #running modulation                                 
-            subset_stat = subset[subset.dx < 1]
-            subset_run = subset[subset.dx >= 1]
-            if (len(subset_run) > 2) & (len(subset_stat) > 2):
-                (_,peak.p_run_dg.iloc[nc]) = st.ttest_ind(subset_run[str(nc)], subset_stat[str(nc)], equal_var=False)
-                
-                if subset_run[str(nc)].mean()>subset_stat[str(nc)].mean():
-                    peak.run_modulation_dg.iloc[nc] = (subset_run[str(nc)].mean() - subset_stat[str(nc)].mean())/np.abs(subset_run[str(nc)].mean())
-                elif subset_run[str(nc)].mean()<subset_stat[str(nc)].mean():
-                    peak.run_modulation_dg.iloc[nc] = -1*((subset_stat[str(nc)].mean() - subset_run[str(nc)].mean())/np.abs(subset_stat[str(nc)].mean()))
-
-            else:
-                peak.p_run_dg.iloc[nc] = np.NaN
-                peak.run_modulation_dg.iloc[nc] = np.NaN
-            
-            #reliability 
-            subset = self.sweep_response[(self.stim_table.temporal_frequency == self.tfvals[
-                                               preftf]) & (self.stim_table.orientation == self.orivals[prefori])]
-            corr_matrix = np.empty((len(subset),len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    r,p = st.pearsonr(subset[str(nc)].iloc[i][30:90], subset[str(nc)].iloc[j][30:90])
-                    corr_matrix[i,j] = r
-            mask = np.ones((len(subset), len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    if i>=j:
-                        mask[i,j] = np.NaN
-            corr_matrix *= mask
-            peak.reliability_dg.iloc[nc] = np.nanmean(corr_matrix)
-            
-            #TF index
-            tf_tuning = self.response[prefori,1:,nc,0]
-            trials = self.mean_sweep_response[(self.stim_table.temporal_frequency!=0)&(self.stim_table.orientation==self.orivals[prefori])][str(nc)].values
-            SSE_part = np.sqrt(np.sum((trials-trials.mean())**2)/(len(trials)-5))
-            peak.tf_index_dg.iloc[nc] = (np.ptp(tf_tuning))/(np.ptp(tf_tuning) + 2*SSE_part)
+        peak = pd.DataFrame(index=range(numbercells), columns=('ori_dg', 'tf_dg', 'reliability_dg',
+                                                               'osi_dg', 'dsi_dg', 'peak_dff_dg',
+                                                               'ptest_dg', 'p_run_dg', 'run_modulation_dg',
+                                                               'cv_os_dg', 'cv_ds_dg', 'tf_index_dg',
+                                                               'cell_specimen_id'))
+        if numbercells == 0:
+            return peak
+
+        number_ori = self.number_ori
+        number_tf = self.number_tf
+        response = self.response[:, :, :numbercells, 0]
+
+        # first occurrence of the peak over the non-blank conditions, in (ori, tf) order
+        driven = response[:, 1:, :].reshape(number_ori * (number_tf - 1), numbercells)
+        prefori, preftf = np.unravel_index(np.nanargmax(driven, axis=0), (number_ori, number_tf - 1))
+        preftf = preftf + 1
+
+        pref = response[prefori, preftf, cells]
+        orth1 = response[np.mod(prefori + 2, 8), preftf, cells]
+        orth2 = response[np.mod(prefori - 2, 8), preftf, cells]
+        orth = (orth1 + orth2) / 2
+        null = response[np.mod(prefori + 4, 8), preftf, cells]
+
+        # circular variance
+        orivals_rad = np.deg2rad(self.orivals)
+        tuning = response[:8, preftf, cells]
+        tuning = np.where(tuning > 0, tuning, 0)
+        cv_top_os = (tuning * np.exp(1j * 2 * orivals_rad[:8, np.newaxis])).sum(axis=0)
+        cv_top_ds = (tuning * np.exp(1j * orivals_rad[:8, np.newaxis])).sum(axis=0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            peak['cv_os_dg'] = np.abs(cv_top_os) / tuning.sum(axis=0)
+            peak['cv_ds_dg'] = np.abs(cv_top_ds) / tuning.sum(axis=0)
+            peak['osi_dg'] = (pref - orth) / (pref + orth)
+            peak['dsi_dg'] = (pref - null) / (pref + null)
+
+        peak['ori_dg'] = prefori
+        peak['tf_dg'] = preftf
+        peak['peak_dff_dg'] = pref
+        peak['cell_specimen_id'] = np.asarray(cids)[:numbercells]
+
+        codes = self.get_condition_codes(self.stim_table,
+                                         [('orientation', self.orivals),
+                                          ('temporal_frequency', self.tfvals)])
+        membership = self.get_condition_membership(codes, number_ori * number_tf)
+        values = self.mean_sweep_response.values[:, :numbercells].astype(float)
+
+        # anova groups: one per non-blank condition and one for all blank sweeps
+        ori_index, tf_index = np.divmod(codes, number_tf)
+        groups = np.where(tf_index == 0, number_ori * (number_tf - 1), ori_index * (number_tf - 1) + tf_index - 1)
+        groups[codes < 0] = -1
+        peak['ptest_dg'] = self.get_one_way_anova(
+            self.get_condition_membership(groups, number_ori * (number_tf - 1) + 1), values)
+
+        # running modulation
+        preferred = prefori * number_tf + preftf
+        dx = self.mean_sweep_response['dx'].values.astype(float)
+        peak['p_run_dg'], peak['run_modulation_dg'] = self.get_running_modulation(
+            membership, values, dx, preferred, min_trials=2)
+
+        # reliability
+        traces = self.sweep_response_tensor[:, :numbercells, 30:90]
+        peak['reliability_dg'] = self.get_reliability(traces, membership, preferred)
+
+        # TF index
+        tf_tuning = response[prefori, 1:, cells]
+        ori_membership = self.get_condition_membership(np.where(tf_index == 0, -1, ori_index), number_ori)
+        trials_mean, n_trials = self.get_grouped_mean(ori_membership, values)
+        deviation = values - ori_membership.T.dot(trials_mean)
+        sum_squares = np.asarray(ori_membership.dot(deviation ** 2))
+        sse_part = np.sqrt(sum_squares[prefori, cells] / (n_trials[prefori, cells] - 5))
+        peak['tf_index_dg'] = np.ptp(tf_tuning, axis=1) / (np.ptp(tf_tuning, axis=1) + 2 * sse_part)
 
         return peak
 
@@ -374,102 +352,49 @@ class DriftingGratings(StimulusAnalysis):
 
         return response_new, response_blank
 
-    def get_signal_correlation(self, corr='spearman'):
+    def get_signal_correlation(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating signal correlation")
 
         response = self.response[:, 1:, :self.numbercells, 0] # orientation x freq x cell, no blank
         response = response.reshape(self.number_ori * (self.number_tf-1), self.numbercells).T
-        N, Nstim = response.shape
-
-        signal_corr = np.zeros((N, N))
-        signal_p = np.empty((N, N))
-        if corr == 'pearson':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.pearsonr(response[i], response[j])
 
-        elif corr == 'spearman':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
-
-        signal_corr = np.triu(signal_corr) + np.triu(signal_corr, 1).T  # fill in lower triangle
-        signal_p = np.triu(signal_p) + np.triu(signal_p, 1).T  # fill in lower triangle
+        signal_corr, signal_p = correlation_matrix(response, corr=corr, chunk_size=chunk_size)
 
         return signal_corr, signal_p
 
 
-    def get_representational_similarity(self, corr='spearman'):
+    def get_representational_similarity(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating representational similarity")
 
         response = self.response[:, 1:, :self.numbercells, 0] # orientation x freq x phase x cell, no blank
         response = response.reshape(self.number_ori * (self.number_tf-1), self.numbercells)
-        Nstim, N = response.shape
-
-        rep_sim = np.zeros((Nstim, Nstim))
-        rep_sim_p = np.empty((Nstim, Nstim))
-        if corr == 'pearson':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.pearsonr(response[i], response[j])
 
-        elif corr == 'spearman':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
-
-        rep_sim = np.triu(rep_sim) + np.triu(rep_sim, 1).T # fill in lower triangle
-        rep_sim_p = np.triu(rep_sim_p) + np.triu(rep_sim_p, 1).T  # fill in lower triangle
+        rep_sim, rep_sim_p = correlation_matrix(response, corr=corr, chunk_size=chunk_size)
 
         return rep_sim, rep_sim_p
 
 
-    def get_noise_correlation(self, corr='spearman'):
+    def get_noise_correlation(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating noise correlations")
 
-        response, response_blank = self.reshape_response_array()
-        noise_corr = np.zeros((self.numbercells, self.numbercells, self.number_ori, self.number_tf-1))
-        noise_corr_p = np.zeros((self.numbercells, self.numbercells, self.number_ori, self.number_tf-1))
-
-        noise_corr_blank = np.zeros((self.numbercells, self.numbercells))
-        noise_corr_blank_p = np.zeros((self.numbercells, self.numbercells))
-
-        if corr == 'pearson':
-            for k in range(self.number_ori):
-                for l in range(self.number_tf-1):
-                    for i in range(self.numbercells):
-                        for j in range(i, self.numbercells):
-                            noise_corr[i, j, k, l], noise_corr_p[i, j, k, l] = st.pearsonr(response[i, k, l], response[j, k, l])
-
-                    noise_corr[:, :, k, l] = np.triu(noise_corr[:, :, k, l]) + np.triu(noise_corr[:, :, k, l], 1).T
-
-            for i in range(self.numbercells):
-                for j in range(i, self.numbercells):
-                    noise_corr_blank[i, j], noise_corr_blank_p[i, j] = st.pearsonr(response_blank[i], response_blank[j])
-
-        elif corr == 'spearman':
-            for k in range(self.number_ori):
-                for l in range(self.number_tf-1):
-                    for i in range(self.numbercells):
-                        for j in range(i, self.numbercells):
-                            noise_corr[i, j, k, l], noise_corr_p[i, j, k, l] = st.spearmanr(response[i, k, l], response[j, k, l])
+        mean_sweep_response = self.mean_sweep_response.values[:, :self.numbercells].astype(float)
+        stim_table = self.stim_table
 
-                    noise_corr[:, :, k, l] = np.triu(noise_corr[:, :, k, l]) + np.triu(noise_corr[:, :, k, l], 1).T
+        tfvals = self.tfvals
+        tfvals = tfvals[tfvals != 0] # blank sweep
 
-            for i in range(self.numbercells):
-                for j in range(i, self.numbercells):
-                    noise_corr_blank[i, j], noise_corr_blank_p[i, j] = st.spearmanr(response_blank[i], response_blank[j])
+        noise_corr = np.zeros((self.numbercells, self.numbercells, self.number_ori, self.number_tf-1))
+        noise_corr_p = np.zeros((self.numbercells, self.numbercells, self.number_ori, self.number_tf-1))
 
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        for k, ori in enumerate(self.orivals):
+            for l, tf in enumerate(tfvals):
+                ind = (stim_table.orientation.values == ori) * (stim_table.temporal_frequency.values == tf)
+                noise_corr[:, :, k, l], p = correlation_matrix(mean_sweep_response[ind].T, corr=corr, chunk_size=chunk_size)
+                noise_corr_p[:, :, k, l] = np.triu(p)
 
-        noise_corr_blank[:, :] = np.triu(noise_corr_blank[:, :]) + np.triu(noise_corr_blank[:, :], 1).T
+        ind = (stim_table.temporal_frequency.values == 0)
+        noise_corr_blank, noise_corr_blank_p = correlation_matrix(mean_sweep_response[ind].T, corr=corr, chunk_size=chunk_size)
+        noise_corr_blank_p = np.triu(noise_corr_blank_p)
 
         return noise_corr, noise_corr_p, noise_corr_blank, noise_corr_blank_p
 
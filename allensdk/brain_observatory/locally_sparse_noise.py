@@ -39,7 +39,8 @@ import h5py
 import numpy as np
 import pandas as pd
 import scipy.ndimage
-from .receptive_field_analysis.receptive_field import compute_receptive_field_with_postprocessing
+import scipy.sparse as sps
+from .receptive_field_analysis.receptive_field import compute_receptive_fields_with_postprocessing
 from .receptive_field_analysis.visualization import plot_receptive_field_data
 
 from . import circle_plots as cplots
@@ -66,6 +67,9 @@ class LocallySparseNoise(StimulusAnalysis):
 
     ncol: int
        Number of columns in the stimulus template
+
+    n_jobs: int
+       Number of processes used to compute receptive fields. None uses one per cpu.
     """
 
     LSN_ON = 255
@@ -73,8 +77,9 @@ class LocallySparseNoise(StimulusAnalysis):
     LSN_GREY = 127
     LSN_OFF_SCREEN = 64
 
-    def __init__(self, data_set, stimulus=None, **kwargs):
+    def __init__(self, data_set, stimulus=None, n_jobs=1, **kwargs):
         super(LocallySparseNoise, self).__init__(data_set, **kwargs)
+        self.n_jobs = n_jobs
         if stimulus is None:
             self.stimulus = stimulus_info.LOCALLY_SPARSE_NOISE
         else:
@@ -97,6 +102,10 @@ class LocallySparseNoise(StimulusAnalysis):
         self._receptive_field = LocallySparseNoise._PRELOAD
         self._cell_index_receptive_field_analysis_data = LocallySparseNoise._PRELOAD
 
+    @property
+    def checkpoint_stage(self):
+        return self.stimulus
+
     @property
     def LSN(self):
         if self._LSN is LocallySparseNoise._PRELOAD:
@@ -135,21 +144,22 @@ class LocallySparseNoise(StimulusAnalysis):
     @property
     def receptive_field(self):
         if self._receptive_field is LocallySparseNoise._PRELOAD:
-            self._receptive_field = self.get_receptive_field()
+            self._receptive_field = self.checkpoint('receptive_field', self.get_receptive_field)
 
         return self._receptive_field
 
     @property
     def cell_index_receptive_field_analysis_data(self):
         if self._cell_index_receptive_field_analysis_data is LocallySparseNoise._PRELOAD:
-            self._cell_index_receptive_field_analysis_data = self.get_receptive_field_analysis_data()
+            self._cell_index_receptive_field_analysis_data = \
+                self.checkpoint('receptive_field_analysis_data', self.get_receptive_field_analysis_data)
 
         return self._cell_index_receptive_field_analysis_data
 
     @property
     def mean_response(self):
         if self._mean_response is LocallySparseNoise._PRELOAD:
-            self._mean_response = self.get_mean_response()
+            self._mean_response = self.checkpoint('mean_response', self.get_mean_response)
 
         return self._mean_response
 
@@ -240,16 +250,22 @@ class LocallySparseNoise(StimulusAnalysis):
         mean_response = np.empty(
             (self.nrows, self.ncols, self.numbercells + 1, 2))
 
-        for xp in range(self.nrows):
-            for yp in range(self.ncols):
-                on_frame = np.where(self.LSN[:, xp, yp] == self.LSN_ON)[0]
-                off_frame = np.where(self.LSN[:, xp, yp] == self.LSN_OFF)[0]
-                subset_on = self.mean_sweep_response[
-                    self.stim_table.frame.isin(on_frame)]
-                subset_off = self.mean_sweep_response[
-                    self.stim_table.frame.isin(off_frame)]
-                mean_response[xp, yp, :, 0] = subset_on.mean(axis=0)
-                mean_response[xp, yp, :, 1] = subset_off.mean(axis=0)
+        frames = np.asarray(self.stim_table.frame.values, dtype=int)
+        shown = (frames >= 0) & (frames < len(self.LSN))
+        template = self.LSN[frames[shown]].reshape(shown.sum(), self.nrows * self.ncols)
+
+        values = np.asarray(self.mean_sweep_response.values, dtype=float).reshape(
+            len(frames), self.numbercells + 1)
+
+        for channel, level in enumerate((self.LSN_ON, self.LSN_OFF)):
+            # (# pixels, # sweeps) membership of each sweep in each pixel's on/off condition
+            pixels, sweeps = np.where(template.T == level)
+            membership = sps.csr_matrix((np.ones(len(sweeps)), (pixels, np.where(shown)[0][sweeps])),
+                                        shape=(self.nrows * self.ncols, len(frames)))
+
+            mean, _ = self.get_grouped_mean(membership, values)
+            mean_response[:, :, :, channel] = mean.reshape(self.nrows, self.ncols, -1)
+
         return mean_response
 
     def get_receptive_field(self):
@@ -271,13 +287,16 @@ class LocallySparseNoise(StimulusAnalysis):
 
 
     def get_receptive_field_analysis_data(self):
-        ''' Calculates receptive fields for each cell
+        ''' Calculates receptive fields for each cell, using self.n_jobs processes
         '''
 
+        cell_indices = range(self.data_set.number_of_cells)
+        rf_list = compute_receptive_fields_with_postprocessing(
+            self.data_set, cell_indices, self.stimulus, n_jobs=self.n_jobs, alpha=.05, number_of_shuffles=10000)
+
         csid_rf = {}
-        for cell_index in range(self.data_set.number_of_cells):
-            csid_rf[str(cell_index)] = compute_receptive_field_with_postprocessing(
-                self.data_set, cell_index, self.stimulus, alpha=.05, number_of_shuffles=10000)
+        for cell_index, rf in zip(cell_indices, rf_list):
+            csid_rf[str(cell_index)] = rf
 
         return csid_rf
 
@@ -33,7 +33,6 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
-import scipy.stats as st
 import pandas as pd
 import numpy as np
 import h5py
@@ -61,6 +60,10 @@ class NaturalMovie(StimulusAnalysis):
         self._sweeplength = NaturalMovie._PRELOAD
         self._sweep_response = NaturalMovie._PRELOAD
 
+    @property
+    def checkpoint_stage(self):
+        return self.movie_name
+
     @property
     def sweeplength(self):
         if self._sweeplength is NaturalMovie._PRELOAD:
@@ -71,7 +74,7 @@ class NaturalMovie(StimulusAnalysis):
     @property
     def sweep_response(self):
         if self._sweep_response is NaturalMovie._PRELOAD:
-            self._sweep_response = self.get_sweep_response()
+            self._sweep_response = self.checkpoint('sweep_response', self.get_sweep_response)
 
         return self._sweep_response
 
@@ -81,21 +84,51 @@ class NaturalMovie(StimulusAnalysis):
         self._sweeplength = \
             self.stim_table.start.iloc[1] - self.stim_table.start.iloc[0]
 
+    def get_sweep_response_tensor(self):
+        """ Gathers the dF/F trace of every cell during every repeat of the movie
+        into a single dense array with one fancy-indexing read of dfftraces.
+        Frames that fall outside of the recording are NaN.
+
+        Returns
+        -------
+        np.ndarray of shape (# repeats, # cells, # movie frames)
+        """
+        starts = self.stim_table['start'].values.astype(int)
+        frames = starts[:, np.newaxis] + np.arange(int(self.sweeplength))
+
+        dfftraces = self.dfftraces
+        n_frames = dfftraces.shape[1]
+        valid = (frames >= 0) & (frames < n_frames)
+
+        tensor = dfftraces[:, np.clip(frames, 0, n_frames - 1)].transpose(1, 0, 2)
+        if not valid.all():
+            tensor = tensor.astype(float)
+            tensor[~valid] = np.nan
+
+        return tensor
+
     def get_sweep_response(self):
-        ''' Returns the dF/F response for each cell
+        ''' Returns the dF/F response for each cell.  The traces are views
+        into self.sweep_response_tensor.
 
         Returns
         -------
         Numpy array
         '''
-        sweep_response = pd.DataFrame(index=self.stim_table.index.values, columns=np.array(
-            range(self.numbercells)).astype(str))
-        for index, row in self.stim_table.iterrows():
-            start = row.start
-            end = start + self.sweeplength
-            for nc in range(self.numbercells):
-                sweep_response[str(nc)][index] = self.dfftraces[nc, start:end]
-        return sweep_response
+        columns = np.array(range(self.numbercells)).astype(str)
+        if self.numbercells == 0:
+            return pd.DataFrame(index=self.stim_table.index.values, columns=columns)
+
+        tensor = self.sweep_response_tensor
+        starts = self.stim_table['start'].values.astype(int)
+        n_valid = np.clip(self.dfftraces.shape[1] - starts, 0, tensor.shape[2])
+
+        traces = np.empty(tensor.shape[:2], dtype=object)
+        for i in range(tensor.shape[0]):
+            for j in range(tensor.shape[1]):
+                traces[i, j] = tensor[i, j, :n_valid[i]]
+
+        return pd.DataFrame(traces, index=self.stim_table.index.values, columns=columns)
 
     def get_peak(self):
         ''' Computes properties of the peak response condition for each cell.
@@ -107,48 +140,24 @@ class NaturalMovie(StimulusAnalysis):
             * peak_nm1 (frame with peak response)
             * response_variability_nm1
         '''
-        peak_movie = pd.DataFrame(index=range(self.numbercells), columns=(
-            'peak', 'response_reliability', 'cell_specimen_id'))
+        numbercells = self.numbercells
         cids = self.data_set.get_cell_specimen_ids()
 
-        mask = np.ones((10,10))
-        for i in range(10):
-            for j in range(10):
-                if i>=j:
-                    mask[i,j] = np.NaN        
-        
-        for nc in range(self.numbercells):
-            peak_movie.cell_specimen_id.iloc[nc] = cids[nc]
-            meanresponse = self.sweep_response[str(nc)].mean()
-            
-#            movie_len = len(meanresponse) / 30
-#            output = np.empty((movie_len, 10))
-#            for tr in range(10):
-#                test = self.sweep_response[str(nc)].iloc[tr]
-#                for i in range(movie_len):
-#                    _, p = st.ks_2samp(
-#                        test[i * 30:(i + 1) * 30], test[(i + 1) * 30:(i + 2) * 30])
-#                    output[i, tr] = p
-#            output = np.where(output < 0.05, 1, 0)
-#            ptime = np.sum(output, axis=1)
-#            ptime *= 10
-            peak = np.argmax(meanresponse)
-#            if peak > 30:
-#                peak_movie.response_reliability.iloc[
-#                    nc] = ptime[(peak - 30) / 30]
-#            else:
-#                peak_movie.response_reliability.iloc[nc] = ptime[0]
-            peak_movie.peak.iloc[nc] = peak
-            
-            #reliability
-            corr_matrix = np.empty((10,10))
-            for i in range(10):
-                for j in range(10):
-                    r,p = st.pearsonr(self.sweep_response[str(nc)].iloc[i], self.sweep_response[str(nc)].iloc[j])
-                    corr_matrix[i,j] = r
-            corr_matrix*=mask
-            peak_movie.response_reliability.iloc[nc] = np.nanmean(corr_matrix)
-            
+        peak_movie = pd.DataFrame(index=range(numbercells), columns=(
+            'peak', 'response_reliability', 'cell_specimen_id'))
+
+        if numbercells > 0:
+            traces = self.sweep_response_tensor[:, :numbercells, :]
+            number_repeats = traces.shape[0]
+
+            # every repeat is a trial of the same (only) condition
+            membership = self.get_condition_membership(np.zeros(number_repeats, dtype=int), 1)
+            preferred = np.zeros(numbercells, dtype=int)
+
+            peak_movie['peak'] = np.argmax(self.get_preferred_mean_trace(traces, membership, preferred), axis=1)
+            peak_movie['response_reliability'] = self.get_reliability(traces, membership, preferred)
+            peak_movie['cell_specimen_id'] = np.asarray(cids)[:numbercells]
+
         if self.movie_name == stiminfo.NATURAL_MOVIE_ONE:
             peak_movie.rename(columns={
                               'peak': 'peak_'+stiminfo.NATURAL_MOVIE_ONE_SHORT, 
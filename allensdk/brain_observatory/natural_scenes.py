@@ -37,6 +37,7 @@ import scipy.stats as st
 import numpy as np
 import pandas as pd
 from .stimulus_analysis import StimulusAnalysis
+from .correlation import correlation_matrix
 import logging
 import h5py
 from . import observatory_plots as oplots
@@ -110,21 +111,12 @@ class NaturalScenes(StimulusAnalysis):
         '''
         NaturalScenes._log.info("Calculating mean responses")
 
-        response = np.empty((self.number_scenes, self.numbercells + 1, 3))
+        # condition 0 is the blank sweep (frame == -1)
+        codes = self.get_condition_codes(self.stim_table,
+                                         [('frame', np.arange(self.number_scenes) - 1)])
+        membership = self.get_condition_membership(codes, self.number_scenes)
 
-        def ptest(x):
-            return len(np.where(x < (0.05 / (self.number_scenes - 1)))[0])
-
-        for ns in range(self.number_scenes):
-            subset_response = self.mean_sweep_response[
-                self.stim_table.frame == (ns - 1)]
-            subset_pval = self.pval[self.stim_table.frame == (ns - 1)]
-            response[ns, :, 0] = subset_response.mean(axis=0)
-            response[ns, :, 1] = subset_response.std(
-                axis=0) / np.sqrt(len(subset_response))
-            response[ns, :, 2] = subset_pval.apply(ptest, axis=0)
-
-        return response
+        return self.get_condition_response(membership, 0.05 / (self.number_scenes - 1))
 
     def get_peak(self):
         ''' Computes metrics about peak response condition for each cell.
@@ -140,93 +132,99 @@ class NaturalScenes(StimulusAnalysis):
             * p_run_ns
             * run_modulation_ns
             * time_to_peak_ns
+            * cell_specimen_id
+            * image_selectivity_ns
         '''
         NaturalScenes._log.info('Calculating peak response properties')
-        peak = pd.DataFrame(index=range(self.numbercells), columns=('scene_ns', 'reliability_ns', 'peak_dff_ns',
-                                                                    'ptest_ns', 'p_run_ns', 'run_modulation_ns', 
-                                                                    'time_to_peak_ns', 
-                                                                    'cell_specimen_id','image_selectivity_ns'))
+
+        numbercells = self.numbercells
+        cells = np.arange(numbercells)
         cids = self.data_set.get_cell_specimen_ids()
 
-        for nc in range(self.numbercells):
-            nsp = np.argmax(self.response[1:, nc, 0])
-            peak.cell_specimen_id.iloc[nc] = cids[nc]
-            peak.scene_ns[nc] = nsp
-#            peak.response_reliability_ns[nc] = self.response[
-#                nsp + 1, nc, 2] / 0.50  # assume 50 trials
-            peak.peak_dff_ns[nc] = self.response[nsp + 1, nc, 0]
-#            subset = self.mean_sweep_response[self.stim_table.frame == nsp]
-#            subset_stat = subset[subset.dx < 2]
-#            subset_run = subset[subset.dx >= 2]
-#            if (len(subset_run) > 5) & (len(subset_stat) > 5):
-#                (_, peak.p_run_ns[nc]) = st.ks_2samp(
-#                    subset_run[str(nc)], subset_stat[str(nc)])
-#                peak.run_modulation_ns[nc] = subset_run[
-#                    str(nc)].mean() / subset_stat[str(nc)].mean()
-#            else:
-#                peak.p_run_ns[nc] = np.NaN
-#                peak.run_modulation_ns[nc] = np.NaN
-            groups = []
-            for im in range(self.number_scenes):
-                subset = self.mean_sweep_response[
-                    self.stim_table.frame == (im - 1)]
-                groups.append(subset[str(nc)].values)
-            (_, peak.ptest_ns[nc]) = st.f_oneway(*groups)
-            test = self.sweep_response[
-                self.stim_table.frame == nsp][str(nc)].mean()
-            peak.time_to_peak_ns[nc] = (
-                np.argmax(test) - self.interlength) / self.acquisition_rate
-            
-            #running modulation
-            subset = self.mean_sweep_response[self.stim_table.frame==nsp]            
-            subset_run = subset[subset.dx>=1]
-            subset_stat = subset[subset.dx<1]
-            if (len(subset_run)>4) & (len(subset_stat)>4):
-                (_,peak.p_run_ns.iloc[nc]) = st.ttest_ind(subset_run[str(nc)], subset_stat[str(nc)], equal_var=False)
-                
-                if subset_run[str(nc)].mean()>subset_stat[str(nc)].mean():
-                    peak.run_modulation_ns.iloc[nc] = (subset_run[str(nc)].mean() - subset_stat[str(nc)].mean())/np.abs(subset_run[str(nc)].mean())
-                elif subset_run[str(nc)].mean()<subset_stat[str(nc)].mean():
-                    peak.run_modulation_ns.iloc[nc] = -1*((subset_stat[str(nc)].mean() - subset_run[str(nc)].mean())/np.abs(subset_stat[str(nc)].mean()))
-            else:
-                peak.p_run_ns.iloc[nc] = np.NaN
-                peak.run_modulation_ns.iloc[nc] = np.NaN                
-            
-            #reliability
-            subset = self.sweep_response[self.stim_table.frame==nsp]            
-            corr_matrix = np.empty((len(subset),len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    r,p = st.pearsonr(subset[str(nc)].iloc[i][28:42], subset[str(nc)].iloc[j][28:42])
-                    corr_matrix[i,j] = r
-            mask = np.ones((len(subset), len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    if i>=j:
-                        mask[i,j] = np.NaN
-            corr_matrix *= mask
-            peak.reliability_ns.iloc[nc] = np.nanmean(corr_matrix)
-            
-            #image selectivity
-            fmin = self.response[1:,nc,0].min()
-            fmax = self.response[1:,nc,0].max()
-            rtj = np.empty((1000,1))
-            for j in range(1000):
-                thresh = fmin + j*((fmax-fmin)/1000.)
-                theta = np.empty((118,1))
-                for im in range(118):
-                    if self.response[im+1,nc,0] > thresh:  #im+1 to only look at images, not blanksweep
-                        theta[im] = 1
-                    else:
-                        theta[im] = 0
-                rtj[j] = theta.mean()
-            
-            biga = rtj.mean()
-            bigs = 1 - (2*biga)
-            peak.image_selectivity_ns.iloc[nc] = bigs
+        peak = pd.DataFrame(index=range(numbercells), columns=('scene_ns', 'reliability_ns', 'peak_dff_ns',
+                                                               'ptest_ns', 'p_run_ns', 'run_modulation_ns',
+                                                               'time_to_peak_ns',
+                                                               'cell_specimen_id','image_selectivity_ns'))
+        if numbercells == 0:
+            return peak
+
+        # condition 0 is the blank sweep, condition i + 1 is scene i
+        response = self.response[:, :numbercells, 0]
+        nsp = np.argmax(response[1:], axis=0)
+        preferred = nsp + 1
+
+        peak['scene_ns'] = nsp
+        peak['peak_dff_ns'] = response[preferred, cells]
+        peak['cell_specimen_id'] = np.asarray(cids)[:numbercells]
+
+        codes = self.get_condition_codes(self.stim_table,
+                                         [('frame', np.arange(self.number_scenes) - 1)])
+        membership = self.get_condition_membership(codes, self.number_scenes)
+        values = self.mean_sweep_response.values[:, :numbercells].astype(float)
+
+        peak['ptest_ns'] = self.get_one_way_anova(membership, values)
+
+        # time to peak of the mean trace over all trials of the preferred scene
+        traces = self.sweep_response_tensor[:, :numbercells, :]
+        mean_traces = self.get_preferred_mean_trace(traces, membership, preferred)
+        peak['time_to_peak_ns'] = (np.argmax(mean_traces, axis=1) - self.interlength) / self.acquisition_rate
+
+        # running modulation
+        dx = self.mean_sweep_response['dx'].values.astype(float)
+        peak['p_run_ns'], peak['run_modulation_ns'] = self.get_running_modulation(
+            membership, values, dx, preferred, min_trials=4)
+
+        # reliability
+        peak['reliability_ns'] = self.get_reliability(traces[:, :, 28:42], membership, preferred)
+
+        # image selectivity
+        peak['image_selectivity_ns'] = self.get_image_selectivity(response[1:])
 
         return peak
 
+    @staticmethod
+    def get_image_selectivity(responses, number_thresholds=1000):
+        """ Computes the image selectivity of each cell: 1 - 2 * the fraction of
+        images whose mean response exceeds a threshold, averaged over
+        number_thresholds thresholds evenly spaced from the cell's weakest
+        response up to (not including) its strongest.
+
+        Rather than comparing every response with every threshold, this counts
+        how many thresholds lie below each response.  For threshold
+        j = fmin + j * step that count is ceil((r - fmin) / step), after
+        which a single correction step makes it agree exactly with the direct
+        comparisons.
+
+        Parameters
+        ----------
+        responses: np.ndarray
+            (# images, # cells) mean responses
+
+        number_thresholds: int
+
+        Returns
+        -------
+        np.ndarray with one selectivity value per cell
+        """
+        responses = np.asarray(responses, dtype=float)
+        number_images = responses.shape[0]
+
+        fmin = responses.min(axis=0)
+        fmax = responses.max(axis=0)
+        step = (fmax - fmin) / float(number_thresholds)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            below = np.ceil((responses - fmin) / step)
+            below = np.clip(np.nan_to_num(below), 0, number_thresholds)
+
+            # fix up counts that rounding put one away from the direct comparisons
+            below = np.where((below > 0) & ~(fmin + (below - 1) * step < responses), below - 1, below)
+            below = np.where((below < number_thresholds) & (fmin + below * step < responses), below + 1, below)
+
+        fraction_above = below.sum(axis=0) / float(number_thresholds * number_images)
+
+        return 1 - 2 * fraction_above
+
     def plot_time_to_peak(self, 
                           p_value_max=oplots.P_VALUE_MAX, 
                           color_map=oplots.STIMULUS_COLOR_MAP):
@@ -293,87 +291,43 @@ class NaturalScenes(StimulusAnalysis):
 
         return response_new
 
-    def get_signal_correlation(self, corr='spearman'):
+    def get_signal_correlation(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating signal correlations")
 
         response = self.response[:, :, 0].T
         response = response[:self.numbercells, :]
-        N, Nstim = response.shape
-
-        signal_corr = np.zeros((N, N))
-        signal_p = np.empty((N, N))
-        if corr == 'pearson':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.pearsonr(response[i], response[j])
 
-        elif corr == 'spearman':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
-
-        signal_corr = np.triu(signal_corr) + np.triu(signal_corr, 1).T  # fill in lower triangle
-        signal_p = np.triu(signal_p) + np.triu(signal_p, 1).T  # fill in lower triangle
+        signal_corr, signal_p = correlation_matrix(response, corr=corr, chunk_size=chunk_size)
 
         return signal_corr, signal_p
 
-    def get_representational_similarity(self, corr='spearman'):
+    def get_representational_similarity(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating representational similarity")
 
         response = self.response[:, :, 0]
         response = response[:, :self.numbercells]
-        Nstim, N = response.shape
-
-        rep_sim = np.zeros((Nstim, Nstim))
-        rep_sim_p = np.empty((Nstim, Nstim))
-        if corr == 'pearson':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
 
-        rep_sim = np.triu(rep_sim) + np.triu(rep_sim, 1).T # fill in lower triangle
-        rep_sim_p = np.triu(rep_sim_p) + np.triu(rep_sim_p, 1).T  # fill in lower triangle
+        rep_sim, rep_sim_p = correlation_matrix(response, corr=corr, chunk_size=chunk_size)
 
         return rep_sim, rep_sim_p
 
-    def get_noise_correlation(self, corr='spearman'):
+    def get_noise_correlation(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating noise correlations")
 
-        response = self.reshape_response_array()
-        noise_corr = np.zeros((self.numbercells, self.numbercells, self.number_scenes))
-        noise_corr_p = np.zeros((self.numbercells, self.numbercells, self.number_scenes))
-
-        if corr == 'pearson':
-            for k in range(self.number_scenes):
-                for i in range(self.numbercells):
-                    for j in range(i, self.numbercells):
-                        noise_corr[i, j, k], noise_corr_p[i, j, k] = st.pearsonr(response[i, k], response[j, k])
+        mean_sweep_response = self.mean_sweep_response.values[:, :self.numbercells].astype(float)
 
-                noise_corr[:, :, k] = np.triu(noise_corr[:, :, k]) + np.triu(noise_corr[:, :, k], 1).T
-                noise_corr_p[:, :, k] = np.triu(noise_corr_p[:, :, k]) + np.triu(noise_corr_p[:, :, k], 1).T
+        stim_table = self.stim_table
+        frames = np.unique(stim_table.frame.values)
 
-        elif corr == 'spearman':
-            for k in range(self.number_scenes):
-                for i in range(self.numbercells):
-                    for j in range(i, self.numbercells):
-                        noise_corr[i, j, k], noise_corr_p[i, j, k] = st.spearmanr(response[i, k], response[j, k])
+        reps = [len(np.where(stim_table.frame.values == frame)[0]) for frame in frames]
+        Nreps = min(reps) # just in case there are different numbers of repetitions
 
-                noise_corr[:, :, k] = np.triu(noise_corr[:, :, k]) + np.triu(noise_corr[:, :, k], 1).T
-                noise_corr_p[:, :, k] = np.triu(noise_corr_p[:, :, k]) + np.triu(noise_corr_p[:, :, k], 1).T
+        noise_corr = np.zeros((self.numbercells, self.numbercells, self.number_scenes))
+        noise_corr_p = np.zeros((self.numbercells, self.numbercells, self.number_scenes))
 
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        for k, frame in enumerate(frames):
+            ind = np.where(stim_table.frame.values == frame)[0][:Nreps]
+            noise_corr[:, :, k], noise_corr_p[:, :, k] = correlation_matrix(mean_sweep_response[ind].T, corr=corr, chunk_size=chunk_size)
 
         return noise_corr, noise_corr_p
 
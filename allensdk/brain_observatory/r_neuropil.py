@@ -37,6 +37,8 @@ import numpy as np
 import scipy.sparse as sparse
 from scipy.linalg import solve_banded
 import logging
+import multiprocessing as mp
+from functools import partial
 
 
 def get_diagonals_from_sparse(mat):
@@ -191,15 +193,21 @@ class NeuropilSubtract(object):
 
         self.F_M = None
         self.F_N = None
+        self.F_M_smooth = None
+        self.F_N_smooth = None
 
         self.r_vals = None
         self.error_vals = None
         self.r = None
         self.error = None
 
-    def set_F(self, F_M, F_N):
+    def set_F(self, F_M, F_N, F_M_smooth=None, F_N_smooth=None):
         """ Break the F_M and F_N traces into the number of folds specified
         in the class constructor and normalize each fold of F_M and R_N relative to F_N.
+
+        The smoothed folds of F_M and F_N, from which the corrected trace for
+        any r follows by linearity, are computed with one banded solve unless
+        they are provided (as lists with one array per fold).
         """
 
         F_M_len = len(F_M)
@@ -209,20 +217,44 @@ class NeuropilSubtract(object):
             raise Exception(
                 "F_M and F_N must have the same length (%d vs %d)" % (F_M_len, F_N_len))
 
-        if self.T != F_M_len:
-            logging.debug("updating ab matrix for new T=%d", F_M_len)
-            self.T = F_M_len
+        self.set_T(F_M_len)
+
+        self.F_M = self.split_folds(F_M)
+        self.F_N = self.split_folds(F_N)
+
+        if F_M_smooth is None or F_N_smooth is None:
+            smooth = self.smooth_folds(self.F_M + self.F_N)
+            F_M_smooth, F_N_smooth = smooth[:self.folds], smooth[self.folds:]
+
+        self.F_M_smooth = F_M_smooth
+        self.F_N_smooth = F_N_smooth
+
+    def set_T(self, T):
+        """ Set the trace length, updating the fold length and ab matrix if it changed. """
+
+        if self.T != T:
+            logging.debug("updating ab matrix for new T=%d", T)
+            self.T = T
             self.T_f = int(self.T / self.folds)
             self.ab = ab_from_T(self.T_f, self.lam, self.dt)
 
-        self.F_M = []
-        self.F_N = []
+    def split_folds(self, F):
+        """ Break a trace into the number of folds specified in the class constructor. """
 
+        folds = []
         for fi in range(self.folds):
             # F_M_i_s, F_N_i_s = normalize_F(F_M[fi*self.T_f:(fi+1)*self.T_f],
             #                               F_N[fi*self.T_f:(fi+1)*self.T_f])
-            self.F_M.append(F_M[fi * self.T_f:(fi + 1) * self.T_f])
-            self.F_N.append(F_N[fi * self.T_f:(fi + 1) * self.T_f])
+            folds.append(F[fi * self.T_f:(fi + 1) * self.T_f])
+
+        return folds
+
+    def smooth_folds(self, folds):
+        """ Solve the banded system for many folds at once, passing each fold as
+        a right-hand-side column. """
+
+        F_smooth = solve_banded((1, 1), self.ab, np.column_stack(folds))
+        return list(F_smooth.T)
 
     def fit_block_coordinate_desc(self, r_init=5.0, min_delta_r=0.00000001):
         F_M = np.concatenate(self.F_M)
@@ -271,18 +303,14 @@ class NeuropilSubtract(object):
 
         it_dr = dr
         while it < iterations:
-            it_errors = []
-
             # build a set of r values evenly distributed in a current range
             rs = np.arange(it_range[0], it_range[1], it_dr)
 
             # estimate error for each r
-            for r in rs:
-                error = self.estimate_error(r)
-                it_errors.append(error)
+            it_errors = self.estimate_errors(rs)
 
-                r_vals.append(r)
-                error_vals.append(error)
+            r_vals.extend(rs)
+            error_vals.extend(it_errors)
 
             # find the minimum in this range and update the global minimum
             min_i = np.argmin(it_errors)
@@ -316,14 +344,21 @@ class NeuropilSubtract(object):
     def estimate_error(self, r):
         """ Estimate error values for a given r for each fold and return the mean. """
 
-        errors = np.zeros(self.folds)
+        return self.estimate_errors(np.array([r]))[0]
+
+    def estimate_errors(self, rs):
+        """ Estimate the mean error across folds for each of an array of r values. """
+
+        rs = np.asarray(rs, dtype=float).reshape(-1, 1)
+
+        errors = np.zeros((self.folds, len(rs)))
         for fi in range(self.folds):
             F_M = self.F_M[fi]
             F_N = self.F_N[fi]
-            F_C = solve_banded((1, 1), self.ab, F_M - r * F_N)
-            errors[fi] = abs(error_calc(F_M, F_N, F_C, r))
+            F_C = self.F_M_smooth[fi] - rs * self.F_N_smooth[fi]
+            errors[fi] = np.abs(np.sqrt(np.mean(np.square(F_C - (F_M - rs * F_N)), axis=1)) / np.mean(F_M))
 
-        return np.mean(errors)
+        return np.mean(errors, axis=0)
 
 
 def estimate_contamination_ratios(F_M, F_N,
@@ -349,6 +384,85 @@ def estimate_contamination_ratios(F_M, F_N,
 
     ns.set_F(F_M, F_N)
 
+    return _fit_contamination_ratio(ns, r_range, iterations, dr, dr_factor)
+
+
+def estimate_contamination_ratios_batch(F_M, F_N,
+                                        lam=0.05, folds=4, iterations=3,
+                                        r_range=[0.0, 2.0], dr=0.1, dr_factor=0.1,
+                                        n_jobs=1, batch_size=50):
+    ''' Calculates neuropil contamination of many ROIs.  All ROIs share the
+    banded smoothing matrix, so the folds of a batch of ROIs are smoothed
+    with a single banded solve.
+
+    Parameters
+    ----------
+       F_M: 2D array of ROI traces
+       F_N: 2D array of neuropil traces
+       n_jobs: number of processes to split the ROIs across. None uses one per cpu.
+       batch_size: number of ROIs smoothed together
+
+    Returns
+    -------
+    list of dictionaries, one per ROI, as returned by estimate_contamination_ratios
+    '''
+
+    F_M = np.asarray(F_M)
+    F_N = np.asarray(F_N)
+
+    if F_M.shape != F_N.shape:
+        raise Exception(
+            "F_M and F_N must have the same shape (%s vs %s)" % (F_M.shape, F_N.shape))
+
+    fit = partial(estimate_contamination_ratios_batch,
+                  lam=lam, folds=folds, iterations=iterations,
+                  r_range=r_range, dr=dr, dr_factor=dr_factor,
+                  n_jobs=1, batch_size=batch_size)
+
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    if n_jobs > 1 and len(F_M) > 1:
+        chunks = np.array_split(np.arange(len(F_M)), min(n_jobs, len(F_M)))
+
+        pool = mp.Pool(len(chunks))
+        try:
+            results = pool.map(partial(_estimate_contamination_ratios_chunk, fit),
+                               [ (F_M[chunk], F_N[chunk]) for chunk in chunks ])
+        finally:
+            pool.close()
+            pool.join()
+
+        return [ result for chunk_results in results for result in chunk_results ]
+
+    ns = NeuropilSubtract(lam=lam, folds=folds)
+
+    results = []
+    for start in range(0, len(F_M), batch_size):
+        F_M_batch = F_M[start:start + batch_size]
+        F_N_batch = F_N[start:start + batch_size]
+
+        # smooth the folds of every ROI in the batch together
+        ns.set_T(F_M.shape[1])
+        folds_batch = [ fold for F in F_M_batch for fold in ns.split_folds(F) ] + \
+                      [ fold for F in F_N_batch for fold in ns.split_folds(F) ]
+        smooth = ns.smooth_folds(folds_batch)
+
+        num_folds = len(F_M_batch) * folds
+        for i, (F_M_i, F_N_i) in enumerate(zip(F_M_batch, F_N_batch)):
+            ns.set_F(F_M_i, F_N_i,
+                     F_M_smooth=smooth[i * folds:(i + 1) * folds],
+                     F_N_smooth=smooth[num_folds + i * folds:num_folds + (i + 1) * folds])
+            results.append(_fit_contamination_ratio(ns, r_range, iterations, dr, dr_factor))
+
+    return results
+
+
+def _estimate_contamination_ratios_chunk(fit, traces):
+    return fit(*traces)
+
+
+def _fit_contamination_ratio(ns, r_range, iterations, dr, dr_factor):
     ns.fit(r_range=r_range,
            iterations=iterations,
            dr=dr,
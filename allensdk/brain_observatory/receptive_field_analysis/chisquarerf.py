@@ -36,6 +36,7 @@
 import numpy as np
 import scipy.interpolate as si
 import scipy.ndimage.filters as filt
+import scipy.sparse as sps
 import scipy.stats as stats
 
 
@@ -82,17 +83,12 @@ def chi_square_binary(events, LSN_template):
     events_per_pixel = get_events_per_pixel(events, trial_matrix)
 
     # smooth stimulus-triggered average spatially with a gaussian
-    for n in range(num_cells):
-        for on_off in range(2):
-            events_per_pixel[n, :, :, on_off] = smooth_STA(events_per_pixel[n, :, :, on_off])
+    events_per_pixel = smooth_STA(events_per_pixel.transpose(0, 3, 1, 2)).transpose(0, 2, 3, 1)
 
     # calculate the p_value for each exclusion region
-    chi_square_grid = np.zeros((num_cells, num_y, num_x))
-    for y in range(num_y):
-        for x in range(num_x):
-            exclusion_mask = np.ones((num_y, num_x, 2)) * disc_masks[y, x, :, :].reshape(num_y, num_x, 1)
-            p_vals, __ = chi_square_within_mask(exclusion_mask, events_per_pixel, trials_per_pixel)
-            chi_square_grid[:, y, x] = p_vals
+    masks = disc_masks.reshape(num_y * num_x, num_y, num_x)
+    p_vals, __ = chi_square_within_masks(masks, events_per_pixel, trials_per_pixel)
+    chi_square_grid = p_vals.reshape(num_cells, num_y, num_x)
 
     return chi_square_grid
 
@@ -203,17 +199,12 @@ def get_events_per_pixel(responses_np, trial_matrix):
     '''
 
     num_cells = np.shape(responses_np)[1]
-    num_y = np.shape(trial_matrix)[0]
-    num_x = np.shape(trial_matrix)[1]
+    num_y, num_x, _, num_trials = np.shape(trial_matrix)
 
-    events_per_pixel = np.zeros((num_cells, num_y, num_x, 2))
-    for y in range(num_y):
-        for x in range(num_x):
-            for on_off in range(2):
-                frames = np.argwhere(trial_matrix[y, x, on_off, :])[:, 0]
-                events_per_pixel[:, y, x, on_off] = np.sum(responses_np[frames, :], axis=0)
+    trials = trial_matrix.reshape(num_y * num_x * 2, num_trials).astype(float)
+    events_per_pixel = trials.dot(np.asarray(responses_np, dtype=float))
 
-    return events_per_pixel
+    return events_per_pixel.T.reshape(num_cells, num_y, num_x, 2)
 
 
 def smooth_STA(STA, gauss_std=0.75, total_degrees=64):
@@ -222,7 +213,8 @@ def smooth_STA(STA, gauss_std=0.75, total_degrees=64):
     Parameters
     ----------
     STA : np.ndarray
-        Input image
+        Input image. Any leading dimensions are treated as a stack of images 
+        of shape (nYPixels, nXPixels), which are smoothed independently.
     gauss_std : numeric, optional
         Standard deviation of the gaussian kernel. Will be applied to the 
         upsampled image, so units are visual degrees. Default is 0.75
@@ -236,14 +228,50 @@ def smooth_STA(STA, gauss_std=0.75, total_degrees=64):
         Smoothed image
     '''
 
-    deg_per_pnt = total_degrees // STA.shape[0]
-    STA_interpolated = interpolate_RF(STA, deg_per_pnt)
-    STA_interpolated_smoothed = filt.gaussian_filter(STA_interpolated, gauss_std)
-    STA_smoothed = deinterpolate_RF(STA_interpolated_smoothed, STA.shape[1], STA.shape[0], deg_per_pnt)
+    y_pnts, x_pnts = STA.shape[-2:]
+    deg_per_pnt = total_degrees // y_pnts
+
+    # bilinear upsampling is separable, so the whole stack can be upsampled 
+    # with one matrix along each image axis
+    x_interpolation = get_interpolation_matrix(x_pnts, deg_per_pnt)
+    y_interpolation = get_interpolation_matrix(y_pnts, deg_per_pnt)
+    STA_interpolated = np.matmul(np.matmul(y_interpolation, STA), x_interpolation.T)
+
+    sigma = [0] * (STA.ndim - 2) + [gauss_std, gauss_std]
+    STA_interpolated_smoothed = filt.gaussian_filter(STA_interpolated, sigma)
+
+    x_deinterpolate = np.arange(0, x_interpolation.shape[0], deg_per_pnt)
+    y_deinterpolate = np.arange(0, y_interpolation.shape[0], deg_per_pnt)
+    STA_smoothed = STA_interpolated_smoothed[..., y_deinterpolate, :][..., x_deinterpolate]
 
     return STA_smoothed
 
 
+def get_interpolation_matrix(pnts, deg_per_pnt):
+    '''Build the linear operator which upsamples one image axis in the 
+    same way as interpolate_RF
+
+    Parameters
+    ----------
+    pnts : int
+        Count of sample points along the axis
+    deg_per_pnt : numeric
+        scale factor
+
+    Returns
+    -------
+    np.ndarray :
+        Dimensions are (nUpsampledPoints, pnts). Each row holds the linear 
+        interpolation weights of one upsampled point.
+    '''
+
+    coor = np.arange(-(pnts - 1) * deg_per_pnt / 2, (pnts + 1) * deg_per_pnt / 2, deg_per_pnt)
+    interpolated = np.arange(-(pnts - 1) * deg_per_pnt / 2, deg_per_pnt / 2 + (pnts / 2 - 1) * deg_per_pnt + 1, 1)
+
+    identity = np.eye(pnts)
+    return np.array([ np.interp(interpolated, coor, column) for column in identity ]).T
+
+
 def interpolate_RF(rf_map, deg_per_pnt):
     '''Upsample an image
       
@@ -358,6 +386,80 @@ def chi_square_within_mask(exclusion_mask, events_per_pixel, trials_per_pixel):
     return p_vals, chi
 
 
+def chi_square_within_masks(masks, events_per_pixel, trials_per_pixel):
+    '''Apply chi_square_within_mask to many masks at once.
+
+    The statistic within each mask is expanded as 
+    sum(observed ** 2 / expected) - 2 * sum(observed) + sum(expected), so that 
+    every term is a product of the (sparse) mask matrix with per-pixel totals.
+
+    Parameters
+    ----------
+    masks : np.ndarray
+        Dimensions are (nMasks, nYPixels, nXPixels). Integer indicator for INCLUSION 
+        of a pixel within each testing region. Masks are shared by on and off pixels.
+    events_per_pixel : np.ndarray
+        Dimensions are (nCells, nYPixels, nXPixels, {on, off}). Integer values 
+        are response counts by cell to on/off luminance at each pixel.
+    trials_per_pixel : np.ndarray
+        Dimensions are (nYPixels, nXPixels, {on, off}). Integer values are 
+        counts of trials where a pixel is on/off.
+
+    Returns
+    -------
+    p_vals : np.ndarray 
+        Dimensions are (nCells, nMasks). Float values are p-values 
+        for the hypothesis that a given cell has a receptive field within 
+        each mask.
+    chi_sum : np.ndarray
+        Dimensions are (nCells, nMasks). Values (float) are the test statistic 
+        summed within each mask.
+    '''
+
+    num_masks = np.shape(masks)[0]
+    num_cells = np.shape(events_per_pixel)[0]
+
+    mask_matrix = sps.csr_matrix(np.reshape(masks, (num_masks, -1)).astype(float))
+    events = np.reshape(events_per_pixel, (num_cells, -1, 2)).astype(float)
+    trials = np.reshape(trials_per_pixel, (-1, 2)).astype(float)
+
+    # d.f. is number of pixels (on and off) in mask minus one
+    degrees_of_freedom = 2 * np.asarray(mask_matrix.sum(axis=1)).ravel() - 1
+
+    total_trials = mask_matrix.dot(trials.sum(axis=1))
+    total_events_by_cell = mask_matrix.dot(events.sum(axis=2).T).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected_by_cell_per_trial = total_events_by_cell / total_trials
+
+    # pixels without trials are expected to have no events. Any event found 
+    # there is infinitely surprising, while an absence of events is ignored.
+    has_trials = trials > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        events_squared_per_trial = np.where(has_trials, events ** 2 / trials, 0.0).sum(axis=2)
+    observed = np.where(has_trials, events, 0.0).sum(axis=2)
+    unexpected = np.logical_and(~has_trials, events > 0).sum(axis=2).astype(float)
+
+    masked_events_squared_per_trial = mask_matrix.dot(events_squared_per_trial.T).T
+    masked_observed = mask_matrix.dot(observed.T).T
+    masked_unexpected = mask_matrix.dot(unexpected.T).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi_sum = masked_events_squared_per_trial / expected_by_cell_per_trial \
+            - 2 * masked_observed \
+            + expected_by_cell_per_trial * total_trials
+    chi_sum[masked_unexpected > 0] = np.inf
+
+    # with no events or no trials every expected count is 0 or undefined, 
+    # so each term is ignored
+    chi_sum[expected_by_cell_per_trial == 0] = 0.0
+    chi_sum[:, total_trials == 0] = 0.0
+
+    # get p-value given test statistic and degrees of freedom
+    p_vals = 1.0 - stats.chi2.cdf(chi_sum, degrees_of_freedom)
+
+    return p_vals, chi_sum
+
+
 def get_expected_events_by_pixel(exclusion_mask, events_per_pixel, trials_per_pixel):
     '''Calculate expected number of events per pixel
 
@@ -423,17 +525,10 @@ def build_trial_matrix(LSN_template,
         indicate that a pixel was on/off on a particular trial.
     '''
 
-    _, num_y, num_x = np.shape(LSN_template)
-    trial_mat = np.zeros( (num_y, num_x, 2, num_trials), dtype=bool )
-
-    for y in range(num_y):
-        for x in range(num_x):
-            for oo, on_off in enumerate(on_off_luminance):
+    on_off_luminance = np.asarray(on_off_luminance).reshape(1, 1, 1, 2)
+    trial_mat = LSN_template[:num_trials, :, :, np.newaxis] == on_off_luminance
 
-                frame = np.argwhere( LSN_template[:num_trials, y, x] == on_off )[:, 0]
-                trial_mat[y, x, oo, frame] = True
-
-    return trial_mat
+    return trial_mat.transpose(1, 2, 3, 0)
 
 
 def get_disc_masks(LSN_template, radius=3, on_luminance=ON_LUMINANCE, off_luminance=OFF_LUMINANCE):
@@ -471,40 +566,27 @@ def get_disc_masks(LSN_template, radius=3, on_luminance=ON_LUMINANCE, off_lumina
     LSN_binary = np.where(LSN_binary == 1, 1.0, 0.0)
 
     # get number of trials each pixel is not gray
-    on_trials = LSN_binary.sum(axis=0).astype(float)  # shape is (num_y,num_x)
-
-    masks = np.zeros((num_y, num_x, num_y, num_x))
-    for y in range(num_y):
-        for x in range(num_x):
-            trials_not_gray = np.argwhere( LSN_binary[:, y, x] > 0 )[:, 0]
-            raw_mask = np.divide( LSN_binary[trials_not_gray, :, :].sum(axis=0), on_trials ) 
-
-            center_y, center_x = np.unravel_index( raw_mask.argmax(), (num_y, num_x) )
-
-            # include center pixel in mask
-            raw_mask[center_y, center_x] = 0.0
-
-            x_max = center_x + radius + 1
-            if x_max > num_x:
-                x_max = num_x
-            x_min = center_x - radius
-            if x_min < 0:
-                x_min = 0
-            y_max = center_y + radius + 1
-            if y_max > num_y:
-                y_max = num_y
-            y_min = center_y - radius
-            if y_min < 0:
-                y_min = 0
-
-            # don't include far away pixels that just happen
-            # to not have any trials in common with center pixel
-            clean_mask = np.ones(np.shape(raw_mask))
-            clean_mask[y_min:y_max, x_min:x_max] = raw_mask[y_min:y_max, x_min:x_max]
-
-            masks[y, x, :, :] = clean_mask
+    LSN_binary = LSN_binary.reshape(LSN_binary.shape[0], num_y * num_x)
+    on_trials = LSN_binary.sum(axis=0).astype(float)  # shape is (num_y * num_x,)
+
+    # fraction of each pixel's trials on which it is coactive with each other pixel
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw_masks = np.divide( LSN_binary.T.dot(LSN_binary), on_trials )
+
+    centers = raw_masks.argmax(axis=1)
+    center_y, center_x = np.unravel_index( centers, (num_y, num_x) )
 
+    # include center pixel in mask
+    raw_masks[np.arange(num_y * num_x), centers] = 0.0
+    raw_masks = raw_masks.reshape(num_y, num_x, num_y, num_x)
+
+    # don't include far away pixels that just happen
+    # to not have any trials in common with center pixel
+    in_box_y = np.abs( np.arange(num_y)[np.newaxis, :] - center_y[:, np.newaxis] ) <= radius
+    in_box_x = np.abs( np.arange(num_x)[np.newaxis, :] - center_x[:, np.newaxis] ) <= radius
+    in_box = np.logical_and( in_box_y[:, :, np.newaxis], in_box_x[:, np.newaxis, :] )
+
+    masks = np.where(in_box.reshape(num_y, num_x, num_y, num_x), raw_masks, 1.0)
     masks = np.where(masks > 0, 0.0, 1.0)
 
     return masks
-
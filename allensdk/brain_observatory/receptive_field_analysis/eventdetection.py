@@ -37,119 +37,158 @@ from .utilities import smooth
 import numpy as np
 import scipy.stats as sps
 
-def detect_events(data, cell_index, stimulus, debug_plots=False):
 
+def _pairwise_max(a, b):
+    # same as the builtin max: keeps a unless b is strictly larger
+    return np.where(b > a, b, a)
 
+def get_trial_windows(stimulus_table, trace_length, k_min=0, k_max=10):
+    '''
+    First and last frame of the trace window that follows the start of each trial.
+    The window starts one frame later when a trial starts on the end frame of
+    the previous one, and is truncated at the end of the trace.
 
-    stimulus_table = data.get_stimulus_table(stimulus)
-    dff_trace = data.get_dff_traces()[1][cell_index, :]
+    :return: tuple of (trials,) arrays: first, last
+    '''
 
+    starts = stimulus_table['start'].values.astype(int)
+    ends = stimulus_table['end'].values.astype(int)
 
+    offset = np.zeros(len(starts), dtype=int)
+    offset[1:] = starts[1:] == ends[:-1]
 
-    k_min = 0
-    k_max = 10
-    delta = 3
+    # every trial needs a complete window
+    assert np.all((starts + k_min >= 0) & (starts + k_max <= trace_length))
 
-    dff_trace = smooth(dff_trace, 5)
+    first = starts + k_min + 1 + offset
+    last = np.minimum(first + k_max - k_min, trace_length) - 1
 
+    return first, last
 
+def get_event_features(dff_traces, stimulus_table, k_min=0, k_max=10, delta=3):
+    '''
+    Computes the per-trial statistics used to detect events, for all cells and trials at once.
 
-    var_dict = {}
-    debug_dict = {}
-    for ii, fi in enumerate(stimulus_table['start'].values):
+    :param dff_traces: (cells, frames) smoothed dF/F traces
+    :param stimulus_table: stimulus table with start and end frames
+    :return: tuple of (cells, trials) arrays: t0 and tf, the first and last samples of each
+             trial window, and xx and yy, the early and late change in dF/F
+    '''
 
-        if ii > 0 and stimulus_table.iloc[ii].start == stimulus_table.iloc[ii-1].end:
-            offset = 1
-        else:
-            offset = 0
+    first, last = get_trial_windows(stimulus_table, dff_traces.shape[1], k_min=k_min, k_max=k_max)
 
-        if fi + k_min >= 0 and fi + k_max <= len(dff_trace):
-            trace = dff_trace[fi + k_min+1+offset:fi + k_max+1+offset]
+    def change(ii):
+        return dff_traces[:, first + delta + ii] - dff_traces[:, first + ii]
 
-            xx = (trace - trace[0])[delta] - (trace - trace[0])[0]
-            yy = max((trace - trace[0])[delta + 2] - (trace - trace[0])[0 + 2],
-                     (trace - trace[0])[delta + 3] - (trace - trace[0])[0 + 3],
-                     (trace - trace[0])[delta + 4] - (trace - trace[0])[0 + 4])
+    t0 = dff_traces[:, first]
+    tf = dff_traces[:, last]
+    xx = change(0)
+    yy = _pairwise_max(_pairwise_max(change(2), change(3)), change(4))
 
-            var_dict[ii] = (trace[0], trace[-1], xx, yy)
-            debug_dict[fi + k_min+1+offset] = (ii, trace)
+    return t0, tf, xx, yy
 
-    xx_list, yy_list = [], []
-    for _, _, xx, yy in var_dict.values():
-        xx_list.append(xx)
-        yy_list.append(yy)
+def classify_events(tf, xx, yy):
+    '''
+    Labels trials as events from the statistics computed by get_event_features.
 
-    mu_x = np.median(xx_list)
-    mu_y = np.median(yy_list)
+    :return: (cells, trials) boolean array
+    '''
 
-    xx_centered = np.array(xx_list)-mu_x
-    yy_centered = np.array(yy_list)-mu_y
+    mu_x = np.median(xx, axis=1)
+    mu_y = np.median(yy, axis=1)
+
+    xx_centered = xx - mu_x[:, np.newaxis]
+    yy_centered = yy - mu_y[:, np.newaxis]
 
     std_factor = 1
-    std_x = 1./std_factor*np.percentile(np.abs(xx_centered), [100*(1-2*(1-sps.norm.cdf(std_factor)))])
-    std_y = 1./std_factor*np.percentile(np.abs(yy_centered), [100*(1-2*(1-sps.norm.cdf(std_factor)))])
+    std_x = 1./std_factor*np.percentile(np.abs(xx_centered), 100*(1-2*(1-sps.norm.cdf(std_factor))), axis=1)
+    std_y = 1./std_factor*np.percentile(np.abs(yy_centered), 100*(1-2*(1-sps.norm.cdf(std_factor))), axis=1)
 
-    curr_inds = []
     allowed_sigma = 4
-    for ii, (xi, yi) in enumerate(zip(xx_centered, yy_centered)):
-        if np.sqrt(((xi)/std_x)**2+((yi)/std_y)**2) < allowed_sigma:
-            curr_inds.append(True)
-        else:
-            curr_inds.append(False)
-
-    curr_inds = np.array(curr_inds)
-    data_x = xx_centered[curr_inds]
-    data_y = yy_centered[curr_inds]
-    Cov = np.cov(data_x, data_y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curr_inds = np.sqrt((xx_centered/std_x[:, np.newaxis])**2+(yy_centered/std_y[:, np.newaxis])**2) < allowed_sigma
+
+    # covariance of the trials inside the noise blob
+    number_of_inds = curr_inds.sum(axis=1)
+    data_x = np.where(curr_inds, xx_centered, 0)
+    data_y = np.where(curr_inds, yy_centered, 0)
+    data_x = np.where(curr_inds, data_x - (data_x.sum(axis=1)/number_of_inds)[:, np.newaxis], 0)
+    data_y = np.where(curr_inds, data_y - (data_y.sum(axis=1)/number_of_inds)[:, np.newaxis], 0)
+
+    Cov = np.empty((len(xx), 2, 2))
+    Cov[:, 0, 0] = (data_x*data_x).sum(axis=1)
+    Cov[:, 0, 1] = Cov[:, 1, 0] = (data_x*data_y).sum(axis=1)
+    Cov[:, 1, 1] = (data_y*data_y).sum(axis=1)
+    Cov /= (number_of_inds - 1)[:, np.newaxis, np.newaxis]
+
     Cov_Factor = np.linalg.cholesky(Cov)
     Cov_Factor_Inv = np.linalg.inv(Cov_Factor)
 
     #===================================================================================================================
 
-    noise_threshold = max(allowed_sigma * std_x + mu_x, allowed_sigma * std_y + mu_y)
-    mu_array = np.array([mu_x, mu_y])
-    yes_set, no_set = set(), set()
-    for ii, (t0, tf, xx, yy) in var_dict.items():
+    noise_threshold = _pairwise_max(allowed_sigma * std_x + mu_x, allowed_sigma * std_y + mu_y)
+
+    xi_z = Cov_Factor_Inv[:, 0, 0, np.newaxis]*xx_centered + Cov_Factor_Inv[:, 0, 1, np.newaxis]*yy_centered
+    yi_z = Cov_Factor_Inv[:, 1, 0, np.newaxis]*xx_centered + Cov_Factor_Inv[:, 1, 1, np.newaxis]*yy_centered
+
+    # Conditions in order:
+    # 1) Outside noise blob
+    # 2) Minimum change in df/f
+    # 3) Change evoked by this trial, not previous
+    # 4) At end of trace, ended up outside of noise floor
+    return (np.sqrt(xi_z**2 + yi_z**2) > 4) & (yy > .05) & (xx < yy) & (tf > noise_threshold[:, np.newaxis]/2)
+
+def detect_events_all_cells(data, stimulus, dff_traces=None, stimulus_table=None, cell_indices=None):
+    '''
+    Detects stimulus-evoked events for many cells, reading the dF/F traces and
+    stimulus table once.
 
+    :param dff_traces: (cells, frames) dF/F traces. Default reads them from data.
+    :param stimulus_table: Default reads it from data.
+    :param cell_indices: rows of dff_traces to use. Default is all of them.
+    :return: (cells, trials) boolean array
+    '''
 
-        xi_z, yi_z = Cov_Factor_Inv.dot((np.array([xx,yy]) - mu_array))
+    if stimulus_table is None:
+        stimulus_table = data.get_stimulus_table(stimulus)
+    if dff_traces is None:
+        dff_traces = data.get_dff_traces()[1]
+    if cell_indices is None:
+        cell_indices = range(len(dff_traces))
 
-        # Conditions in order:
-        # 1) Outside noise blob
-        # 2) Minimum change in df/f
-        # 3) Change evoked by this trial, not previous
-        # 4) At end of trace, ended up outside of noise floor
+    smoothed_traces = np.array([smooth(dff_traces[cell_index, :], 5) for cell_index in cell_indices])
+    smoothed_traces = smoothed_traces.reshape(len(cell_indices), -1)
 
-        if np.sqrt(xi_z**2 + yi_z**2) > 4 and yy > .05 and xx < yy and tf > noise_threshold/2:
-            yes_set.add(ii)
-        else:
-            no_set.add(ii)
+    t0, tf, xx, yy = get_event_features(smoothed_traces, stimulus_table)
 
+    return classify_events(tf, xx, yy)
 
+def detect_events(data, cell_index, stimulus, debug_plots=False, dff_traces=None, stimulus_table=None):
 
-    assert len(var_dict) == len(stimulus_table)
-    b = np.zeros(len(stimulus_table), dtype=np.bool)
-    for yi in yes_set:
-        b[yi] = True
+    if stimulus_table is None:
+        stimulus_table = data.get_stimulus_table(stimulus)
+    if dff_traces is None:
+        dff_traces = data.get_dff_traces()[1]
+
+    b = detect_events_all_cells(data, stimulus, dff_traces=dff_traces, stimulus_table=stimulus_table,
+                                cell_indices=[cell_index])[0]
 
     if debug_plots == True:
         import matplotlib.pyplot as plt
-        fig, ax = plt.subplots(1,2)
-        # ax[0].plot(dff_trace)
-        for key, val in debug_dict.items():
-            ti, trace = val
-            if ti in no_set:
-                ax[0].plot(np.arange(key, key+len(trace)), trace, 'b')
-            elif ti in yes_set:
-                ax[0].plot(np.arange(key, key + len(trace)), trace, 'r', linewidth=2)
-            else:
-                raise Exception
 
-        for ii in yes_set:
-            ax[1].plot([var_dict[ii][2]], [var_dict[ii][3]], 'r.')
+        dff_trace = smooth(dff_traces[cell_index, :], 5)
+        _, _, xx, yy = get_event_features(dff_trace[np.newaxis, :], stimulus_table)
+        first, last = get_trial_windows(stimulus_table, len(dff_trace))
 
-        for ii in no_set:
-            ax[1].plot([var_dict[ii][2]], [var_dict[ii][3]], 'b.')
+        fig, ax = plt.subplots(1,2)
+        for ii, (fi, li) in enumerate(zip(first, last)):
+            window = np.arange(fi, li + 1)
+            if b[ii]:
+                ax[0].plot(window, dff_trace[window], 'r', linewidth=2)
+                ax[1].plot([xx[0, ii]], [yy[0, ii]], 'r.')
+            else:
+                ax[0].plot(window, dff_trace[window], 'b')
+                ax[1].plot([xx[0, ii]], [yy[0, ii]], 'b.')
 
         print('number_of_events: %d' % b.sum())
         plt.show()
@@ -33,47 +33,61 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
-from .eventdetection import detect_events
+from .eventdetection import detect_events, detect_events_all_cells
 from statsmodels.sandbox.stats.multicomp import multipletests
 import numpy as np
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+from functools import partial
 from .utilities import get_A, get_A_blur, get_shuffle_matrix, get_components, dict_generator
 from .postprocessing import run_postprocessing
 import h5py
 
-def events_to_pvalues_no_fdr_correction(data, event_vector, A, number_of_shuffles=5000, response_detection_error_std_dev=.1, seed=1):
+_worker_data = None
+_worker_A = None
+_worker_A_blur = None
 
-    number_of_pixels = A.shape[0] // 2
+def events_to_pvalues_no_fdr_correction(data, event_vector, A, number_of_shuffles=5000, response_detection_error_std_dev=.1, seed=1):
 
     # Initializations:
     number_of_events = event_vector.sum()
-    np.random.seed(seed)
+    random_state = np.random.RandomState(seed)
 
-    shuffle_data = get_shuffle_matrix(data, event_vector, A, number_of_shuffles=number_of_shuffles, response_detection_error_std_dev=response_detection_error_std_dev)
+    shuffle_data = get_shuffle_matrix(data, event_vector, A, number_of_shuffles=number_of_shuffles,
+                                      response_detection_error_std_dev=response_detection_error_std_dev,
+                                      random_state=random_state)
 
     # Build list of p-values:
     response_triggered_stimulus_vector = A.dot(event_vector)/number_of_events
-    p_value_list = []
-    for pi in range(2*number_of_pixels):
-        curr_p_value = 1-(shuffle_data[pi, :] < response_triggered_stimulus_vector[pi]).sum()*1./number_of_shuffles
-        p_value_list.append(curr_p_value)
+    p_value_list = 1-(shuffle_data < response_triggered_stimulus_vector[:, np.newaxis]).sum(axis=1)*1./number_of_shuffles
 
-    return np.array(p_value_list)
+    return p_value_list
 
 def compute_receptive_field(data, cell_index, stimulus, **kwargs):
 
     alpha = kwargs.pop('alpha')
+    A = kwargs.pop('A', None)
+    A_blur = kwargs.pop('A_blur', None)
+    event_vector = kwargs.pop('event_vector', None)
+    stimulus_shape = kwargs.pop('stimulus_shape', None)
 
-    event_vector = detect_events(data, cell_index, stimulus)
+    if A is None:
+        A = get_A(data, stimulus)
+    if A_blur is None:
+        A_blur = get_A_blur(data, stimulus)
+
+    if event_vector is None:
+        event_vector = detect_events(data, cell_index, stimulus)
 
-    A_blur = get_A_blur(data, stimulus)
     number_of_pixels = A_blur.shape[0] // 2
 
     pvalues = events_to_pvalues_no_fdr_correction(data, event_vector, A_blur, **kwargs)
 
-
-    stimulus_table = data.get_stimulus_table(stimulus)
-    stimulus_template = data.get_stimulus_template(stimulus)[stimulus_table['frame'].values, :, :]
-    s1, s2 = stimulus_template.shape[1], stimulus_template.shape[2]
+    if stimulus_shape is None:
+        stimulus_shape = data.get_stimulus_template(stimulus).shape[1:]
+    s1, s2 = stimulus_shape
     pvalues_on, pvalues_off = pvalues[:number_of_pixels].reshape(s1, s2), pvalues[number_of_pixels:].reshape(s1, s2)
 
 
@@ -90,9 +104,6 @@ def compute_receptive_field(data, cell_index, stimulus, **kwargs):
     _fdr_mask_off[fdr_corrected_pvalues_off < alpha] = True
     components_off, number_of_components_off = get_components(_fdr_mask_off)
 
-    A = get_A(data, stimulus)
-    A_blur = get_A_blur(data, stimulus)
-
     response_triggered_stimulus_field = A.dot(event_vector)
     response_triggered_stimulus_field_on = response_triggered_stimulus_field[:number_of_pixels].reshape(s1, s2)
     response_triggered_stimulus_field_off = response_triggered_stimulus_field[number_of_pixels:].reshape(s1, s2)
@@ -127,6 +138,71 @@ def compute_receptive_field_with_postprocessing(data, cell_index, stimulus, **kw
 
     return rf
 
+def _init_receptive_field_worker(data, stimulus, A_file_name, A_blur_file_name):
+    global _worker_data, _worker_A, _worker_A_blur
+    _worker_data = data
+    _worker_A = np.asarray(np.load(A_file_name, mmap_mode='r'))
+    _worker_A_blur = np.asarray(np.load(A_blur_file_name, mmap_mode='r'))
+
+def _compute_receptive_field_worker(stimulus, kwargs, cell_events):
+    cell_index, event_vector = cell_events
+    return compute_receptive_field_with_postprocessing(_worker_data, cell_index, stimulus, A=_worker_A,
+                                                       A_blur=_worker_A_blur, event_vector=event_vector, **kwargs)
+
+def compute_receptive_fields_with_postprocessing(data, cell_indices, stimulus, n_jobs=1, **kwargs):
+    '''
+    Runs compute_receptive_field_with_postprocessing for several cells, optionally
+    fanning the cells out over a pool of n_jobs processes.  The stimulus design
+    matrices are computed once and handed to the workers as memory-mapped files,
+    and events are detected for all cells from a single read of the dF/F traces.
+    The stimulus template shape is also resolved once and handed to every task.
+    Every cell is computed with the same arguments (including the shuffle seed),
+    so the results do not depend on n_jobs.
+
+    :param cell_indices: iterable of cell indices
+    :param n_jobs: number of worker processes. None uses one per cpu.
+    :return: list of receptive field dictionaries, in the order of cell_indices
+    '''
+
+    cell_indices = list(cell_indices)
+    if len(cell_indices) == 0:
+        return []
+
+    A = get_A(data, stimulus)
+    A_blur = get_A_blur(data, stimulus)
+    events = detect_events_all_cells(data, stimulus, cell_indices=cell_indices)
+
+    # resolved once here rather than in every worker task
+    kwargs['stimulus_shape'] = data.get_stimulus_template(stimulus).shape[1:]
+
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    if n_jobs == 1 or len(cell_indices) <= 1:
+        return [compute_receptive_field_with_postprocessing(data, cell_index, stimulus, A=A, A_blur=A_blur,
+                                                            event_vector=event_vector, **kwargs)
+                for cell_index, event_vector in zip(cell_indices, events)]
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        A_file_name = os.path.join(temp_dir, 'A.npy')
+        A_blur_file_name = os.path.join(temp_dir, 'A_blur.npy')
+        np.save(A_file_name, A)
+        np.save(A_blur_file_name, A_blur)
+
+        pool = mp.Pool(min(n_jobs, len(cell_indices)), initializer=_init_receptive_field_worker,
+                       initargs=(data, stimulus, A_file_name, A_blur_file_name))
+        try:
+            rf_list = pool.map(partial(_compute_receptive_field_worker, stimulus, kwargs),
+                               list(zip(cell_indices, events)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(temp_dir)
+
+    return rf_list
+
 def get_attribute_dict(rf):
 
     attribute_dict = {}
@@ -36,6 +36,7 @@
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
 import scipy.interpolate as spinterp
+import scipy.sparse as sps
 from .tools import dict_generator
 from allensdk.api.cache import memoize
 import os
@@ -119,20 +120,47 @@ def get_A_blur(data, stimulus):
 
     return A
 
-def get_shuffle_matrix(data, event_vector, A, number_of_shuffles=5000, response_detection_error_std_dev=.1):
-
-    number_of_events = event_vector.sum()
-    number_of_pixels = A.shape[0] // 2
-    shuffle_data = np.zeros((2*number_of_pixels, number_of_shuffles))
-    evr = range(len(event_vector))
-    for ii in range(number_of_shuffles):
+def get_shuffle_matrix(data, event_vector, A, number_of_shuffles=5000, response_detection_error_std_dev=.1,
+                       random_state=None, block_size=1000):
+    '''
+    Stimulus-triggered averages for randomly chosen sets of frames.  Each shuffle
+    draws a jittered number of events without replacement; the shuffled event
+    masks of a block of shuffles form one sparse matrix, so that the averages of
+    the whole block are a single product with A.
+
+    :param random_state: np.random.RandomState used for the draws. Default is the global numpy random state.
+    :param block_size: number of shuffles computed per product
+    :return: (2*number_of_pixels, number_of_shuffles) np.ndarray
+    '''
 
-        size = number_of_events + int(np.round(response_detection_error_std_dev*number_of_events*np.random.randn()))
-        shuffled_event_inds = np.random.choice(evr, size=size, replace=False)
+    if random_state is None:
+        random_state = np.random
 
-        b_tmp = np.zeros(len(event_vector), dtype=np.bool)
-        b_tmp[shuffled_event_inds] = True
-        shuffle_data[:, ii] = A[:,b_tmp].sum(axis=1)/float(size)
+    number_of_events = event_vector.sum()
+    number_of_frames = len(event_vector)
+    shuffle_data = np.zeros((A.shape[0], number_of_shuffles))
+
+    for block_start in range(0, number_of_shuffles, block_size):
+        block = range(block_start, min(block_start + block_size, number_of_shuffles))
+
+        # same draws, in the same order, as np.random.choice(..., replace=False)
+        sizes = np.zeros(len(block), dtype=int)
+        indices = []
+        for ii in range(len(block)):
+            size = number_of_events + int(np.round(response_detection_error_std_dev*number_of_events*random_state.randn()))
+            if size > number_of_frames:
+                raise ValueError("Cannot take a larger sample than population when 'replace=False'")
+
+            sizes[ii] = size
+            indices.append(random_state.permutation(number_of_frames)[:size])
+
+        indptr = np.zeros(len(block) + 1, dtype=int)
+        np.cumsum(sizes, out=indptr[1:])
+        masks = sps.csr_matrix((np.ones(indptr[-1]), np.concatenate(indices), indptr),
+                               shape=(len(block), number_of_frames))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shuffle_data[:, block_start:block_start + len(block)] = masks.dot(A.T).T / sizes.astype(float)
 
     return shuffle_data
 
@@ -35,9 +35,12 @@
 #
 import numpy as np
 import math
-import scipy.ndimage.morphology as morphology
+import threading
+import scipy.ndimage.filters as filters
+import scipy.sparse as sps
 import logging
 import h5py
+from six.moves import queue
 
 # constants used for accessing border array
 RIGHT_SHIFT = 0
@@ -280,21 +283,65 @@ def create_neuropil_mask(roi, border, combined_binary_mask, label=None):
     -------
         NeuropilMask object
     '''
-    # combined_binary_mask is a bitmap union of ALL ROI masks
-    # create a binary mask of the ROI
-    binary_mask = np.zeros((roi.img_rows, roi.img_cols))
-    binary_mask[roi.y:roi.y + roi.height, roi.x:roi.x + roi.width] = roi.mask
-    binary_mask = binary_mask > 0
-    # dilate the mask
-    binary_mask_dilated = morphology.binary_dilation(
-        binary_mask, structure=np.ones((3, 3)), iterations=13)  # T/F
-    # eliminate ROIs from the dilation
-    binary_mask_dilated = binary_mask_dilated > combined_binary_mask
-    # create mask from binary dilation
-    m = NeuropilMask(w=roi.img_cols, h=roi.img_rows,
-                     label=label, mask_group=roi.mask_group)
-    m.init_by_mask(border, binary_mask_dilated)
-    return m
+    return create_neuropil_masks([roi], border, combined_binary_mask, [label])[0]
+
+
+def create_neuropil_masks(rois, border, combined_binary_mask, labels=None):
+    '''
+    Creates the neuropil mask of each ROI, as in create_neuropil_mask().
+    Each ROI is dilated only within its bounding box padded by the
+    dilation distance, rather than over the whole image.
+
+    Parameters
+    ----------
+
+    rois: list<RoiMask>
+        The ROIs that the neuropil masks will be based on
+
+    border: float[4]
+        Coordinates defining useable area of image. See create_roi_mask().
+
+    combined_binary_mask: integer[image_h][image_w]
+        Image-sized array that shows the position of all ROIs in the
+        image. See create_neuropil_mask().
+
+    labels: list<text>
+        User-defined text labels to identify the masks
+
+    Returns
+    -------
+        list<NeuropilMask>
+    '''
+    # 13 iterations of a 3x3 dilation reach every pixel within a
+    #   chessboard distance of 13 of the ROI
+    distance = 13
+
+    if labels is None:
+        labels = [None] * len(rois)
+
+    masks = []
+    for roi, label in zip(rois, labels):
+        # pad the ROI's bounding box by the dilation distance
+        top = max(roi.y - distance, 0)
+        left = max(roi.x - distance, 0)
+        bottom = min(roi.y + roi.height + distance, roi.img_rows)
+        right = min(roi.x + roi.width + distance, roi.img_cols)
+
+        binary_mask = np.zeros((bottom - top, right - left), dtype=bool)
+        binary_mask[roi.y - top:roi.y - top + roi.height,
+                    roi.x - left:roi.x - left + roi.width] = np.asarray(roi.mask) > 0
+        # dilate the mask
+        binary_mask_dilated = filters.maximum_filter(
+            binary_mask, size=2 * distance + 1, mode='constant', cval=0)
+        # eliminate ROIs from the dilation
+        binary_mask_dilated = binary_mask_dilated > combined_binary_mask[top:bottom, left:right]
+        # create mask from binary dilation
+        m = NeuropilMask(w=roi.img_cols, h=roi.img_rows,
+                         label=label, mask_group=roi.mask_group)
+        m.init_by_mask(border, binary_mask_dilated, offset=(top, left))
+        masks.append(m)
+
+    return masks
 
 
 class NeuropilMask(Mask):
@@ -314,7 +361,7 @@ class NeuropilMask(Mask):
         '''
         super(NeuropilMask, self).__init__(w, h, label, mask_group)
 
-    def init_by_mask(self, border, array):
+    def init_by_mask(self, border, array, offset=(0, 0)):
         '''
         Initialize mask using spatial mask
 
@@ -326,9 +373,13 @@ class NeuropilMask(Mask):
         array: integer[image height][image width]
             Image-sized array that describes the mask. Active parts of the
             mask should have values >0. Background pixels must be zero
+
+        offset: integer[2]
+            Row and column of the image at which array starts, if array
+            only covers part of the image. Pixels outside of array are zero.
         '''
         # find lowest and highest non-zero indices on each axis
-        px = np.argwhere(array)
+        px = np.argwhere(array) + offset
         (top, left), (bottom, right) = px.min(0), px.max(0)
 
         # left and right border insets
@@ -361,10 +412,95 @@ class NeuropilMask(Mask):
         self.y = top
         self.height = bottom - top + 1
         # make copy of mask
-        self.mask = array[top:bottom + 1, left:right + 1]
+        self.mask = np.zeros((self.height, self.width), dtype=array.dtype)
+        row, col = offset
+        rows = slice(max(top, row), min(bottom + 1, row + array.shape[0]))
+        cols = slice(max(left, col), min(right + 1, col + array.shape[1]))
+        if rows.start < rows.stop and cols.start < cols.stop:
+            self.mask[rows.start - top:rows.stop - top, cols.start - left:cols.stop - left] = \
+                array[rows.start - row:rows.stop - row, cols.start - col:cols.stop - col]
+
+
+def create_mask_weight_matrix(mask_list, image_h, image_w, valid_masks=None):
+    '''
+    Packs masks into a sparse matrix with one row per mask and one column
+    per image pixel (in row-major order). Mask pixels have a weight of one.
+
+    Parameters
+    ----------
+    mask_list: list<Mask>
+        List of masks
+
+    image_h: integer
+        Height of image that the masks reside in
+
+    image_w: integer
+        Width of image that the masks reside in
+
+    valid_masks: bool[number masks]
+        Masks to include. Rows of excluded masks are empty. By default
+        all masks are included.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix [number masks][image_h * image_w]
+    '''
+    rows = []
+    cols = []
+    for i, mask in enumerate(mask_list):
+        if valid_masks is not None and not valid_masks[i]:
+            continue
+
+        y, x = np.nonzero(mask.mask)
+        rows.append(np.full(len(y), i, dtype=int))
+        cols.append((y + mask.y) * image_w + x + mask.x)
+
+    if len(rows) > 0:
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+    else:
+        rows = cols = np.zeros(0, dtype=int)
+
+    return sps.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                          shape=(len(mask_list), image_h * image_w))
+
+
+def _read_frame_blocks(stack, block_size, read_ahead=False):
+    '''
+    Yields (first frame, frames) for consecutive blocks of an image
+    stack. If read_ahead is set, the next block is read in a background
+    thread while the current one is processed.
+    '''
+    starts = range(0, stack.shape[0], block_size)
+
+    if not read_ahead:
+        for frame_num in starts:
+            yield frame_num, stack[frame_num:frame_num + block_size]
+        return
+
+    blocks = queue.Queue(maxsize=1)
+
+    def read():
+        try:
+            for frame_num in starts:
+                blocks.put((frame_num, stack[frame_num:frame_num + block_size], None))
+        except Exception as e:
+            blocks.put((None, None, e))
 
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
 
-def calculate_traces(stack, mask_list, block_size=100):
+    for _ in starts:
+        frame_num, frames, error = blocks.get()
+        if error is not None:
+            raise error
+        yield frame_num, frames
+
+    reader.join()
+
+
+def calculate_traces(stack, mask_list, block_size=100, read_ahead=False):
     '''
     Calculates the average response of the specified masks in the
     image stack
@@ -377,6 +513,14 @@ def calculate_traces(stack, mask_list, block_size=100):
     mask_list: list<Mask>
         List of masks
 
+    block_size: integer
+        Number of frames to read at once. If the stack is a chunked
+        h5py dataset, this is rounded up to a whole number of chunks.
+
+    read_ahead: boolean
+        Read the next block of frames in a background thread while the
+        current block is processed.
+
     Returns
     -------
     float[number masks][number frames]
@@ -402,31 +546,32 @@ def calculate_traces(stack, mask_list, block_size=100):
             traces[i,:] = np.nan
             valid_masks[i] = False
 
-        # if the mask overlaps the motion border, the trace is nan
+        # masks that overlap the motion border are reported, but their
+        # traces are still calculated
         if mask.overlaps_motion_border:
             logging.warning("mask '%d/%s' overlaps with motion border", i, mask.label)
-            traces[i,:] = np.nan
-            valid_masks[i] = False
+
+    # all masks are applied to a block of frames with one sparse product
+    weights = create_mask_weight_matrix(mask_list, stack.shape[1], stack.shape[2], valid_masks)
+    weights = weights[valid_masks]
+    mask_areas = mask_areas[valid_masks].reshape(-1, 1)
+
+    # read whole chunks from the file
+    chunks = getattr(stack, "chunks", None)
+    if chunks:
+        block_size = int(math.ceil(float(block_size) / chunks[0])) * chunks[0]
 
     # calculate traces
-    for frame_num in range(0, num_frames, block_size):
+    for frame_num, frames in _read_frame_blocks(stack, block_size, read_ahead):
         if frame_num % 1000 == 0:
             logging.debug("frame " + str(frame_num) + " of " + str(num_frames))
-        frames = stack[frame_num:frame_num+block_size]
-
-        for i in range(len(mask_list)):
-            if valid_masks[i] is False:
-                continue
 
-            mask = mask_list[i]
-            subframe = frames[:,mask.y:mask.y + mask.height, 
-                                mask.x:mask.x + mask.width]
-
-            total = subframe[:, mask.mask].sum(axis=1)
-            traces[i, frame_num:frame_num+block_size] = total / mask_areas[i]
+        pixels = frames.reshape(frames.shape[0], -1).T
+        total = weights.dot(pixels)
+        traces[valid_masks, frame_num:frame_num+block_size] = total / mask_areas
     return traces
 
-def calculate_roi_and_neuropil_traces(movie_h5, roi_mask_list, motion_border):
+def calculate_roi_and_neuropil_traces(movie_h5, roi_mask_list, motion_border, read_ahead=False):
     """ get roi and neuropil masks """
 
     # a combined binary mask for all ROIs (this is used to 
@@ -437,10 +582,8 @@ def calculate_roi_and_neuropil_traces(movie_h5, roi_mask_list, motion_border):
     logging.info("%d total ROIs" % len(roi_mask_list))
 
     # create neuropil masks for the central ROIs
-    neuropil_masks = []
-    for m in roi_mask_list:
-        nmask = create_neuropil_mask(m, motion_border, combined_mask, "neuropil for " + m.label)
-        neuropil_masks.append(nmask)
+    neuropil_masks = create_neuropil_masks(roi_mask_list, motion_border, combined_mask,
+                                           ["neuropil for " + m.label for m in roi_mask_list])
 
     # calculate fluorescence traces for valid ROI and neuropil masks
     # create a combined list and calculate these together (this lets us
@@ -455,7 +598,7 @@ def calculate_roi_and_neuropil_traces(movie_h5, roi_mask_list, motion_border):
         stack_frames = movie_f["data"]
 
         logging.info("Calculating %d traces (neuropil + ROI) over %d frames" % (len(combined_list), len(stack_frames)))
-        traces = calculate_traces(stack_frames, combined_list)
+        traces = calculate_traces(stack_frames, combined_list, read_ahead=read_ahead)
 
         roi_traces = traces[:len(roi_mask_list)]
         neuropil_traces = traces[len(roi_mask_list):]
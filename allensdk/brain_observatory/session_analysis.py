@@ -42,13 +42,20 @@ from .natural_movie import NaturalMovie
 import six
 from allensdk.core.brain_observatory_nwb_data_set \
     import BrainObservatoryNwbDataSet
+from .checkpoint_store import CheckpointStore
 from . import stimulus_info
 from allensdk.brain_observatory.brain_observatory_exceptions \
     import BrainObservatoryAnalysisException
 from . import brain_observatory_plotting as cp
 import argparse
 import logging
+import multiprocessing as mp
 import os
+import time
+import traceback
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from allensdk.deprecated import deprecated
 
@@ -81,14 +88,32 @@ class SessionAnalysis(object):
     nwb_path: string, path to NWB file
 
     save_path: string, path to HDF5 file to store outputs.  Recommended NOT to modify the NWB file.
+
+    memmap: bool, share read-only trace arrays between the stimulus analyses (see BrainObservatoryNwbDataSet)
+
+    n_threads: int, number of stimulus analyses to compute concurrently.  They share the data set read-only.
+
+    checkpoint_path: string, path to an HDF5 file in which intermediate results are saved as soon as they are
+        computed (see CheckpointStore).  Results already in it are reused instead of being recomputed.
+
+    lsn_n_jobs: int, number of processes used to compute locally sparse noise receptive fields.  None uses
+        one per cpu.
     """
 
     _log = logging.getLogger('allensdk.brain_observatory.session_analysis')
 
-    def __init__(self, nwb_path, save_path):
-        self.nwb = BrainObservatoryNwbDataSet(nwb_path)
+    def __init__(self, nwb_path, save_path, memmap=False, n_threads=1, checkpoint_path=None, lsn_n_jobs=1):
+        self.nwb = BrainObservatoryNwbDataSet(nwb_path, memmap=memmap)
         self.save_path = save_path
         self.save_dir = os.path.dirname(save_path)
+        self.n_threads = n_threads
+        self.lsn_n_jobs = lsn_n_jobs
+        self.stage_timings = OrderedDict()
+
+        if checkpoint_path is None:
+            self.checkpoint_store = None
+        else:
+            self.checkpoint_store = CheckpointStore(checkpoint_path, nwb_path)
 
         self.metrics_a = dict(cell={},experiment={})
         self.metrics_b = dict(cell={},experiment={})
@@ -361,6 +386,36 @@ class SessionAnalysis(object):
         dxcm, dxtime = self.nwb.get_running_speed()
         metrics['mean_running_speed'] = np.nanmean(dxcm)
 
+    def run_stage(self, name, func):
+        """ Run one analysis stage, recording and logging how long it took. """
+
+        start = time.time()
+        result = func()
+        self.stage_timings[name] = time.time() - start
+        SessionAnalysis._log.info("%s finished in %.2f seconds", name, self.stage_timings[name])
+
+        return result
+
+    def run_stages(self, stages):
+        """ Run analysis stages that are independent of one another, using up to self.n_threads threads.
+
+        Parameters
+        ----------
+        stages: list
+            (name, callable) pairs.  The callables take no arguments.
+        """
+
+        if self.n_threads > 1 and len(stages) > 1:
+            pool = ThreadPool(min(self.n_threads, len(stages)))
+            try:
+                pool.map(lambda stage: self.run_stage(*stage), stages, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for name, func in stages:
+                self.run_stage(name, func)
+
     def verify_roi_lists_equal(self, roi1, roi2):
         """ TODO: replace this with simpler numpy comparisons """
 
@@ -373,6 +428,51 @@ class SessionAnalysis(object):
                 raise BrainObservatoryAnalysisException(
                     "Error -- ROI lists have different entries")
 
+    def run(self, plot_flag=False, save_flag=True):
+        """ Inspect the NWB file to determine which experiment session was run and
+        compute all stimulus-specific analyses.
+
+        Parameters
+        ----------
+        plot_flag: bool
+            Whether to save brain_observatory_plotting work plots.
+
+        save_flag: bool
+            Whether to save results to self.save_path.
+
+        Returns
+        -------
+        metrics: dictionary of cell and experiment metrics for the session
+        """
+
+        # read everything through one handle, unless results are written back into the input file
+        hold_open = os.path.abspath(self.save_path) != os.path.abspath(self.nwb.nwb_file)
+        if hold_open:
+            self.nwb.open()
+
+        try:
+            session = self.nwb.get_session_type()
+
+            if session == stimulus_info.THREE_SESSION_A:
+                self.session_a(plot_flag=plot_flag, save_flag=save_flag)
+                metrics = self.metrics_a
+            elif session == stimulus_info.THREE_SESSION_B:
+                self.session_b(plot_flag=plot_flag, save_flag=save_flag)
+                metrics = self.metrics_b
+            elif session == stimulus_info.THREE_SESSION_C:
+                self.session_c(plot_flag=plot_flag, save_flag=save_flag)
+                metrics = self.metrics_c
+            elif session == stimulus_info.THREE_SESSION_C2:
+                self.session_c2(plot_flag=plot_flag, save_flag=save_flag)
+                metrics = self.metrics_c
+            else:
+                raise IndexError("Unknown session: %s" % session)
+        finally:
+            if hold_open:
+                self.nwb.close()
+
+        return metrics
+
     def session_a(self, plot_flag=False, save_flag=True):
         """ Run stimulus-specific analysis for natural movie one, natural movie three, and drifting gratings.
         The input NWB be for a stimulus_info.THREE_SESSION_A experiment.
@@ -386,13 +486,20 @@ class SessionAnalysis(object):
             Whether to save the output of analysis to self.save_path upon completion.
         """
 
-        nm1 = NaturalMovie(self.nwb, 'natural_movie_one')
-        nm3 = NaturalMovie(self.nwb, 'natural_movie_three')
-        dg = DriftingGratings(self.nwb)
+        nm1 = NaturalMovie(self.nwb, 'natural_movie_one', checkpoint_store=self.checkpoint_store)
+        nm3 = NaturalMovie(self.nwb, 'natural_movie_three', checkpoint_store=self.checkpoint_store)
+        dg = DriftingGratings(self.nwb, checkpoint_store=self.checkpoint_store)
 
-        dg.noise_correlation, _, _, _ = dg.get_noise_correlation()
-        dg.signal_correlation, _ = dg.get_signal_correlation()
-        dg.representational_similarity, _ = dg.get_representational_similarity()
+        def drifting_gratings():
+            dg.peak
+            dg.noise_correlation, _, _, _ = dg.checkpoint('noise_correlation', dg.get_noise_correlation)
+            dg.signal_correlation, _ = dg.checkpoint('signal_correlation', dg.get_signal_correlation)
+            dg.representational_similarity, _ = dg.checkpoint('representational_similarity',
+                                                              dg.get_representational_similarity)
+
+        self.run_stages([(stimulus_info.DRIFTING_GRATINGS, drifting_gratings),
+                         (stimulus_info.NATURAL_MOVIE_ONE, lambda: (nm1.peak, nm1.peak_run)),
+                         (stimulus_info.NATURAL_MOVIE_THREE, lambda: nm3.peak)])
 
         SessionAnalysis._log.info("Session A analyzed")
         peak = multi_dataframe_merge(
@@ -407,11 +514,11 @@ class SessionAnalysis(object):
         self.append_metadata(peak)
 
         if save_flag:
-            self.save_session_a(dg, nm1, nm3, peak)
+            self.run_stage('save', lambda: self.save_session_a(dg, nm1, nm3, peak))
 
         if plot_flag:
-            cp._plot_3sa(dg, nm1, nm3, self.save_dir)
-            cp.plot_drifting_grating_traces(dg, self.save_dir)
+            self.run_stage('plot', lambda: (cp._plot_3sa(dg, nm1, nm3, self.save_dir),
+                                            cp.plot_drifting_grating_traces(dg, self.save_dir)))
 
     def session_b(self, plot_flag=False, save_flag=True):
         """ Run stimulus-specific analysis for natural scenes, static gratings, and natural movie one.
@@ -426,9 +533,28 @@ class SessionAnalysis(object):
             Whether to save the output of analysis to self.save_path upon completion.
         """
 
-        ns = NaturalScenes(self.nwb)
-        sg = StaticGratings(self.nwb)
-        nm1 = NaturalMovie(self.nwb, 'natural_movie_one')
+        ns = NaturalScenes(self.nwb, checkpoint_store=self.checkpoint_store)
+        sg = StaticGratings(self.nwb, checkpoint_store=self.checkpoint_store)
+        nm1 = NaturalMovie(self.nwb, 'natural_movie_one', checkpoint_store=self.checkpoint_store)
+
+        def static_gratings():
+            sg.peak
+            sg.noise_correlation, _, _, _ = sg.checkpoint('noise_correlation', sg.get_noise_correlation)
+            sg.signal_correlation, _ = sg.checkpoint('signal_correlation', sg.get_signal_correlation)
+            sg.representational_similarity, _ = sg.checkpoint('representational_similarity',
+                                                              sg.get_representational_similarity)
+
+        def natural_scenes():
+            ns.peak
+            ns.noise_correlation, _ = ns.checkpoint('noise_correlation', ns.get_noise_correlation)
+            ns.signal_correlation, _ = ns.checkpoint('signal_correlation', ns.get_signal_correlation)
+            ns.representational_similarity, _ = ns.checkpoint('representational_similarity',
+                                                              ns.get_representational_similarity)
+
+        self.run_stages([(stimulus_info.STATIC_GRATINGS, static_gratings),
+                         (stimulus_info.NATURAL_SCENES, natural_scenes),
+                         (stimulus_info.NATURAL_MOVIE_ONE, lambda: (nm1.peak, nm1.peak_run))])
+
         SessionAnalysis._log.info("Session B analyzed")
         peak = multi_dataframe_merge(
             [nm1.peak_run, sg.peak, ns.peak, nm1.peak])
@@ -441,21 +567,13 @@ class SessionAnalysis(object):
         self.verify_roi_lists_equal(sg.roi_id, ns.roi_id)
         self.metrics_b['cell']['roi_id'] = sg.roi_id
 
-        sg.noise_correlation, _, _, _ = sg.get_noise_correlation()
-        sg.signal_correlation, _ = sg.get_signal_correlation()
-        sg.representational_similarity, _ = sg.get_representational_similarity()
-
-        ns.noise_correlation, _ = ns.get_noise_correlation()
-        ns.signal_correlation, _ = ns.get_signal_correlation()
-        ns.representational_similarity, _ = ns.get_representational_similarity()
-
         if save_flag:
-            self.save_session_b(sg, nm1, ns, peak)
+            self.run_stage('save', lambda: self.save_session_b(sg, nm1, ns, peak))
 
         if plot_flag:
-            cp._plot_3sb(sg, nm1, ns, self.save_dir)
-            cp.plot_ns_traces(ns, self.save_dir)
-            cp.plot_sg_traces(sg, self.save_dir)
+            self.run_stage('plot', lambda: (cp._plot_3sb(sg, nm1, ns, self.save_dir),
+                                            cp.plot_ns_traces(ns, self.save_dir),
+                                            cp.plot_sg_traces(sg, self.save_dir)))
 
     def session_c(self, plot_flag=False, save_flag=True):
         """ Run stimulus-specific analysis for natural movie one, natural movie two, and locally sparse noise.
@@ -470,9 +588,15 @@ class SessionAnalysis(object):
             Whether to save the output of analysis to self.save_path upon completion.
         """
 
-        lsn = LocallySparseNoise(self.nwb, stimulus_info.LOCALLY_SPARSE_NOISE)
-        nm2 = NaturalMovie(self.nwb, 'natural_movie_two')
-        nm1 = NaturalMovie(self.nwb, 'natural_movie_one')
+        lsn = LocallySparseNoise(self.nwb, stimulus_info.LOCALLY_SPARSE_NOISE, n_jobs=self.lsn_n_jobs,
+                                 checkpoint_store=self.checkpoint_store)
+        nm2 = NaturalMovie(self.nwb, 'natural_movie_two', checkpoint_store=self.checkpoint_store)
+        nm1 = NaturalMovie(self.nwb, 'natural_movie_one', checkpoint_store=self.checkpoint_store)
+
+        self.run_stages([(stimulus_info.LOCALLY_SPARSE_NOISE, lambda: lsn.peak),
+                         (stimulus_info.NATURAL_MOVIE_ONE, lambda: (nm1.peak, nm1.peak_run)),
+                         (stimulus_info.NATURAL_MOVIE_TWO, lambda: nm2.peak)])
+
         SessionAnalysis._log.info("Session C analyzed")
         peak = multi_dataframe_merge([nm1.peak_run, nm1.peak, nm2.peak, lsn.peak])
         self.append_metadata(peak)
@@ -484,11 +608,11 @@ class SessionAnalysis(object):
         self.metrics_c['cell']['roi_id'] = nm1.roi_id
 
         if save_flag:
-            self.save_session_c(lsn, nm1, nm2, peak)
+            self.run_stage('save', lambda: self.save_session_c(lsn, nm1, nm2, peak))
 
         if plot_flag:
-            cp._plot_3sc(lsn, nm1, nm2, self.save_dir)
-            cp.plot_lsn_traces(lsn, self.save_dir)
+            self.run_stage('plot', lambda: (cp._plot_3sc(lsn, nm1, nm2, self.save_dir),
+                                            cp.plot_lsn_traces(lsn, self.save_dir)))
 
     def session_c2(self, plot_flag=False, save_flag=True):
         """ Run stimulus-specific analysis for locally sparse noise (4 deg.), locally sparse noise (8 deg.),
@@ -503,11 +627,19 @@ class SessionAnalysis(object):
             Whether to save the output of analysis to self.save_path upon completion.
         """
 
-        lsn4 = LocallySparseNoise(self.nwb, stimulus_info.LOCALLY_SPARSE_NOISE_4DEG)
-        lsn8 = LocallySparseNoise(self.nwb, stimulus_info.LOCALLY_SPARSE_NOISE_8DEG)
+        lsn4 = LocallySparseNoise(self.nwb, stimulus_info.LOCALLY_SPARSE_NOISE_4DEG, n_jobs=self.lsn_n_jobs,
+                                  checkpoint_store=self.checkpoint_store)
+        lsn8 = LocallySparseNoise(self.nwb, stimulus_info.LOCALLY_SPARSE_NOISE_8DEG, n_jobs=self.lsn_n_jobs,
+                                  checkpoint_store=self.checkpoint_store)
+
+        nm2 = NaturalMovie(self.nwb, 'natural_movie_two', checkpoint_store=self.checkpoint_store)
+        nm1 = NaturalMovie(self.nwb, 'natural_movie_one', checkpoint_store=self.checkpoint_store)
+
+        self.run_stages([(stimulus_info.LOCALLY_SPARSE_NOISE_4DEG, lambda: lsn4.peak),
+                         (stimulus_info.LOCALLY_SPARSE_NOISE_8DEG, lambda: lsn8.peak),
+                         (stimulus_info.NATURAL_MOVIE_ONE, lambda: (nm1.peak, nm1.peak_run)),
+                         (stimulus_info.NATURAL_MOVIE_TWO, lambda: nm2.peak)])
 
-        nm2 = NaturalMovie(self.nwb, 'natural_movie_two')
-        nm1 = NaturalMovie(self.nwb, 'natural_movie_one')
         SessionAnalysis._log.info("Session C2 analyzed")
 
         if self.nwb.get_metadata()['targeted_structure'] == 'VISp':
@@ -525,16 +657,24 @@ class SessionAnalysis(object):
         self.metrics_c['cell']['roi_id'] = nm1.roi_id
 
         if save_flag:
-            self.save_session_c2(lsn4, lsn8, nm1, nm2, peak)
+            self.run_stage('save', lambda: self.save_session_c2(lsn4, lsn8, nm1, nm2, peak))
 
         if plot_flag:
-            cp._plot_3sc(lsn4, nm1, nm2, self.save_dir, '_4deg')
-            cp._plot_3sc(lsn8, nm1, nm2, self.save_dir, '_8deg')
-            cp.plot_lsn_traces(lsn4, self.save_dir, '_4deg')
-            cp.plot_lsn_traces(lsn4, self.save_dir, '_8deg')
+            self.run_stage('plot', lambda: (cp._plot_3sc(lsn4, nm1, nm2, self.save_dir, '_4deg'),
+                                            cp._plot_3sc(lsn8, nm1, nm2, self.save_dir, '_8deg'),
+                                            cp.plot_lsn_traces(lsn4, self.save_dir, '_4deg'),
+                                            cp.plot_lsn_traces(lsn4, self.save_dir, '_8deg')))
+
+
+def _make_save_dir(save_path):
+    save_dir = os.path.abspath(os.path.dirname(save_path))
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
 
 
-def run_session_analysis(nwb_path, save_path, plot_flag=False, save_flag=True):
+def run_session_analysis(nwb_path, save_path, plot_flag=False, save_flag=True, memmap=False, n_threads=1,
+                         checkpoint_path=None, lsn_n_jobs=1):
     """ Inspect an NWB file to determine which experiment session was run
     and compute all stimulus-specific analyses.
 
@@ -551,33 +691,215 @@ def run_session_analysis(nwb_path, save_path, plot_flag=False, save_flag=True):
 
     save_flag: bool
         Whether to save results to save_path.
+
+    memmap: bool
+        Whether the stimulus analyses share read-only, memory-mapped trace arrays.
+
+    n_threads: int
+        Number of stimulus analyses to compute concurrently.
+
+    checkpoint_path: string
+        HDF5 file for saving intermediate results as they are computed.  A rerun
+        with the same file skips whatever is already in it.
+
+    lsn_n_jobs: int
+        Number of processes used to compute locally sparse noise receptive
+        fields.  None uses one per cpu.
     """
 
-    save_dir = os.path.abspath(os.path.dirname(save_path))
+    _make_save_dir(save_path)
+
+    session_analysis = SessionAnalysis(nwb_path, save_path, memmap=memmap, n_threads=n_threads,
+                                       checkpoint_path=checkpoint_path, lsn_n_jobs=lsn_n_jobs)
+
+    return session_analysis.run(plot_flag=plot_flag, save_flag=save_flag)
+
+
+def _run_session_analysis_worker(kwargs, paths):
+    nwb_path, save_path, checkpoint_path = paths
+
+    result = { 'nwb_path': nwb_path,
+               'save_path': save_path,
+               'metrics': None,
+               'error': None,
+               'stage_timings': OrderedDict() }
+
+    start = time.time()
+    try:
+        _make_save_dir(save_path)
+
+        session_analysis = SessionAnalysis(nwb_path, save_path,
+                                           memmap=kwargs.get('memmap', False),
+                                           n_threads=kwargs.get('n_threads', 1),
+                                           checkpoint_path=checkpoint_path,
+                                           lsn_n_jobs=kwargs.get('lsn_n_jobs', 1))
+        result['stage_timings'] = session_analysis.stage_timings
+        result['metrics'] = session_analysis.run(plot_flag=kwargs.get('plot_flag', False),
+                                                 save_flag=kwargs.get('save_flag', True))
+    except Exception:
+        result['error'] = traceback.format_exc()
+        SessionAnalysis._log.error("analysis of %s failed:\n%s", nwb_path, result['error'])
+
+    result['elapsed'] = time.time() - start
+    SessionAnalysis._log.info("%s finished in %.2f seconds", nwb_path, result['elapsed'])
+
+    return result
+
+
+def _run_session_analysis_process(worker, index, paths, result_queue):
+    result_queue.put((index, worker(paths)))
+
+
+def _failed_session_result(paths, error, elapsed):
+    nwb_path, save_path, _ = paths
+    SessionAnalysis._log.error("analysis of %s failed: %s", nwb_path, error)
+
+    return { 'nwb_path': nwb_path,
+             'save_path': save_path,
+             'metrics': None,
+             'error': error,
+             'stage_timings': OrderedDict(),
+             'elapsed': elapsed }
+
+
+def _run_session_processes(worker, paths, n_jobs, session_timeout=None, poll_interval=1.0):
+    """ Runs worker(paths[i]) for every i, each in a fresh process, up to n_jobs at
+    a time.  A process that dies without returning a result (e.g. killed for running
+    out of memory, or a segfault) or that runs longer than session_timeout seconds
+    is recorded as a failed session instead of stalling the batch. """
+
+    results = [ None ] * len(paths)
+    pending = list(range(len(paths)))
+    running = {}
+    result_queue = mp.Queue()
+
+    try:
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                index = pending.pop(0)
+                process = mp.Process(target=_run_session_analysis_process,
+                                     args=(worker, index, paths[index], result_queue))
+                process.start()
+                running[index] = (process, time.time())
+
+            try:
+                index, result = result_queue.get(timeout=poll_interval)
+                results[index] = result
+                if index in running:
+                    running.pop(index)[0].join()
+                continue
+            except six.moves.queue.Empty:
+                pass
+
+            for index, (process, start) in list(running.items()):
+                elapsed = time.time() - start
+
+                # a process that exited cleanly has already queued its result
+                if not process.is_alive() and process.exitcode != 0:
+                    results[index] = _failed_session_result(
+                        paths[index], "worker process exited with code %s" % process.exitcode, elapsed)
+                    del running[index]
+                elif session_timeout is not None and elapsed > session_timeout:
+                    process.terminate()
+                    process.join()
+                    results[index] = _failed_session_result(
+                        paths[index], "timed out after %.0f seconds" % elapsed, elapsed)
+                    del running[index]
+    finally:
+        for process, _ in running.values():
+            process.terminate()
+            process.join()
+
+    return results
+
+
+def run_session_analyses(nwb_paths, save_paths, n_jobs=1, plot_flag=False, save_flag=True,
+                         memmap=False, n_threads=1, checkpoint_paths=None, session_timeout=None, lsn_n_jobs=1):
+    """ Run run_session_analysis on many NWB files, one session per worker process.
+    A session that fails is logged and reported in its result; the rest of the batch
+    still runs.  This includes sessions whose worker process is killed or crashes.
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    Parameters
+    ----------
+    nwb_paths: list of strings
+        Paths to NWB files.  See get_session_nwb_paths for selecting these with a
+        BrainObservatoryCache.
+
+    save_paths: list of strings
+        Where to save the results for each NWB file.
+
+    n_jobs: int
+        Number of sessions to analyze at once.  None uses one per cpu.
+
+    plot_flag, save_flag, memmap, n_threads, lsn_n_jobs:
+        Passed to run_session_analysis for every session.  Session workers are
+        ordinary (non-daemonic) processes, so they can start their own receptive
+        field pools; up to n_jobs * lsn_n_jobs processes then run at once.
+
+    checkpoint_paths: list of strings (optional)
+        Checkpoint file for each NWB file (see run_session_analysis).  Rerunning
+        a batch with the same checkpoint files resumes failed or interrupted
+        sessions where they stopped.
+
+    session_timeout: float (optional)
+        When running in worker processes (n_jobs > 1), sessions taking longer
+        than this many seconds are stopped and reported as failed.
+
+    Returns
+    -------
+    list of dictionaries, one per session in the order of nwb_paths, with keys
+    'nwb_path', 'save_path', 'metrics' (None on failure), 'error' (the traceback
+    on failure, otherwise None), 'stage_timings' and 'elapsed' (seconds).
+    """
+
+    nwb_paths = list(nwb_paths)
+    save_paths = list(save_paths)
+
+    if len(nwb_paths) != len(save_paths):
+        raise ValueError("got %d NWB files but %d save paths" % (len(nwb_paths), len(save_paths)))
 
-    session_analysis = SessionAnalysis(nwb_path, save_path)
-
-    session = session_analysis.nwb.get_session_type()
-
-    if session == stimulus_info.THREE_SESSION_A:
-        session_analysis.session_a(plot_flag=plot_flag, save_flag=save_flag)
-        metrics = session_analysis.metrics_a
-    elif session == stimulus_info.THREE_SESSION_B:
-        session_analysis.session_b(plot_flag=plot_flag, save_flag=save_flag)
-        metrics = session_analysis.metrics_b
-    elif session == stimulus_info.THREE_SESSION_C:
-        session_analysis.session_c(plot_flag=plot_flag, save_flag=save_flag)
-        metrics = session_analysis.metrics_c
-    elif session == stimulus_info.THREE_SESSION_C2:
-        session_analysis.session_c2(plot_flag=plot_flag, save_flag=save_flag)
-        metrics = session_analysis.metrics_c
+    if checkpoint_paths is None:
+        checkpoint_paths = [ None ] * len(nwb_paths)
     else:
-        raise IndexError("Unknown session: %s" % session)
+        checkpoint_paths = list(checkpoint_paths)
+        if len(checkpoint_paths) != len(nwb_paths):
+            raise ValueError("got %d NWB files but %d checkpoint paths" % (len(nwb_paths), len(checkpoint_paths)))
+
+    kwargs = { 'plot_flag': plot_flag,
+               'save_flag': save_flag,
+               'memmap': memmap,
+               'n_threads': n_threads,
+               'lsn_n_jobs': lsn_n_jobs }
+    worker = partial(_run_session_analysis_worker, kwargs)
+    paths = list(zip(nwb_paths, save_paths, checkpoint_paths))
+
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    if n_jobs == 1 or len(paths) <= 1:
+        return [ worker(p) for p in paths ]
+
+    # a fresh process per session returns its memory to the system
+    return _run_session_processes(worker, paths, min(n_jobs, len(paths)), session_timeout=session_timeout)
+
+
+def get_session_nwb_paths(boc, ophys_experiment_ids):
+    """ Download (if necessary) the NWB files for a list of ophys experiments and return their paths.
+
+    Parameters
+    ----------
+    boc: BrainObservatoryCache
+
+    ophys_experiment_ids: list of ints
+        For example, [ e['id'] for e in boc.get_ophys_experiments(...) ]
+
+    Returns
+    -------
+    list of strings
+    """
 
-    return metrics
+    return [ boc.get_ophys_experiment_data(ophys_experiment_id).nwb_file
+             for ophys_experiment_id in ophys_experiment_ids ]
 
 
 @deprecated('use the standalone version in bin/brain_observatory')
@@ -36,9 +36,9 @@
 import scipy.stats as st
 import numpy as np
 import pandas as pd
-from math import sqrt
 import logging
 from .stimulus_analysis import StimulusAnalysis
+from .correlation import correlation_matrix
 from .brain_observatory_exceptions import BrainObservatoryAnalysisException, MissingStimulusException
 from . import observatory_plots as oplots
 from . import circle_plots as cplots
@@ -158,32 +158,21 @@ class StaticGratings(StimulusAnalysis):
         '''
         StaticGratings._log.info("Calculating mean responses")
 
-        response = np.empty((self.number_ori, self.number_sf,
-                             self.number_phase, self.numbercells + 1, 3))
+        codes = self.get_condition_codes(self.stim_table,
+                                         [('orientation', self.orivals),
+                                          ('spatial_frequency', self.sfvals),
+                                          ('phase', self.phasevals)])
+        membership = self.get_condition_membership(
+            codes, self.number_ori * self.number_sf * self.number_phase)
 
-        def ptest(x):
-            return len(np.where(x < (0.05 / (self.number_ori * (self.number_sf - 1))))[0])
+        # bonferroni correction over the non-blank conditions, if there are any
+        number_comparisons = self.number_ori * (self.number_sf - 1)
+        p_threshold = 0.05 / number_comparisons if number_comparisons else np.nan
 
-        for ori in self.orivals:
-            ori_pt = np.where(self.orivals == ori)[0][0]
+        response = self.get_condition_response(membership, p_threshold)
 
-            for sf in self.sfvals:
-                sf_pt = np.where(self.sfvals == sf)[0][0]
-
-                for phase in self.phasevals:
-                    phase_pt = np.where(self.phasevals == phase)[0][0]
-                    subset_response = self.mean_sweep_response[(self.stim_table.spatial_frequency == sf) & (
-                        self.stim_table.orientation == ori) & (self.stim_table.phase == phase)]
-                    subset_pval = self.pval[(self.stim_table.spatial_frequency == sf) & (
-                        self.stim_table.orientation == ori) & (self.stim_table.phase == phase)]
-                    response[ori_pt, sf_pt, phase_pt, :,
-                             0] = subset_response.mean(axis=0)
-                    response[ori_pt, sf_pt, phase_pt, :, 1] = subset_response.std(
-                        axis=0) / sqrt(len(subset_response))
-                    response[ori_pt, sf_pt, phase_pt, :,
-                             2] = subset_pval.apply(ptest, axis=0)
-
-        return response
+        return response.reshape(self.number_ori, self.number_sf, self.number_phase,
+                                self.numbercells + 1, 3)
 
     def get_peak(self):
         ''' Computes metrics related to each cell's peak response condition.
@@ -203,103 +192,96 @@ class StaticGratings(StimulusAnalysis):
         '''
         StaticGratings._log.info('Calculating peak response properties')
 
-        peak = pd.DataFrame(index=range(self.numbercells), columns=('ori_sg', 'sf_sg', 'phase_sg', 'reliability_sg',
-                                                                    'osi_sg', 'peak_dff_sg', 'ptest_sg', 'time_to_peak_sg', 
-                                                                    'cell_specimen_id','p_run_sg', 'cv_os_sg',
-                                                                    'run_modulation_sg', 'sf_index_sg'))
+        numbercells = self.numbercells
+        cells = np.arange(numbercells)
         cids = self.data_set.get_cell_specimen_ids()
 
+        peak = pd.DataFrame(index=range(numbercells), columns=('ori_sg', 'sf_sg', 'phase_sg', 'reliability_sg',
+                                                               'osi_sg', 'peak_dff_sg', 'ptest_sg', 'time_to_peak_sg',
+                                                               'cell_specimen_id','p_run_sg', 'cv_os_sg',
+                                                               'run_modulation_sg', 'sf_index_sg'))
+        if numbercells == 0:
+            return peak
+
+        number_ori = self.number_ori
+        number_sf = self.number_sf
+        number_phase = self.number_phase
+        response = self.response[:, :, :, :numbercells, 0]
+
+        # first occurrence of the peak over the non-blank conditions, in (ori, sf, phase) order
+        driven = response[:, 1:, :, :].reshape(number_ori * (number_sf - 1) * number_phase, numbercells)
+        pref_ori, pref_sf, pref_phase = np.unravel_index(np.nanargmax(driven, axis=0),
+                                                         (number_ori, number_sf - 1, number_phase))
+        pref_sf = pref_sf + 1
+
+        pref = response[pref_ori, pref_sf, pref_phase, cells]
+        orth = response[np.mod(pref_ori + 3, 6), pref_sf, pref_phase, cells]
+
+        # circular variance
         orivals_rad = np.deg2rad(self.orivals)
-        for nc in range(self.numbercells):
-            cell_peak = np.where(self.response[:, 1:, :, nc, 0] == np.nanmax(
-                self.response[:, 1:, :, nc, 0]))
-            pref_ori = cell_peak[0][0]
-            pref_sf = cell_peak[1][0] + 1
-            pref_phase = cell_peak[2][0]
-            peak.cell_specimen_id.iloc[nc] = cids[nc]
-            peak.ori_sg[nc] = pref_ori
-            peak.sf_sg[nc] = pref_sf
-            peak.phase_sg[nc] = pref_phase
-
-#            peak.response_reliability_sg[nc] = self.response[
-#                pref_ori, pref_sf, pref_phase, nc, 2] / 0.48  # TODO: check number of trials
-
-            pref = self.response[pref_ori, pref_sf, pref_phase, nc, 0]
-            orth = self.response[
-                np.mod(pref_ori + 3, 6), pref_sf, pref_phase, nc, 0]
-            tuning = self.response[:, pref_sf, pref_phase, nc, 0]
-            tuning = np.where(tuning>0, tuning, 0)
-            CV_top_os = np.empty((6), dtype=np.complex128)
-            for i in range(6):
-                CV_top_os[i] = (tuning[i]*np.exp(1j*2*orivals_rad[i]))
-            peak.cv_os_sg.iloc[nc] = np.abs(CV_top_os.sum())/tuning.sum()
-                
-            peak.osi_sg[nc] = (pref - orth) / (pref + orth)
-            peak.peak_dff_sg[nc] = pref
-            groups = []
-
-            for ori in self.orivals:
-                for sf in self.sfvals[1:]:
-                    for phase in self.phasevals:
-                        groups.append(self.mean_sweep_response[(self.stim_table.spatial_frequency == sf) & (
-                            self.stim_table.orientation == ori) & (self.stim_table.phase == phase)][str(nc)])
-            groups.append(self.mean_sweep_response[
-                          self.stim_table.spatial_frequency == 0][str(nc)])
-
-            _, p = st.f_oneway(*groups)
-            peak.ptest_sg[nc] = p
-
-            test_rows = (self.stim_table.orientation == self.orivals[pref_ori]) & \
-                (self.stim_table.spatial_frequency == self.sfvals[pref_sf]) & \
-                (self.stim_table.phase == self.phasevals[pref_phase])
-
-            if len(test_rows) < 2:
-                msg = "Static grating p value requires at least 2 trials at the preferred "
+        tuning = response[:6, pref_sf, pref_phase, cells]
+        tuning = np.where(tuning > 0, tuning, 0)
+        cv_top_os = (tuning * np.exp(1j * 2 * orivals_rad[:6, np.newaxis])).sum(axis=0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            peak['cv_os_sg'] = np.abs(cv_top_os) / tuning.sum(axis=0)
+            peak['osi_sg'] = (pref - orth) / (pref + orth)
+
+        peak['ori_sg'] = pref_ori
+        peak['sf_sg'] = pref_sf
+        peak['phase_sg'] = pref_phase
+        peak['peak_dff_sg'] = pref
+        peak['cell_specimen_id'] = np.asarray(cids)[:numbercells]
+
+        codes = self.get_condition_codes(self.stim_table,
+                                         [('orientation', self.orivals),
+                                          ('spatial_frequency', self.sfvals),
+                                          ('phase', self.phasevals)])
+        membership = self.get_condition_membership(codes, number_ori * number_sf * number_phase)
+        values = self.mean_sweep_response.values[:, :numbercells].astype(float)
+
+        # anova groups: one per non-blank condition and one for all blank sweeps
+        ori_index, sf_index, phase_index = np.unravel_index(np.maximum(codes, 0),
+                                                            (number_ori, number_sf, number_phase))
+        groups = np.where(sf_index == 0, number_ori * (number_sf - 1) * number_phase,
+                          (ori_index * (number_sf - 1) + sf_index - 1) * number_phase + phase_index)
+        groups[codes < 0] = -1
+        peak['ptest_sg'] = self.get_one_way_anova(
+            self.get_condition_membership(groups, number_ori * (number_sf - 1) * number_phase + 1), values)
+
+        preferred = (pref_ori * number_sf + pref_sf) * number_phase + pref_phase
+        n_trials = np.asarray(membership.sum(axis=1)).reshape(-1)[preferred]
+        if np.any(n_trials < 2):
+            nc = np.where(n_trials < 2)[0][0]
+            msg = "Static grating p value requires at least 2 trials at the preferred " \
                 "orientation/spatial frequency/phase. Cell %d (%f, %f, %f) has %d." % \
-                    (int(nc), self.orivals[pref_ori], self.sfvals[pref_sf],
-                     self.phasevals[pref_phase], len(test_rows))
-
-                raise BrainObservatoryAnalysisException(msg)
-
-            test = self.sweep_response[test_rows][str(nc)].mean()
-            peak.time_to_peak_sg[nc] = (
-                np.argmax(test) - self.interlength) / self.acquisition_rate
-
-            #running modulation
-            subset = self.mean_sweep_response[(self.stim_table.spatial_frequency==self.sfvals[pref_sf])&(self.stim_table.orientation==self.orivals[pref_ori])&(self.stim_table.phase==self.phasevals[pref_phase])]            
-            subset_run = subset[subset.dx>=1]
-            subset_stat = subset[subset.dx<1]
-            if (len(subset_run)>4) & (len(subset_stat)>4):
-                (_,peak.p_run_sg.iloc[nc]) = st.ttest_ind(subset_run[str(nc)], subset_stat[str(nc)], equal_var=False)
-                
-                if subset_run[str(nc)].mean()>subset_stat[str(nc)].mean():
-                    peak.run_modulation_sg.iloc[nc] = (subset_run[str(nc)].mean() - subset_stat[str(nc)].mean())/np.abs(subset_run[str(nc)].mean())
-                elif subset_run[str(nc)].mean()<subset_stat[str(nc)].mean():
-                    peak.run_modulation_sg.iloc[nc] = -1*((subset_stat[str(nc)].mean() - subset_run[str(nc)].mean())/np.abs(subset_stat[str(nc)].mean()))
-            else:
-                peak.p_run_sg.iloc[nc] = np.NaN
-                peak.run_modulation_sg.iloc[nc] = np.NaN                
-            
-            #reliability
-            subset = self.sweep_response[(self.stim_table.spatial_frequency==self.sfvals[pref_sf])&(self.stim_table.orientation==self.orivals[pref_ori])&(self.stim_table.phase==self.phasevals[pref_phase])]         
-            corr_matrix = np.empty((len(subset),len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    r,p = st.pearsonr(subset[str(nc)].iloc[i][28:42], subset[str(nc)].iloc[j][28:42])
-                    corr_matrix[i,j] = r
-            mask = np.ones((len(subset), len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    if i>=j:
-                        mask[i,j] = np.NaN
-            corr_matrix *= mask
-            peak.reliability_sg.iloc[nc] = np.nanmean(corr_matrix)
-
-            #SF index
-            sf_tuning = self.response[pref_ori,1:,pref_phase,nc,0]
-            trials = self.mean_sweep_response[(self.stim_table.spatial_frequency!=0)&(self.stim_table.orientation==self.orivals[pref_ori])&(self.stim_table.phase==self.phasevals[pref_phase])][str(nc)].values
-            SSE_part = np.sqrt(np.sum((trials-trials.mean())**2)/(len(trials)-5))
-            peak.sf_index_sg.iloc[nc] = (np.ptp(sf_tuning))/(np.ptp(sf_tuning) + 2*SSE_part)
+                (int(nc), self.orivals[pref_ori[nc]], self.sfvals[pref_sf[nc]],
+                 self.phasevals[pref_phase[nc]], n_trials[nc])
+
+            raise BrainObservatoryAnalysisException(msg)
+
+        traces = self.sweep_response_tensor[:, :numbercells, :]
+        mean_traces = self.get_preferred_mean_trace(traces, membership, preferred)
+        peak['time_to_peak_sg'] = (np.argmax(mean_traces, axis=1) - self.interlength) / self.acquisition_rate
+
+        # running modulation
+        dx = self.mean_sweep_response['dx'].values.astype(float)
+        peak['p_run_sg'], peak['run_modulation_sg'] = self.get_running_modulation(
+            membership, values, dx, preferred, min_trials=4)
+
+        # reliability
+        peak['reliability_sg'] = self.get_reliability(traces[:, :, 28:42], membership, preferred)
+
+        # SF index
+        sf_tuning = response[pref_ori, 1:, pref_phase, cells]
+        ori_phase = np.where((sf_index == 0) | (codes < 0), -1, ori_index * number_phase + phase_index)
+        ori_phase_membership = self.get_condition_membership(ori_phase, number_ori * number_phase)
+        trials_mean, n_trials = self.get_grouped_mean(ori_phase_membership, values)
+        deviation = values - ori_phase_membership.T.dot(trials_mean)
+        sum_squares = np.asarray(ori_phase_membership.dot(deviation ** 2))
+        pref_ori_phase = pref_ori * number_phase + pref_phase
+        sse_part = np.sqrt(sum_squares[pref_ori_phase, cells] / (n_trials[pref_ori_phase, cells] - 5))
+        peak['sf_index_sg'] = np.ptp(sf_tuning, axis=1) / (np.ptp(sf_tuning, axis=1) + 2 * sse_part)
 
         return peak
 
@@ -461,104 +443,50 @@ class StaticGratings(StimulusAnalysis):
         return response_new, response_blank
 
 
-    def get_signal_correlation(self, corr='spearman'):
+    def get_signal_correlation(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating signal correlation")
 
         response = self.response[:, 1:, :, :self.numbercells, 0] # orientation x freq x phase x cell, no blank
         response = response.reshape(self.number_ori * (self.number_sf-1) * self.number_phase, self.numbercells).T
-        N, Nstim = response.shape
 
-        signal_corr = np.zeros((N, N))
-        signal_p = np.empty((N, N))
-        if corr == 'pearson':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
-
-        signal_corr = np.triu(signal_corr) + np.triu(signal_corr, 1).T  # fill in lower triangle
-        signal_p = np.triu(signal_p) + np.triu(signal_p, 1).T  # fill in lower triangle
+        signal_corr, signal_p = correlation_matrix(response, corr=corr, chunk_size=chunk_size)
 
         return signal_corr, signal_p
 
 
-    def get_representational_similarity(self, corr='spearman'):
+    def get_representational_similarity(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating representational similarity")
 
         response = self.response[:, 1:, :, :self.numbercells, 0] # orientation x freq x phase x cell
         response = response.reshape(self.number_ori * (self.number_sf-1) * self.number_phase, self.numbercells)
-        Nstim, N = response.shape
 
-        rep_sim = np.zeros((Nstim, Nstim))
-        rep_sim_p = np.empty((Nstim, Nstim))
-        if corr == 'pearson':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
-
-        rep_sim = np.triu(rep_sim) + np.triu(rep_sim, 1).T # fill in lower triangle
-        rep_sim_p = np.triu(rep_sim_p) + np.triu(rep_sim_p, 1).T  # fill in lower triangle
+        rep_sim, rep_sim_p = correlation_matrix(response, corr=corr, chunk_size=chunk_size)
 
         return rep_sim, rep_sim_p
 
 
-    def get_noise_correlation(self, corr='spearman'):
+    def get_noise_correlation(self, corr='spearman', chunk_size=None):
         logging.debug("Calculating noise correlation")
 
-        response, response_blank = self.reshape_response_array()
-        noise_corr = np.zeros((self.numbercells, self.numbercells, self.number_ori, self.number_sf-1, self.number_phase))
-        noise_corr_p = np.zeros((self.numbercells, self.numbercells, self.number_ori, self.number_sf-1, self.number_phase))
-
-        noise_corr_blank = np.zeros((self.numbercells, self.numbercells))
-        noise_corr_blank_p = np.zeros((self.numbercells, self.numbercells))
-
-        if corr == 'pearson':
-            for k in range(self.number_ori):
-                for l in range(self.number_sf-1):
-                    for m in range(self.number_phase):
-                        for i in range(self.numbercells):
-                            for j in range(i, self.numbercells):
-                                noise_corr[i, j, k, l, m], noise_corr_p[i, j, k, l, m] = st.pearsonr(response[i, k, l, m], response[j, k, l, m])
-
-                        noise_corr[:, :, k, l, m] = np.triu(noise_corr[:, :, k, l, m]) + np.triu(noise_corr[:, :, k, l, m], 1).T
-
-            for i in range(self.numbercells):
-                for j in range(i, self.numbercells):
-                    noise_corr_blank[i, j], noise_corr_blank_p[i, j] = st.pearsonr(response_blank[i], response_blank[j])
-
-        elif corr == 'spearman':
-            for k in range(self.number_ori):
-                for l in range(self.number_sf-1):
-                    for m in range(self.number_phase):
-                        for i in range(self.numbercells):
-                            for j in range(i, self.numbercells):
-                                noise_corr[i, j, k, l, m], noise_corr_p[i, j, k, l, m] = st.spearmanr(response[i, k, l, m], response[j, k, l, m])
+        mean_sweep_response = self.mean_sweep_response.values[:, :self.numbercells].astype(float)
+        stim_table = self.stim_table
 
-                        noise_corr[:, :, k, l, m] = np.triu(noise_corr[:, :, k, l, m]) + np.triu(noise_corr[:, :, k, l, m], 1).T
+        sfvals = self.sfvals
+        sfvals = sfvals[sfvals != 0] # blank sweep
 
-            for i in range(self.numbercells):
-                for j in range(i, self.numbercells):
-                    noise_corr_blank[i, j], noise_corr_blank_p[i, j] = st.spearmanr(response_blank[i], response_blank[j])
+        noise_corr = np.zeros((self.numbercells, self.numbercells, self.number_ori, self.number_sf-1, self.number_phase))
+        noise_corr_p = np.zeros((self.numbercells, self.numbercells, self.number_ori, self.number_sf-1, self.number_phase))
 
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        for k, ori in enumerate(self.orivals):
+            for l, sf in enumerate(sfvals):
+                for m, phase in enumerate(self.phasevals):
+                    ind = (stim_table.orientation.values == ori) * (stim_table.spatial_frequency.values == sf) * (stim_table.phase.values == phase)
+                    noise_corr[:, :, k, l, m], p = correlation_matrix(mean_sweep_response[ind].T, corr=corr, chunk_size=chunk_size)
+                    noise_corr_p[:, :, k, l, m] = np.triu(p)
 
-        noise_corr_blank[:, :] = np.triu(noise_corr_blank[:, :]) + np.triu(noise_corr_blank[:, :], 1).T
+        ind = (stim_table.spatial_frequency.values == 0)
+        noise_corr_blank, noise_corr_blank_p = correlation_matrix(mean_sweep_response[ind].T, corr=corr, chunk_size=chunk_size)
+        noise_corr_blank_p = np.triu(noise_corr_blank_p)
 
         return noise_corr, noise_corr_p, noise_corr_blank, noise_corr_blank_p
 
@@ -34,13 +34,16 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import scipy.stats as st
+import scipy.sparse as sps
 import numpy as np
 import pandas as pd
 import logging
+import warnings
 from .findlevel import findlevel
 from .brain_observatory_exceptions import BrainObservatoryAnalysisException
 from . import observatory_plots as oplots
 import matplotlib.pyplot as plt
+import allensdk
 
 class StimulusAnalysis(object):
     """ Base class for all response analysis code. Subclasses are responsible
@@ -57,12 +60,28 @@ class StimulusAnalysis(object):
     speed_tuning: boolean, deprecated
        Whether or not to compute speed tuning histograms
 
+    checkpoint_store: CheckpointStore instance (optional)
+       If given, expensive results (sweep responses, responses, peak tables,
+       speed tuning and so on) are read from this store when present, and
+       written to it as soon as they are computed otherwise.
+
+    speed_tuning_shuffles: int (optional)
+       Number of time shuffles used to test each cell for speed modulation.
+       Default 200.
+
+    speed_tuning_seed: int (optional)
+       Seed for the speed tuning shuffles.  Default draws from the global
+       numpy random state, so results are only reproducible if a seed is given.
+
     """
     _log = logging.getLogger('allensdk.brain_observatory.stimulus_analysis')
     _PRELOAD = "PRELOAD"
 
-    def __init__(self, data_set):
+    def __init__(self, data_set, checkpoint_store=None, speed_tuning_shuffles=200, speed_tuning_seed=None):
         self.data_set = data_set
+        self.checkpoint_store = checkpoint_store
+        self.speed_tuning_shuffles = speed_tuning_shuffles
+        self.speed_tuning_seed = speed_tuning_seed
         self._timestamps = StimulusAnalysis._PRELOAD
         self._celltraces = StimulusAnalysis._PRELOAD
         self._acquisition_rate = StimulusAnalysis._PRELOAD
@@ -82,10 +101,36 @@ class StimulusAnalysis(object):
         self._stim_table = StimulusAnalysis._PRELOAD
         self._response = StimulusAnalysis._PRELOAD
         self._sweep_response = StimulusAnalysis._PRELOAD
+        self._sweep_response_tensor = StimulusAnalysis._PRELOAD
         self._mean_sweep_response = StimulusAnalysis._PRELOAD
         self._pval = StimulusAnalysis._PRELOAD
         self._peak = StimulusAnalysis._PRELOAD
 
+    @property
+    def checkpoint_stage(self):
+        """ Name of the group holding this analysis' results in a checkpoint store. """
+        return type(self).__name__
+
+    @property
+    def checkpoint_params(self):
+        """ Parameters that checkpointed results of this analysis depend on. """
+        return { 'analysis': type(self).__name__,
+                 'binsize': self._binsize,
+                 'speed_tuning_shuffles': self.speed_tuning_shuffles,
+                 'speed_tuning_seed': self.speed_tuning_seed,
+                 'allensdk_version': allensdk.__version__ }
+
+    def checkpoint(self, name, func):
+        """ Returns func(), or the result previously stored under name in
+        self.checkpoint_store.  Newly computed results are stored.
+        """
+
+        if self.checkpoint_store is None:
+            return func()
+
+        return self.checkpoint_store.get_or_compute(self.checkpoint_stage, name, func,
+                                                    self.checkpoint_params)
+
     @property
     def stim_table(self):
         if self._stim_table is StimulusAnalysis._PRELOAD:
@@ -97,15 +142,27 @@ class StimulusAnalysis(object):
     def sweep_response(self):
         if self._sweep_response is StimulusAnalysis._PRELOAD:
             self._sweep_response, self._mean_sweep_response, self._pval = \
-                self.get_sweep_response()
+                self.checkpoint('sweep_response', self.get_sweep_response)
 
         return self._sweep_response
 
+    @property
+    def sweep_response_tensor(self):
+        if self._sweep_response_tensor is StimulusAnalysis._PRELOAD:
+            if self._sweep_response is StimulusAnalysis._PRELOAD:
+                self._sweep_response_tensor = self.get_sweep_response_tensor()
+            else:
+                # sweep responses were loaded from an analysis file
+                self._sweep_response_tensor = \
+                    StimulusAnalysis.sweep_response_to_tensor(self._sweep_response)
+
+        return self._sweep_response_tensor
+
     @property
     def mean_sweep_response(self):
         if self._mean_sweep_response is StimulusAnalysis._PRELOAD:
             self._sweep_response, self._mean_sweep_response, self._pval = \
-                self.get_sweep_response()
+                self.checkpoint('sweep_response', self.get_sweep_response)
 
         return self._mean_sweep_response
 
@@ -113,21 +170,21 @@ class StimulusAnalysis(object):
     def pval(self):
         if self._pval is StimulusAnalysis._PRELOAD:
             self._sweep_response, self._mean_sweep_response, self._pval = \
-                self.get_sweep_response()
+                self.checkpoint('sweep_response', self.get_sweep_response)
 
         return self._pval
 
     @property
     def response(self):
         if self._response is StimulusAnalysis._PRELOAD:
-            self._response = self.get_response()
+            self._response = self.checkpoint('response', self.get_response)
 
         return self._response
 
     @property
     def peak(self):
         if self._peak is StimulusAnalysis._PRELOAD:
-            self._peak = self.get_peak()
+            self._peak = self.checkpoint('peak', self.get_peak)
 
         return self._peak
 
@@ -206,7 +263,7 @@ class StimulusAnalysis(object):
         if self._binned_dx_sp is StimulusAnalysis._PRELOAD:
             (self._binned_dx_sp, self._binned_cells_sp, self._binned_dx_vis,
              self._binned_cells_vis, self._peak_run) = \
-                self.get_speed_tuning(binsize=self._binsize)
+                self.checkpoint('speed_tuning', self._get_speed_tuning)
 
         return self._binned_dx_sp
 
@@ -215,7 +272,7 @@ class StimulusAnalysis(object):
         if self._binned_cells_sp is StimulusAnalysis._PRELOAD:
             (self._binned_dx_sp, self._binned_cells_sp, self._binned_dx_vis,
              self._binned_cells_vis, self._peak_run) = \
-                self.get_speed_tuning(binsize=self._binsize)
+                self.checkpoint('speed_tuning', self._get_speed_tuning)
 
         return self._binned_cells_sp
 
@@ -224,7 +281,7 @@ class StimulusAnalysis(object):
         if self._binned_dx_vis is StimulusAnalysis._PRELOAD:
             (self._binned_dx_sp, self._binned_cells_sp, self._binned_dx_vis,
              self._binned_cells_vis, self._peak_run) = \
-                self.get_speed_tuning(binsize=self._binsize)
+                self.checkpoint('speed_tuning', self._get_speed_tuning)
 
         return self._binned_dx_vis
 
@@ -233,7 +290,7 @@ class StimulusAnalysis(object):
         if self._binned_cells_vis is StimulusAnalysis._PRELOAD:
             (self._binned_dx_sp, self._binned_cells_sp, self._binned_dx_vis,
              self._binned_cells_vis, self._peak_run) = \
-                self.get_speed_tuning(binsize=self._binsize)
+                self.checkpoint('speed_tuning', self._get_speed_tuning)
 
         return self._binned_cells_vis
 
@@ -242,10 +299,15 @@ class StimulusAnalysis(object):
         if self._peak_run is StimulusAnalysis._PRELOAD:
             (self._binned_dx_sp, self._binned_cells_sp, self._binned_dx_vis,
              self._binned_cells_vis, self._peak_run) = \
-                self.get_speed_tuning(binsize=self._binsize)
+                self.checkpoint('speed_tuning', self._get_speed_tuning)
 
         return self._peak_run
 
+    def _get_speed_tuning(self):
+        return self.get_speed_tuning(binsize=self._binsize,
+                                     number_of_shuffles=self.speed_tuning_shuffles,
+                                     seed=self.speed_tuning_seed)
+
     def populate_stimulus_table(self):
         """ Implemented by subclasses. """
         raise BrainObservatoryAnalysisException("populate_stimulus_table not implemented")
@@ -258,7 +320,7 @@ class StimulusAnalysis(object):
         """ Implemented by subclasses. """
         raise BrainObservatoryAnalysisException("get_peak not implemented")
 
-    def get_speed_tuning(self, binsize):
+    def get_speed_tuning(self, binsize, number_of_shuffles=200, seed=None):
         """ Calculates speed tuning, spontaneous versus visually driven.  The return is a 5-tuple
         of speed and dF/F histograms.
 
@@ -280,6 +342,17 @@ class StimulusAnalysis(object):
 
             peak_run: pd.DataFrame of speed-related properties of a cell.
 
+        Parameters
+        ----------
+        binsize: int
+            number of samples in each running speed bin above 1 cm/s
+
+        number_of_shuffles: int
+            number of time shuffles used to test each cell for speed modulation
+
+        seed: int
+            seed for the shuffles. Default draws from the global numpy random state.
+
         Returns
         -------
         tuple: binned_dx_sp, binned_cells_sp, binned_dx_vis, binned_cells_vis, peak_run
@@ -316,132 +389,39 @@ class StimulusAnalysis(object):
         celltraces_vis = celltraces_vis[:, ~np.isnan(dx_vis)]
         dx_vis = dx_vis[~np.isnan(dx_vis)]
 
+        if np.all(np.isnan(dx_sp)):
+            raise BrainObservatoryAnalysisException(
+                "dx is filled with NaNs")
+
+        if seed is None:
+            rng = np.random
+        else:
+            rng = np.random.RandomState(seed)
+
         nbins = 1 + len(np.where(dx_sp >= 1)[0]) // binsize
         dx_sorted = dx_sp[np.argsort(dx_sp)]
         celltraces_sorted_sp = celltraces_sp[:, np.argsort(dx_sp)]
-        binned_cells_sp = np.zeros((self.numbercells, nbins, 2))
-        binned_dx_sp = np.zeros((nbins, 2))
-        for i in range(nbins):
-            if np.all(np.isnan(dx_sorted)):
-                raise BrainObservatoryAnalysisException(
-                    "dx is filled with NaNs")
-
-            offset = findlevel(dx_sorted, 1, 'up')
-
-            if offset is None:
-                StimulusAnalysis._log.info(
-                    "dx never crosses 1, all speed data going into single bin")
-                offset = len(dx_sorted)
-
-            if i == 0:
-                binned_dx_sp[i, 0] = np.mean(dx_sorted[:offset])
-                binned_dx_sp[i, 1] = np.std(
-                    dx_sorted[:offset]) / np.sqrt(offset)
-                binned_cells_sp[:, i, 0] = np.mean(
-                    celltraces_sorted_sp[:, :offset], axis=1)
-                binned_cells_sp[:, i, 1] = np.std(
-                    celltraces_sorted_sp[:, :offset], axis=1) / np.sqrt(offset)
-            else:
-                start = offset + (i - 1) * binsize
-                binned_dx_sp[i, 0] = np.mean(dx_sorted[start:start + binsize])
-                binned_dx_sp[i, 1] = np.std(
-                    dx_sorted[start:start + binsize]) / np.sqrt(binsize)
-                binned_cells_sp[:, i, 0] = np.mean(
-                    celltraces_sorted_sp[:, start:start + binsize], axis=1)
-                binned_cells_sp[:, i, 1] = np.std(
-                    celltraces_sorted_sp[:, start:start + binsize], axis=1) / np.sqrt(binsize)
-
-        binned_cells_shuffled_sp = np.empty((self.numbercells, nbins, 2, 200))
-        for shuf in range(200):
-            celltraces_shuffled = celltraces_sp[
-                :, np.random.permutation(np.size(celltraces_sp, 1))]
-            celltraces_shuffled_sorted = celltraces_shuffled[
-                :, np.argsort(dx_sp)]
-            for i in range(nbins):
-                offset = findlevel(dx_sorted, 1, 'up')
-
-                if offset is None:
-                    StimulusAnalysis._log.info(
-                        "dx never crosses 1, all speed data going into single bin")
-                    offset = celltraces_shuffled_sorted.shape[1]
-
-                if i == 0:
-                    binned_cells_shuffled_sp[:, i, 0, shuf] = np.mean(
-                        celltraces_shuffled_sorted[:, :offset], axis=1)
-                    binned_cells_shuffled_sp[:, i, 1, shuf] = np.std(
-                        celltraces_shuffled_sorted[:, :offset], axis=1)
-                else:
-                    start = offset + (i - 1) * binsize
-                    binned_cells_shuffled_sp[:, i, 0, shuf] = np.mean(
-                        celltraces_shuffled_sorted[:, start:start + binsize], axis=1)
-                    binned_cells_shuffled_sp[:, i, 1, shuf] = np.std(
-                        celltraces_shuffled_sorted[:, start:start + binsize], axis=1)
+        bin_starts, bin_ends = StimulusAnalysis.get_speed_bins(dx_sorted, binsize, nbins)
+        binned_dx_sp, binned_cells_sp = StimulusAnalysis.get_binned_speed_statistics(
+            dx_sorted, celltraces_sorted_sp, bin_starts, bin_ends, binsize)
+        binned_cells_shuffled_sp = StimulusAnalysis.get_shuffled_bin_means(
+            celltraces_sp, np.argsort(dx_sp), bin_starts, bin_ends, number_of_shuffles, rng)
 
         nbins = 1 + len(np.where(dx_vis >= 1)[0]) // binsize
         dx_sorted = dx_vis[np.argsort(dx_vis)]
         celltraces_sorted_vis = celltraces_vis[:, np.argsort(dx_vis)]
-        binned_cells_vis = np.zeros((self.numbercells, nbins, 2))
-        binned_dx_vis = np.zeros((nbins, 2))
-        for i in range(nbins):
-            offset = findlevel(dx_sorted, 1, 'up')
-
-            if offset is None:
-                StimulusAnalysis._log.info(
-                    "dx never crosses 1, all speed data going into single bin")
-                offset = len(dx_sorted)
-
-            if i == 0:
-                binned_dx_vis[i, 0] = np.mean(dx_sorted[:offset])
-                binned_dx_vis[i, 1] = np.std(
-                    dx_sorted[:offset]) / np.sqrt(offset)
-                binned_cells_vis[:, i, 0] = np.mean(
-                    celltraces_sorted_vis[:, :offset], axis=1)
-                binned_cells_vis[:, i, 1] = np.std(
-                    celltraces_sorted_vis[:, :offset], axis=1) / np.sqrt(offset)
-            else:
-                start = offset + (i - 1) * binsize
-                binned_dx_vis[i, 0] = np.mean(dx_sorted[start:start + binsize])
-                binned_dx_vis[i, 1] = np.std(
-                    dx_sorted[start:start + binsize]) / np.sqrt(binsize)
-                binned_cells_vis[:, i, 0] = np.mean(
-                    celltraces_sorted_vis[:, start:start + binsize], axis=1)
-                binned_cells_vis[:, i, 1] = np.std(
-                    celltraces_sorted_vis[:, start:start + binsize], axis=1) / np.sqrt(binsize)
-
-        binned_cells_shuffled_vis = np.empty((self.numbercells, nbins, 2, 200))
-        for shuf in range(200):
-            celltraces_shuffled = celltraces_vis[
-                :, np.random.permutation(np.size(celltraces_vis, 1))]
-            celltraces_shuffled_sorted = celltraces_shuffled[
-                :, np.argsort(dx_vis)]
-            for i in range(nbins):
-                offset = findlevel(dx_sorted, 1, 'up')
-
-                if offset is None:
-                    StimulusAnalysis._log.info(
-                        "dx never crosses 1, all speed data going into single bin")
-                    offset = len(dx_sorted)
-
-                if i == 0:
-                    binned_cells_shuffled_vis[:, i, 0, shuf] = np.mean(
-                        celltraces_shuffled_sorted[:, :offset], axis=1)
-                    binned_cells_shuffled_vis[:, i, 1, shuf] = np.std(
-                        celltraces_shuffled_sorted[:, :offset], axis=1)
-                else:
-                    start = offset + (i - 1) * binsize
-                    binned_cells_shuffled_vis[:, i, 0, shuf] = np.mean(
-                        celltraces_shuffled_sorted[:, start:start + binsize], axis=1)
-                    binned_cells_shuffled_vis[:, i, 1, shuf] = np.std(
-                        celltraces_shuffled_sorted[:, start:start + binsize], axis=1)
-
-        shuffled_variance_sp = binned_cells_shuffled_sp[
-            :, :, 0, :].std(axis=1)**2
+        bin_starts, bin_ends = StimulusAnalysis.get_speed_bins(dx_sorted, binsize, nbins)
+        binned_dx_vis, binned_cells_vis = StimulusAnalysis.get_binned_speed_statistics(
+            dx_sorted, celltraces_sorted_vis, bin_starts, bin_ends, binsize)
+        binned_cells_shuffled_vis = StimulusAnalysis.get_shuffled_bin_means(
+            celltraces_vis, np.argsort(dx_vis), bin_starts, bin_ends, number_of_shuffles, rng)
+
+        shuffled_variance_sp = binned_cells_shuffled_sp.std(axis=1)**2
         variance_threshold_sp = np.percentile(
             shuffled_variance_sp, 99.9, axis=1)
         response_variance_sp = binned_cells_sp[:, :, 0].std(axis=1)**2
 
-        shuffled_variance_vis = binned_cells_shuffled_vis[
-            :, :, 0, :].std(axis=1)**2
+        shuffled_variance_vis = binned_cells_shuffled_vis.std(axis=1)**2
         variance_threshold_vis = np.percentile(
             shuffled_variance_vis, 99.9, axis=1)
         response_variance_vis = binned_cells_vis[:, :, 0].std(axis=1)**2
@@ -494,6 +474,206 @@ class StimulusAnalysis(object):
 
         return binned_dx_sp, binned_cells_sp, binned_dx_vis, binned_cells_vis, peak_run
 
+    @staticmethod
+    def get_speed_bins(dx_sorted, binsize, nbins):
+        """ Computes the boundaries of the running speed bins used by get_speed_tuning.
+        The first bin holds every sample below 1 cm/s; the remaining bins hold binsize
+        samples each.  Bins that run past the end of the data are truncated.
+
+        Parameters
+        ----------
+        dx_sorted: np.ndarray
+            running speeds, sorted in ascending order
+
+        binsize: int
+            number of samples per bin above 1 cm/s
+
+        nbins: int
+            total number of bins
+
+        Returns
+        -------
+        tuple: bin_starts, bin_ends; (nbins,) np.ndarrays of sample indices
+        """
+        offset = findlevel(dx_sorted, 1, 'up')
+
+        if offset is None:
+            StimulusAnalysis._log.info(
+                "dx never crosses 1, all speed data going into single bin")
+            offset = len(dx_sorted)
+
+        bin_starts = np.empty(nbins, dtype=int)
+        bin_starts[0] = 0
+        bin_starts[1:] = offset + np.arange(nbins - 1) * binsize
+
+        bin_ends = np.empty(nbins, dtype=int)
+        bin_ends[0] = offset
+        bin_ends[1:] = bin_starts[1:] + binsize
+
+        length = len(dx_sorted)
+        return np.minimum(bin_starts, length), np.minimum(bin_ends, length)
+
+    @staticmethod
+    def get_binned_speed_statistics(dx_sorted, celltraces_sorted, bin_starts, bin_ends, binsize):
+        """ Computes the mean and standard error of the running speed and of every
+        cell's fluorescence within each running speed bin.  The standard error of
+        every bin above 1 cm/s is normalized by the nominal bin size.
+
+        Parameters
+        ----------
+        dx_sorted: np.ndarray
+            running speeds, sorted in ascending order
+
+        celltraces_sorted: np.ndarray
+            (# cells, # samples) fluorescence, in the same order as dx_sorted
+
+        bin_starts: np.ndarray
+            first sample of each bin, see get_speed_bins
+
+        bin_ends: np.ndarray
+            one past the last sample of each bin, see get_speed_bins
+
+        binsize: int
+            number of samples per bin above 1 cm/s
+
+        Returns
+        -------
+        tuple: binned_dx, (bins,2) np.ndarray; binned_cells, (cells,bins,2) np.ndarray
+        """
+        nbins = len(bin_starts)
+        binned_dx = np.zeros((nbins, 2))
+        binned_cells = np.zeros((len(celltraces_sorted), nbins, 2))
+
+        for i in range(nbins):
+            start, end = bin_starts[i], bin_ends[i]
+            count = end if i == 0 else binsize
+
+            binned_dx[i, 0] = np.mean(dx_sorted[start:end])
+            binned_dx[i, 1] = np.std(dx_sorted[start:end]) / np.sqrt(count)
+            binned_cells[:, i, 0] = np.mean(celltraces_sorted[:, start:end], axis=1)
+            binned_cells[:, i, 1] = np.std(celltraces_sorted[:, start:end], axis=1) / np.sqrt(count)
+
+        return binned_dx, binned_cells
+
+    @staticmethod
+    def get_shuffled_bin_means(celltraces, order, bin_starts, bin_ends,
+                               number_of_shuffles, rng=np.random, max_batch_elements=2**23):
+        """ Computes the null distribution of binned fluorescence used to test for
+        speed tuning.  For every shuffle, the samples of each cell are permuted in
+        time before being sorted by running speed and binned.
+
+        Shuffles are drawn as (# shuffles, # samples) index arrays and bin means
+        come from the cumulative sum of the permuted traces, processed in batches
+        of shuffles holding at most max_batch_elements values each.
+
+        Parameters
+        ----------
+        celltraces: np.ndarray
+            (# cells, # samples) fluorescence
+
+        order: np.ndarray
+            indices that sort the samples by running speed
+
+        bin_starts: np.ndarray
+            first sample of each bin, see get_speed_bins
+
+        bin_ends: np.ndarray
+            one past the last sample of each bin, see get_speed_bins
+
+        number_of_shuffles: int
+            number of permutations
+
+        rng: np.random.RandomState or the np.random module
+            source of the permutations
+
+        max_batch_elements: int
+            bound on the size of the permuted trace array of a batch
+
+        Returns
+        -------
+        np.ndarray: (# cells, # bins, # shuffles) mean fluorescence in each bin
+        """
+        number_cells, number_samples = celltraces.shape
+        counts = (bin_ends - bin_starts).astype(float)
+        length = bin_ends.max() if len(bin_ends) else 0
+
+        # samples along the first axis, so that permuting gathers contiguous rows
+        celltraces_by_sample = np.ascontiguousarray(celltraces.T)
+
+        shuffled_means = np.empty((number_cells, len(bin_starts), number_of_shuffles))
+        batch_size = max(1, max_batch_elements // max(number_cells * number_samples, 1))
+
+        for batch_start in range(0, number_of_shuffles, batch_size):
+            batch = range(batch_start, min(batch_start + batch_size, number_of_shuffles))
+            permutations = np.array([rng.permutation(number_samples) for _ in batch], dtype=int)
+            permutations = permutations.reshape(len(batch), number_samples)[:, order[:length]]
+
+            # cumulative sums along time, with a leading zero so that bin sums are differences
+            cumulative = np.empty((len(batch), length + 1, number_cells))
+            cumulative[:, 0, :] = 0
+            cumulative[:, 1:, :] = np.take(celltraces_by_sample, permutations, axis=0)
+            np.cumsum(cumulative, axis=1, out=cumulative)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means = (cumulative[:, bin_ends, :] - cumulative[:, bin_starts, :]) / counts[:, np.newaxis]
+            shuffled_means[:, :, batch_start:batch_start + len(batch)] = means.transpose(2, 1, 0)
+
+        return shuffled_means
+
+    def get_sweep_response_tensor(self):
+        """ Gathers the dF/F trace window around every sweep in the stimulus table
+        for every cell into a single dense array.  Each window starts
+        self.interlength frames before the sweep and ends self.interlength frames
+        after self.sweeplength.  Cell traces are expressed as percent change relative
+        to the mean of the pre-sweep interval.  The final entry along the cell axis
+        holds the raw running speed over the same window.  Frames that fall outside
+        of the recording are NaN.
+
+        Returns
+        -------
+        np.ndarray of shape (# sweeps, # cells + 1, window length)
+        """
+        StimulusAnalysis._log.info('Gathering sweep response windows')
+
+        interlength = int(self.interlength)
+        window = int(self.sweeplength) + 2 * interlength
+        starts = self.stim_table['start'].values.astype(int) - interlength
+        frames = starts[:, np.newaxis] + np.arange(window)
+
+        numbercells = self.numbercells
+        tensor = np.empty((len(starts), numbercells + 1, window))
+
+        for traces, channels in ((self.celltraces, slice(0, numbercells)),
+                                 (np.asarray(self.dxcm)[np.newaxis, :], slice(numbercells, numbercells + 1))):
+            n_frames = traces.shape[1]
+            valid = (frames >= 0) & (frames < n_frames)
+            gathered = traces[:, np.clip(frames, 0, n_frames - 1)]
+            gathered[:, ~valid] = np.nan
+            tensor[:, channels, :] = gathered.transpose(1, 0, 2)
+
+        baseline = tensor[:, :numbercells, :interlength].mean(axis=2)
+        cells = tensor[:, :numbercells, :]
+        np.divide(cells, baseline[:, :, np.newaxis], out=cells)
+        cells -= 1
+        cells *= 100
+
+        return tensor
+
+    @staticmethod
+    def sweep_response_to_tensor(sweep_response):
+        """ Converts a sweep_response data frame (one trace per sweep and cell) into
+        the dense (# sweeps, # columns, window length) array returned by
+        get_sweep_response_tensor. Traces shorter than the longest one are padded
+        with NaN. """
+        traces = sweep_response.values
+        window = max(len(trace) for trace in traces.ravel()) if traces.size else 0
+
+        tensor = np.full(traces.shape + (window,), np.nan)
+        for (i, j), trace in np.ndenumerate(traces):
+            tensor[i, j, :len(trace)] = trace
+
+        return tensor
+
     def get_sweep_response(self):
         """ Calculates the response to each sweep in the stimulus table for each cell and the mean response.
         The return is a 3-tuple of:
@@ -504,40 +684,382 @@ class StimulusAnalysis(object):
 
             * pval: p value from 1-way ANOVA comparing response during sweep to response prior to sweep
 
+        The traces in sweep_response are views into self.sweep_response_tensor.
+
         Returns
         -------
         3-tuple: sweep_response, mean_sweep_response, pval
         """
-        def do_mean(x):
-            # +1])
-            return np.mean(x[self.interlength:self.interlength + self.sweeplength + self.extralength])
+        StimulusAnalysis._log.info('Calculating responses for each sweep')
 
-        def do_p_value(x):
-            (_, p) = st.f_oneway(x[:self.interlength], x[
-                self.interlength:self.interlength + self.sweeplength + self.extralength])
-            return p
+        tensor = self.sweep_response_tensor
+        columns = list(map(str, range(self.numbercells))) + ['dx']
+        index = self.stim_table.index.values
+
+        interlength = int(self.interlength)
+        response_end = interlength + int(self.sweeplength) + int(self.extralength)
+        mean_sweep_response, pval = StimulusAnalysis.compute_sweep_statistics(
+            tensor, interlength, response_end)
+
+        # windows running off the end of the recording are truncated, as they
+        # would be by slicing the traces directly
+        window = tensor.shape[2]
+        starts = self.stim_table['start'].values.astype(int) - interlength
+        n_valid = np.empty(tensor.shape[:2], dtype=int)
+        n_valid[:, :-1] = np.clip(self.celltraces.shape[1] - starts, 0, window)[:, np.newaxis]
+        n_valid[:, -1] = np.clip(len(self.dxcm) - starts, 0, window)
+        truncated = np.where((n_valid < window).any(axis=1))[0]
+
+        traces = np.empty(tensor.shape[:2], dtype=object)
+        for i in range(tensor.shape[0]):
+            for j in range(tensor.shape[1]):
+                traces[i, j] = tensor[i, j]
+
+        for i in truncated:
+            for j in range(tensor.shape[1]):
+                trace = tensor[i, j, :n_valid[i, j]]
+                traces[i, j] = trace
+                mean_sweep_response[i, j] = np.mean(trace[interlength:response_end])
+                (_, pval[i, j]) = st.f_oneway(trace[:interlength], trace[interlength:response_end])
+
+        sweep_response = pd.DataFrame(traces, index=index, columns=columns)
+        mean_sweep_response = pd.DataFrame(mean_sweep_response, index=index, columns=columns)
+        pval = pd.DataFrame(pval, index=index, columns=columns)
 
-        StimulusAnalysis._log.info('Calculating responses for each sweep')
-        sweep_response = pd.DataFrame(index=self.stim_table.index.values, 
-                                      columns=list(map(str, range(self.numbercells + 1))))
+        return sweep_response, mean_sweep_response, pval
 
-        sweep_response.rename(
-            columns={str(self.numbercells): 'dx'}, inplace=True)
+    @staticmethod
+    def compute_sweep_statistics(tensor, interlength, response_end, chunk_size=500):
+        """ Computes the mean response and the p value of a 1-way ANOVA comparing the
+        pre-sweep interval (tensor[..., :interlength]) to the response interval
+        (tensor[..., interlength:response_end]) for every sweep and cell at once.
 
-        for index, row in self.stim_table.iterrows():
-            start = int(row['start'] - self.interlength)
-            end = int(row['start'] + self.sweeplength + self.interlength)
+        Parameters
+        ----------
+        tensor: np.ndarray
+            (# sweeps, # cells, window length) array of sweep responses
 
-            for nc in range(self.numbercells):
-                temp = self.celltraces[int(nc), start:end]
-                sweep_response[str(nc)][index] = 100 * \
-                    ((temp / np.mean(temp[:self.interlength])) - 1)
-            sweep_response['dx'][index] = self.dxcm[start:end]
+        interlength: int
+            number of frames preceding the sweep
 
-        mean_sweep_response = sweep_response.applymap(do_mean)
+        response_end: int
+            end of the response interval within the window
 
-        pval = sweep_response.applymap(do_p_value)
-        return sweep_response, mean_sweep_response, pval
+        chunk_size: int
+            number of sweeps processed together, bounding temporary memory use
+
+        Returns
+        -------
+        tuple: mean_sweep_response, pval, each a (# sweeps, # cells) np.ndarray
+        """
+        n_sweeps = tensor.shape[0]
+        mean_sweep_response = np.empty(tensor.shape[:2])
+        pval = np.empty(tensor.shape[:2])
+
+        n_pre = interlength
+        n_post = response_end - interlength
+        df_within = n_pre + n_post - 2
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for chunk_start in range(0, n_sweeps, chunk_size):
+                chunk = slice(chunk_start, chunk_start + chunk_size)
+                pre = tensor[chunk, :, :interlength]
+                post = tensor[chunk, :, interlength:response_end]
+
+                pre_mean = pre.mean(axis=2)
+                post_mean = post.mean(axis=2)
+                grand_mean = (n_pre * pre_mean + n_post * post_mean) / (n_pre + n_post)
+
+                ss_between = n_pre * (pre_mean - grand_mean) ** 2 + n_post * (post_mean - grand_mean) ** 2
+                ss_within = ((pre - pre_mean[:, :, np.newaxis]) ** 2).sum(axis=2) + \
+                    ((post - post_mean[:, :, np.newaxis]) ** 2).sum(axis=2)
+
+                f = ss_between / (ss_within / df_within)
+                mean_sweep_response[chunk] = post_mean
+                pval[chunk] = st.f.sf(f, 1, df_within)
+
+        return mean_sweep_response, pval
+
+    @staticmethod
+    def get_condition_codes(stim_table, conditions):
+        """ Assigns every sweep in a stimulus table an integer code identifying its
+        stimulus condition.  Codes enumerate the cartesian product of the condition
+        values in row-major order, so that they can be reshaped into a
+        (# values of first column, # values of second column, ...) grid.
+
+        Parameters
+        ----------
+        stim_table: pd.DataFrame
+            stimulus table with one row per sweep
+
+        conditions: list of (column name, values) tuples
+            values must be sorted. Sweeps are matched to values by equality.
+
+        Returns
+        -------
+        np.ndarray of integer codes, -1 for sweeps that match no condition
+        """
+        codes = np.zeros(len(stim_table), dtype=int)
+        matched = np.ones(len(stim_table), dtype=bool)
+
+        for column, values in conditions:
+            values = np.asarray(values)
+            column_values = np.asarray(stim_table[column].values).reshape(len(stim_table))
+
+            if len(values) == 0:
+                matched[:] = False
+                continue
+
+            index = np.clip(np.searchsorted(values, column_values), 0, len(values) - 1)
+            matched &= values[index] == column_values
+            codes = codes * len(values) + index
+
+        codes[~matched] = -1
+        return codes
+
+    @staticmethod
+    def get_condition_membership(codes, number_conditions):
+        """ Converts per-sweep condition codes into a sparse
+        (# conditions, # sweeps) indicator matrix. """
+        sweeps = np.where(codes >= 0)[0]
+        return sps.csr_matrix((np.ones(len(sweeps)), (codes[sweeps], sweeps)),
+                              shape=(number_conditions, len(codes)))
+
+    @staticmethod
+    def get_grouped_mean(membership, values):
+        """ Computes the NaN-ignoring mean of every column of values across the sweeps
+        belonging to each condition.
+
+        Parameters
+        ----------
+        membership: scipy.sparse matrix
+            (# conditions, # sweeps) indicator matrix. Sweeps may belong to
+            more than one condition.
+
+        values: np.ndarray
+            (# sweeps, # columns) array
+
+        Returns
+        -------
+        tuple: mean, number of non-NaN values; each a (# conditions, # columns) np.ndarray
+        """
+        valid = ~np.isnan(values)
+        n_valid = np.asarray(membership.dot(valid.astype(float)))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.asarray(membership.dot(np.where(valid, values, 0.0))) / n_valid
+
+        return mean, n_valid
+
+    def get_condition_response(self, membership, p_threshold):
+        """ Computes the mean response, the standard error of the mean response and the
+        number of significantly responsive trials for each condition, column of
+        self.mean_sweep_response and self.pval in one pass.
+
+        Parameters
+        ----------
+        membership: scipy.sparse matrix
+            (# conditions, # sweeps) indicator matrix, see get_condition_membership.
+            Each sweep may belong to at most one condition.
+
+        p_threshold: float
+            trials with self.pval below this are counted as significant
+
+        Returns
+        -------
+        (# conditions, # cells + 1, 3) np.ndarray.  Conditions that were never
+        presented have NaN mean and standard error and 0 significant trials.
+        """
+        n_sweeps = membership.shape[1]
+        values = np.asarray(self.mean_sweep_response.values, dtype=float).reshape(
+            n_sweeps, self.numbercells + 1)
+        pval = np.asarray(self.pval.values, dtype=float).reshape(values.shape)
+
+        mean, n_valid = StimulusAnalysis.get_grouped_mean(membership, values)
+
+        # two pass variance for numerical agreement with pd.DataFrame.std
+        deviation = values - membership.T.dot(np.nan_to_num(mean))
+        deviation[np.isnan(deviation)] = 0.0
+        sum_squares = np.asarray(membership.dot(deviation ** 2))
+        n_trials = np.asarray(membership.sum(axis=1))
+
+        response = np.empty((membership.shape[0], values.shape[1], 3))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(sum_squares / (n_valid - 1))
+            std[n_valid < 2] = np.nan
+            response[:, :, 0] = mean
+            response[:, :, 1] = std / np.sqrt(n_trials)
+            response[:, :, 2] = membership.dot((pval < p_threshold).astype(float))
+
+        return response
+
+    @staticmethod
+    def get_one_way_anova(membership, values):
+        """ Computes a 1-way ANOVA across the groups of sweeps in membership
+        separately for every column of values, as scipy.stats.f_oneway would.
+
+        Parameters
+        ----------
+        membership: scipy.sparse matrix
+            (# groups, # sweeps) indicator matrix. Each sweep may belong to at
+            most one group.  Sweeps belonging to no group are ignored.
+
+        values: np.ndarray
+            (# sweeps, # columns) array
+
+        Returns
+        -------
+        np.ndarray of p values, one per column
+        """
+        number_groups = membership.shape[0]
+        n = np.asarray(membership.sum(axis=1))
+        n_total = n.sum()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            group_mean = np.asarray(membership.dot(values)) / n
+            grand_mean = (n * group_mean).sum(axis=0) / n_total
+
+            ss_between = (n * (group_mean - grand_mean) ** 2).sum(axis=0)
+            deviation = values - membership.T.dot(group_mean)
+            ss_within = np.asarray(membership.dot(deviation ** 2)).sum(axis=0)
+
+            df_between = number_groups - 1
+            df_within = n_total - number_groups
+            f = (ss_between / df_between) / (ss_within / df_within)
+
+        return st.f.sf(f, df_between, df_within)
+
+    @staticmethod
+    def get_running_modulation(membership, values, dx, preferred, min_trials):
+        """ Compares each cell's responses to its preferred condition on running
+        (dx >= 1) and stationary (dx < 1) trials with Welch's t-test.
+
+        Parameters
+        ----------
+        membership: scipy.sparse matrix
+            (# conditions, # sweeps) indicator matrix
+
+        values: np.ndarray
+            (# sweeps, # cells) mean sweep responses
+
+        dx: np.ndarray
+            mean running speed of each sweep
+
+        preferred: np.ndarray
+            index of the preferred condition of each cell
+
+        min_trials: int
+            cells with this many or fewer running or stationary trials are skipped
+
+        Returns
+        -------
+        tuple: p_run, run_modulation; each an np.ndarray with one value per cell
+        """
+        preferred_membership = sps.csr_matrix(membership[preferred])
+        number_cells = len(preferred)
+
+        stats = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for trials in (dx >= 1, dx < 1):
+                trial_membership = preferred_membership.multiply(trials[np.newaxis, :].astype(float))
+                n = np.asarray(trial_membership.sum(axis=1)).reshape(number_cells)
+                mean = np.asarray(trial_membership.multiply(values.T).sum(axis=1)).reshape(number_cells) / n
+                sum_squares = trial_membership.multiply(((values - mean) ** 2).T)
+                var = np.asarray(sum_squares.sum(axis=1)).reshape(number_cells) / (n - 1)
+                stats.append((n, mean, var))
+
+            (n_run, mean_run, var_run), (n_stat, mean_stat, var_stat) = stats
+
+            vn_run = var_run / n_run
+            vn_stat = var_stat / n_stat
+            df = (vn_run + vn_stat) ** 2 / (vn_run ** 2 / (n_run - 1) + vn_stat ** 2 / (n_stat - 1))
+            df[np.isnan(df)] = 1
+            t = (mean_run - mean_stat) / np.sqrt(vn_run + vn_stat)
+            p_run = st.t.sf(np.abs(t), df) * 2
+
+            run_modulation = np.full(number_cells, np.nan)
+            faster = mean_run > mean_stat
+            slower = mean_run < mean_stat
+            run_modulation[faster] = ((mean_run - mean_stat) / np.abs(mean_run))[faster]
+            run_modulation[slower] = -1 * ((mean_stat - mean_run) / np.abs(mean_stat))[slower]
+
+        enough = (n_run > min_trials) & (n_stat > min_trials)
+        p_run[~enough] = np.nan
+        run_modulation[~enough] = np.nan
+
+        return p_run, run_modulation
+
+    @staticmethod
+    def get_reliability(traces, membership, preferred):
+        """ Computes the mean pairwise Pearson correlation between the response traces
+        of all trials of each cell's preferred condition.
+
+        Parameters
+        ----------
+        traces: np.ndarray
+            (# sweeps, # cells, # frames) array of response traces
+
+        membership: scipy.sparse matrix
+            (# conditions, # sweeps) indicator matrix
+
+        preferred: np.ndarray
+            index of the preferred condition of each cell
+
+        Returns
+        -------
+        np.ndarray with one reliability value per cell
+        """
+        reliability = np.full(len(preferred), np.nan)
+        membership = sps.csr_matrix(membership)
+
+        for condition in np.unique(preferred):
+            cells = np.where(preferred == condition)[0]
+            sweeps = np.sort(membership[condition].indices)
+
+            # z-scored traces turn every trial by trial correlation matrix into one product
+            x = traces[sweeps][:, cells, :]
+            x = x - x.mean(axis=2, keepdims=True)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x /= np.sqrt((x ** 2).sum(axis=2, keepdims=True))
+                corr = np.clip(np.einsum('icf,jcf->cij', x, x), -1.0, 1.0)
+
+            upper_i, upper_j = np.triu_indices(len(sweeps), 1)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                reliability[cells] = np.nanmean(corr[:, upper_i, upper_j], axis=1)
+
+        return reliability
+
+    @staticmethod
+    def get_preferred_mean_trace(traces, membership, preferred):
+        """ Computes the trial-averaged response trace of each cell to its
+        preferred condition.
+
+        Parameters
+        ----------
+        traces: np.ndarray
+            (# sweeps, # cells, # frames) array of response traces
+
+        membership: scipy.sparse matrix
+            (# conditions, # sweeps) indicator matrix
+
+        preferred: np.ndarray
+            index of the preferred condition of each cell
+
+        Returns
+        -------
+        (# cells, # frames) np.ndarray
+        """
+        mean_traces = np.full((len(preferred), traces.shape[2]), np.nan)
+        membership = sps.csr_matrix(membership)
+
+        for condition in np.unique(preferred):
+            cells = np.where(preferred == condition)[0]
+            sweeps = np.sort(membership[condition].indices)
+            if len(sweeps) > 0:
+                mean_traces[cells] = traces[sweeps][:, cells, :].sum(axis=0) / len(sweeps)
+
+        return mean_traces
 
     def plot_representational_similarity(self, repsim, stimulus=False):
         if stimulus:
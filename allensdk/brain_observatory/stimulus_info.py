@@ -37,7 +37,6 @@ import six
 import numpy as np
 import scipy.ndimage.interpolation as spndi
 from scipy.misc import imresize
-from allensdk.api.cache import memoize
 import itertools
 
 # some handles for stimulus types
@@ -119,6 +118,8 @@ MONITOR_DIMENSIONS = (1200, 1920)
 MONITOR_DISTANCE = 15
 
 STIMULUS_GRAY = 127
+
+DRIFTING_GRATINGS_SPATIAL_FREQUENCY = 0.04
 STIMULUS_BITDEPTH = 8
 
 # Note: the "8deg" stimulus is actually 9.3 visual degrees on a side
@@ -181,8 +182,8 @@ class BinaryIntervalSearchTree(object):
 
 
     def __init__(self, search_list):
-        """Create a binary tree to search for a point within a list of intervals.  Assumes that the intervals are
-        non-overlapping.  If two intervals share an endpoint, the left-side wins the tie.
+        """Create a sorted interval index to search for points within a list of intervals.  Assumes that the
+        intervals are non-overlapping.  If two intervals share an endpoint, the left-side wins the tie.
 
         :param search_list: list of interval tuples; in the tuple, first element is interval start, then interval
         end (inclusive), then the return value for the lookup
@@ -199,35 +200,35 @@ class BinaryIntervalSearchTree(object):
         for x, y in zip(search_list[:-1], search_list[1:]):
             assert x[1] <= y[0]
 
+        self.data = search_list
+        self.starts = np.array([x[0] for x in search_list], dtype=float)
+        self.ends = np.array([x[1] for x in search_list], dtype=float)
 
-        self.data = {}
-        self.add(search_list)
+    def search_indices(self, fi):
+        """Find the interval containing each of an array of points.
 
-    def add(self, input_list, tmp=None):
-        if tmp is None:
-            tmp = []
+        :param fi: scalar or array of points
+        :return: array (same shape as fi) of positions in self.data, -1 where no interval contains the point
+        """
+        fi = np.asarray(fi, dtype=float)
 
-        if len(input_list) == 1:
-            self.data[tuple(tmp)] = input_list[0]
-        else:
-            self.add(input_list[:int(len(input_list)/2)], tmp=tmp+[0])
-            self.add(input_list[int(len(input_list)/2):], tmp=tmp+[1])
-            self.data[tuple(tmp)] = input_list[int(len(input_list)/2)-1]
-
-    def search(self, fi, tmp=None):
-        if tmp is None:
-            tmp = []
-
-        if (self.data[tuple(tmp)][0] <= fi) and (fi <= self.data[tuple(tmp)][1]):
-            return_val = self.data[tuple(tmp)]
-        elif fi < self.data[tuple(tmp)][1]:
-            return_val = self.search(fi, tmp=tmp + [0])
-        else:
-            return_val = self.search(fi, tmp=tmp + [1])
+        if len(self.data) == 0:
+            return np.full(fi.shape, -1, dtype=int)
+
+        # the first interval ending at or after the point is the only candidate; on a shared
+        # endpoint this is the left interval
+        inds = np.searchsorted(self.ends, fi, side='left')
+        inds = np.minimum(inds, len(self.ends) - 1)
+        found = (self.starts[inds] <= fi) & (fi <= self.ends[inds])
 
-        # print 'CHECKING:', return_val[0], fi, return_val[1], tmp
-        assert (return_val[0] <= fi) and (fi <= return_val[1])
-        return return_val
+        return np.where(found, inds, -1)
+
+    def search(self, fi):
+        ind = int(self.search_indices(fi))
+        if ind < 0:
+            raise KeyError(fi)
+
+        return self.data[ind]
 
 class StimulusSearch(object):
 
@@ -239,34 +240,63 @@ class StimulusSearch(object):
         self.epoch_bst = BinaryIntervalSearchTree.from_df(self.epoch_df)
         self.master_bst = BinaryIntervalSearchTree.from_df(self.master_df)
 
-    @memoize
-    def search(self, fi):
+        self._first_frame, self._frame_fill = self._build_frame_fill()
 
-        try:
+    def _build_frame_fill(self):
+        """Resolves every integer frame spanned by the epoch and master tables.  A frame
+        inside a fine-grain (master) interval maps to that interval.  A frame that is
+        only inside a coarse-grain epoch maps to the most recent fine-grain interval, as
+        long as every frame back to it is inside an epoch.  Anything else maps to -1.
+        """
+        bounds = np.concatenate([self.master_bst.starts, self.master_bst.ends,
+                                 self.epoch_bst.starts, self.epoch_bst.ends])
+        if len(bounds) == 0:
+            return 0, np.empty(0, dtype=int)
+
+        first_frame = int(np.floor(bounds.min()))
+        frames = np.arange(first_frame, int(np.ceil(bounds.max())) + 1)
+
+        master = self.master_bst.search_indices(frames)
+        in_epoch = self.epoch_bst.search_indices(frames) >= 0
+        if len(self.epoch_df) > 0:
+            in_epoch &= frames >= self.epoch_df.iloc[0]['start']
+
+        # carry each fine-grain hit forward until a frame outside of every epoch
+        resolved = (master >= 0) | ~in_epoch
+        last_resolved = np.maximum.accumulate(np.where(resolved, np.arange(len(frames)), -1))
+        frame_fill = np.where(last_resolved >= 0, master[np.maximum(last_resolved, 0)], -1)
 
-            # Look in fine-grain tree:
-            search_result = self.master_bst.search(fi)
-            return search_result
-        except KeyError:
+        return first_frame, frame_fill
 
-            # Current frame not found in a fine-grain interval;
-            #   see if it is unregistered to a coarse-grain epoch:
-            try:
+    def search_indices(self, fi):
+        """Resolve acquisition frames to fine-grain stimulus intervals.
 
-                # THis will thow KeyError if not in coarse-grain epoch
-                self.epoch_bst.search(fi)
+        :param fi: scalar or array of acquisition frame indices
+        :return: array (same shape as fi) of positions in self.master_bst.data, -1 where the frame
+        is not registered to a stimulus
+        """
+        fi = np.asarray(fi, dtype=float)
+        inds = self.master_bst.search_indices(fi)
+
+        # frames in gaps between fine-grain intervals fall back on the precomputed fill
+        gap = inds < 0
+        positions = np.floor(fi[gap]).astype(int) - self._first_frame
+        within = (positions >= 0) & (positions < len(self._frame_fill))
+        filled = np.full(len(positions), -1, dtype=int)
+        filled[within] = self._frame_fill[positions[within]]
+        inds[gap] = filled
 
-                # Frame is in a coarse-grain  epoch, but not a fine grain interval;
-                #   look backwards to find most recent find nearest matching interval
-                if fi < self.epoch_df.iloc[0]['start']:
-                    return None
-                else:
-                    return self.search(fi-1)
+        return inds
+
+    def search(self, fi):
+        """Returns the master stimulus table interval (start, end, row) registered to an acquisition
+        frame, or None.  If fi is an array, returns a list with one result per frame."""
+        inds = self.search_indices(fi)
 
-            except KeyError:
+        if inds.ndim == 0:
+            return None if inds < 0 else self.master_bst.data[inds]
 
-                # Frame is unregistered at the coarse level; return None
-                return None
+        return [None if ind < 0 else self.master_bst.data[ind] for ind in inds.ravel()]
 
 def rotate(X, Y, theta):
     x = np.array([X, Y])
@@ -33,6 +33,7 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import contextlib
 import functools
 import dateutil
 import re
@@ -40,6 +41,8 @@ import os
 import six
 import itertools
 import logging
+import threading
+import weakref
 from pkg_resources import parse_version
 
 import h5py
@@ -136,11 +139,45 @@ class BrainObservatoryNwbDataSet(object):
     MOTION_CORRECTION_DATASETS = [ "MotionCorrection/2p_image_series/xy_translations",
                                    "MotionCorrection/2p_image_series/xy_translation" ]
 
-    def __init__(self, nwb_file):
+    # chunk cache settings used while the file is held open (see open())
+    RDCC_NBYTES = 64 * 1024 ** 2
+    RDCC_NSLOTS = 10007
+    RDCC_W0 = 0.75
+
+    # number of stimulus frames returned together by get_stimulus_frames
+    STIMULUS_FRAME_CHUNK_SIZE = 30
+
+    # upper bound on the size of one chunk of rendered grating frames.  A
+    # BrainObservatoryMonitor frame is 1200 x 1920 float32 (~8.8 MB), so
+    # grating chunks hold at most 7 frames.
+    RENDERED_FRAME_CHUNK_NBYTES = 64 * 1024 ** 2
+
+    def __init__(self, nwb_file, memmap=False):
+        '''
+        Parameters
+        ----------
+        nwb_file: string
+            Path to the NWB file
+
+        memmap: bool (optional)
+            If True, whole-dataset reads of traces, dF/F and running speed
+            return read-only arrays shared by every caller of this data set.
+            Contiguous, uncompressed datasets are memory-mapped straight from
+            the file; anything else is read once and kept for as long as some
+            caller still holds a reference to it.  Default False.
+        '''
 
         self.nwb_file = nwb_file
+        self.memmap = memmap
         self.pipeline_version = None
 
+        self._h5_file = None
+        self._h5_file_kwargs = None
+        self._open_count = 0
+        self._open_lock = threading.RLock()
+        self._cache = {}
+        self._shared_arrays = weakref.WeakValueDictionary()
+
         if os.path.exists(self.nwb_file):
             meta = self.get_metadata()
             if meta and 'pipeline_version' in meta:
@@ -153,6 +190,141 @@ class BrainObservatoryNwbDataSet(object):
 
         self._stimulus_search = None
 
+    def open(self, rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=None):
+        ''' Keep a single read-only handle to the NWB file open until close()
+        is called.  While the handle is open every accessor reads through it
+        instead of opening and closing the file again.  Calls nest: the file
+        is closed when close() has been called once per call to open().
+
+        This is usually used as a context manager:
+
+            with BrainObservatoryNwbDataSet(path) as data_set:
+                ...
+
+        Parameters
+        ----------
+        rdcc_nbytes: int (optional)
+            Size of the raw data chunk cache in bytes.  Defaults to RDCC_NBYTES.
+
+        rdcc_nslots: int (optional)
+            Number of chunk slots in the cache hash table; should be a prime.
+            Defaults to RDCC_NSLOTS.
+
+        rdcc_w0: float (optional)
+            Chunk cache preemption policy.  Defaults to RDCC_W0.
+
+        Returns
+        -------
+        self
+        '''
+
+        with self._open_lock:
+            if self._h5_file is None:
+                kwargs = {}
+                if parse_version(h5py.__version__) >= parse_version("2.9"):
+                    kwargs = {
+                        'rdcc_nbytes': self.RDCC_NBYTES if rdcc_nbytes is None else rdcc_nbytes,
+                        'rdcc_nslots': self.RDCC_NSLOTS if rdcc_nslots is None else rdcc_nslots,
+                        'rdcc_w0': self.RDCC_W0 if rdcc_w0 is None else rdcc_w0
+                    }
+                self._h5_file = h5py.File(self.nwb_file, 'r', **kwargs)
+                self._h5_file_kwargs = kwargs
+
+            self._open_count += 1
+
+        return self
+
+    def close(self):
+        ''' Release the handle held open by open(). '''
+
+        with self._open_lock:
+            if self._open_count > 0:
+                self._open_count -= 1
+
+            if self._open_count == 0 and self._h5_file is not None:
+                self._h5_file.close()
+                self._h5_file = None
+
+    @property
+    def is_open(self):
+        ''' True if a persistent handle to the NWB file is being held open '''
+        return self._h5_file is not None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        # open h5py handles cannot be pickled; a copy starts out closed
+        state = self.__dict__.copy()
+        state['_h5_file'] = None
+        state['_h5_file_kwargs'] = None
+        state['_open_count'] = 0
+        del state['_open_lock']
+        del state['_shared_arrays']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_lock = threading.RLock()
+        self._shared_arrays = weakref.WeakValueDictionary()
+
+    @contextlib.contextmanager
+    def _open_nwb(self):
+        ''' Yields the persistent handle if there is one, otherwise opens the
+        file for the duration of the block.  The persistent handle is
+        borrowed with a counted reference, so another thread leaving its
+        own open()/close() block cannot close it mid-read.
+        '''
+
+        with self._open_lock:
+            f = self._h5_file
+            if f is not None:
+                self.open()
+
+        if f is not None:
+            try:
+                yield f
+            finally:
+                self.close()
+        else:
+            with h5py.File(self.nwb_file, 'r') as f:
+                yield f
+
+    def _get_cached(self, key, loader):
+        ''' Memoizes immutable values read from the file on this instance. '''
+
+        if key not in self._cache:
+            self._cache[key] = loader()
+        return self._cache[key]
+
+    def _get_shared(self, keys, loader):
+        ''' Returns read-only arrays shared between callers in memmap mode.
+        Only weak references are kept, so the arrays are released once the
+        last caller drops them.  loader returns one array per key.
+        '''
+
+        arrays = [ self._shared_arrays.get(key) for key in keys ]
+
+        if any(array is None for array in arrays):
+            arrays = loader()
+            for key, array in zip(keys, arrays):
+                array.setflags(write=False)
+                self._shared_arrays[key] = array
+
+        return arrays
+
+    def _read_dataset(self, ds):
+        ''' Reads a whole dataset, sharing it in memmap mode '''
+
+        if not self.memmap:
+            return ds.value
+
+        array, = self._get_shared((ds.name,), lambda: (map_dataset(ds, self.nwb_file),))
+        return array
+
     def get_stimulus_epoch_table(self):
         '''Returns a pandas dataframe that summarizes the stimulus epoch duration for each acquisition time index in
         the experiment
@@ -228,7 +400,7 @@ class BrainObservatoryNwbDataSet(object):
         return interval_df
 
 
-    def get_fluorescence_traces(self, cell_specimen_ids=None):
+    def get_fluorescence_traces(self, cell_specimen_ids=None, start_frame=None, end_frame=None):
         ''' Returns an array of fluorescence traces for all ROI and
         the timestamps for each datapoint
 
@@ -238,6 +410,13 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return traces for. If this is None (default)
             then all are returned
 
+        start_frame: int (optional)
+            Index of the first frame to return. Defaults to the first frame
+
+        end_frame: int (optional)
+            Index one past the last frame to return. Defaults to the end of
+            the session
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -246,28 +425,29 @@ class BrainObservatoryNwbDataSet(object):
         traces: 2D numpy array
             Fluorescence traces for each cell
         '''
-        timestamps = self.get_fluorescence_timestamps()
-        with h5py.File(self.nwb_file, 'r') as f:
+        timestamps = self.get_fluorescence_timestamps()[start_frame:end_frame]
+        with self._open_nwb() as f:
             ds = f['processing'][self.PIPELINE_DATASET][
                 'Fluorescence']['imaging_plane_1']['data']
 
-            if cell_specimen_ids is None:
-                cell_traces = ds.value
-            else:
-                inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                cell_traces = ds[inds, :]
+            cell_traces = self._read_cell_rows(ds, cell_specimen_ids, start_frame, end_frame)
 
         return timestamps, cell_traces
 
     def get_fluorescence_timestamps(self):
         ''' Returns an array of timestamps in seconds for the fluorescence traces '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        timestamps = self._get_cached('fluorescence_timestamps', self._load_fluorescence_timestamps)
+        return timestamps if self.memmap else timestamps.copy()
+
+    def _load_fluorescence_timestamps(self):
+        with self._open_nwb() as f:
             timestamps = f['processing'][self.PIPELINE_DATASET][
                 'Fluorescence']['imaging_plane_1']['timestamps'].value
+        timestamps.setflags(write=False)
         return timestamps
 
-    def get_neuropil_traces(self, cell_specimen_ids=None):
+    def get_neuropil_traces(self, cell_specimen_ids=None, start_frame=None, end_frame=None):
         ''' Returns an array of neuropil fluorescence traces for all ROIs
         and the timestamps for each datapoint
 
@@ -277,6 +457,13 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return traces for. If this is None (default)
             then all are returned
 
+        start_frame: int (optional)
+            Index of the first frame to return. Defaults to the first frame
+
+        end_frame: int (optional)
+            Index one past the last frame to return. Defaults to the end of
+            the session
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -286,9 +473,9 @@ class BrainObservatoryNwbDataSet(object):
             Neuropil fluorescence traces for each cell
         '''
 
-        timestamps = self.get_fluorescence_timestamps()
+        timestamps = self.get_fluorescence_timestamps()[start_frame:end_frame]
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             if self.pipeline_version >= parse_version("2.0"):
                 ds = f['processing'][self.PIPELINE_DATASET][
                     'Fluorescence']['imaging_plane_1_neuropil_response']['data']
@@ -296,11 +483,7 @@ class BrainObservatoryNwbDataSet(object):
                 ds = f['processing'][self.PIPELINE_DATASET][
                     'Fluorescence']['imaging_plane_1']['neuropil_traces']
 
-            if cell_specimen_ids is None:
-                np_traces = ds.value
-            else:
-                inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                np_traces = ds[inds, :]
+            np_traces = self._read_cell_rows(ds, cell_specimen_ids, start_frame, end_frame)
 
         return timestamps, np_traces
 
@@ -320,7 +503,7 @@ class BrainObservatoryNwbDataSet(object):
             Scalar for neuropil subtraction for each cell
         '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             if self.pipeline_version >= parse_version("2.0"):
                 r_ds = f['processing'][self.PIPELINE_DATASET][
                     'Fluorescence']['imaging_plane_1_neuropil_response']['r']
@@ -328,15 +511,11 @@ class BrainObservatoryNwbDataSet(object):
                 r_ds = f['processing'][self.PIPELINE_DATASET][
                     'Fluorescence']['imaging_plane_1']['r']
 
-            if cell_specimen_ids is None:
-                r = r_ds.value
-            else:
-                inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                r = r_ds[inds]
+            r = self._read_cell_rows(r_ds, cell_specimen_ids)
 
         return r
 
-    def get_demixed_traces(self, cell_specimen_ids=None):
+    def get_demixed_traces(self, cell_specimen_ids=None, start_frame=None, end_frame=None):
         ''' Returns an array of demixed fluorescence traces for all ROIs
         and the timestamps for each datapoint
 
@@ -346,6 +525,13 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return traces for. If this is None (default)
             then all are returned
 
+        start_frame: int (optional)
+            Index of the first frame to return. Defaults to the first frame
+
+        end_frame: int (optional)
+            Index one past the last frame to return. Defaults to the end of
+            the session
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -355,20 +541,17 @@ class BrainObservatoryNwbDataSet(object):
             Demixed fluorescence traces for each cell
         '''
 
-        timestamps = self.get_fluorescence_timestamps()
+        timestamps = self.get_fluorescence_timestamps()[start_frame:end_frame]
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             ds = f['processing'][self.PIPELINE_DATASET][
                 'Fluorescence']['imaging_plane_1_demixed_signal']['data']
-            if cell_specimen_ids is None:
-                traces = ds.value
-            else:
-                inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                traces = ds[inds, :]
+
+            traces = self._read_cell_rows(ds, cell_specimen_ids, start_frame, end_frame)
 
         return timestamps, traces
 
-    def get_corrected_fluorescence_traces(self, cell_specimen_ids=None):
+    def get_corrected_fluorescence_traces(self, cell_specimen_ids=None, start_frame=None, end_frame=None):
         ''' Returns an array of demixed and neuropil-corrected fluorescence traces
         for all ROIs and the timestamps for each datapoint
 
@@ -378,6 +561,13 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return traces for. If this is None (default)
             then all are returned
 
+        start_frame: int (optional)
+            Index of the first frame to return. Defaults to the first frame
+
+        end_frame: int (optional)
+            Index one past the last frame to return. Defaults to the end of
+            the session
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -387,15 +577,25 @@ class BrainObservatoryNwbDataSet(object):
             Corrected fluorescence traces for each cell
         '''
 
-        # starting in version 2.0, neuropil correction follows trace demixing
-        if self.pipeline_version >= parse_version("2.0"):
-            timestamps, cell_traces = self.get_demixed_traces(cell_specimen_ids)
-        else:
-            timestamps, cell_traces = self.get_fluorescence_traces(cell_specimen_ids)
+        if self.memmap and cell_specimen_ids is None and start_frame is None and end_frame is None:
+            timestamps = self.get_fluorescence_timestamps()
+            fc, = self._get_shared(('corrected_fluorescence',),
+                                   lambda: (self._load_corrected_fluorescence_traces()[1],))
+            return timestamps, fc
 
-        r = self.get_neuropil_r(cell_specimen_ids)
+        return self._load_corrected_fluorescence_traces(cell_specimen_ids, start_frame, end_frame)
 
-        _, neuropil_traces = self.get_neuropil_traces(cell_specimen_ids)
+    def _load_corrected_fluorescence_traces(self, cell_specimen_ids=None, start_frame=None, end_frame=None):
+        with self:
+            # starting in version 2.0, neuropil correction follows trace demixing
+            if self.pipeline_version >= parse_version("2.0"):
+                timestamps, cell_traces = self.get_demixed_traces(cell_specimen_ids, start_frame, end_frame)
+            else:
+                timestamps, cell_traces = self.get_fluorescence_traces(cell_specimen_ids, start_frame, end_frame)
+
+            r = self.get_neuropil_r(cell_specimen_ids)
+
+            _, neuropil_traces = self.get_neuropil_traces(cell_specimen_ids, start_frame, end_frame)
 
         fc = cell_traces - neuropil_traces * r[:, np.newaxis]
 
@@ -410,17 +610,42 @@ class BrainObservatoryNwbDataSet(object):
 
         '''
 
-        all_cell_specimen_ids = list(self.get_cell_specimen_ids())
-        
+        index = self._get_cached('cell_specimen_index', self._build_cell_specimen_index)
+
         try:
-            inds = [list(all_cell_specimen_ids).index(i)
-                    for i in cell_specimen_ids]
-        except ValueError as e:
-            raise ValueError("Cell specimen not found (%s)" % str(e))
+            inds = [index[i] for i in cell_specimen_ids]
+        except KeyError as e:
+            raise ValueError("Cell specimen not found (%s is not in list)" % str(e))
 
         return inds
 
-    def get_dff_traces(self, cell_specimen_ids=None):
+    def _build_cell_specimen_index(self):
+        # first occurrence wins, as with list.index
+        all_cell_specimen_ids = self.get_cell_specimen_ids()
+        return { csid: i for i, csid in reversed(list(enumerate(all_cell_specimen_ids))) }
+
+    def _read_cell_rows(self, ds, cell_specimen_ids=None, start_frame=None, end_frame=None):
+        ''' Reads the rows of a (cells,) or (cells, frames) dataset belonging to
+        the requested cells, optionally restricted to a window of frames.
+        '''
+
+        window = (slice(start_frame, end_frame),) if len(ds.shape) > 1 else ()
+
+        if self.memmap:
+            data = self._read_dataset(ds)
+            if cell_specimen_ids is None:
+                if start_frame is None and end_frame is None:
+                    return data
+                return data[(slice(None),) + window]
+            return data[(self.get_cell_specimen_indices(cell_specimen_ids),) + window]
+
+        if cell_specimen_ids is None:
+            return ds[(slice(None),) + window]
+
+        inds = self.get_cell_specimen_indices(cell_specimen_ids)
+        return read_dataset_rows(ds, inds, window)
+
+    def get_dff_traces(self, cell_specimen_ids=None, start_frame=None, end_frame=None):
         ''' Returns an array of dF/F traces for all ROIs and
         the timestamps for each datapoint
 
@@ -430,6 +655,13 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return data for. If this is None (default)
             then all are returned
 
+        start_frame: int (optional)
+            Index of the first frame to return. Defaults to the first frame
+
+        end_frame: int (optional)
+            Index one past the last frame to return. Defaults to the end of
+            the session
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -438,17 +670,16 @@ class BrainObservatoryNwbDataSet(object):
         dF/F: 2D numpy array
             dF/F values for each cell
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             dff_ds = f['processing'][self.PIPELINE_DATASET][
                 'DfOverF']['imaging_plane_1']
 
-            timestamps = dff_ds['timestamps'].value
-
-            if cell_specimen_ids is None:
-                cell_traces = dff_ds['data'].value
+            if self.memmap:
+                timestamps = self._read_dataset(dff_ds['timestamps'])[start_frame:end_frame]
             else:
-                inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                cell_traces = dff_ds['data'][inds, :]
+                timestamps = dff_ds['timestamps'][start_frame:end_frame]
+
+            cell_traces = self._read_cell_rows(dff_ds['data'], cell_specimen_ids, start_frame, end_frame)
 
         return timestamps, cell_traces
 
@@ -459,7 +690,7 @@ class BrainObservatoryNwbDataSet(object):
         -------
         ROI IDs: list
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             roi_id = f['processing'][self.PIPELINE_DATASET][
                 'ImageSegmentation']['roi_ids'].value
         return roi_id
@@ -471,7 +702,11 @@ class BrainObservatoryNwbDataSet(object):
         -------
         cell specimen IDs: list
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
+
+        return self._get_cached('cell_specimen_ids', self._load_cell_specimen_ids).copy()
+
+    def _load_cell_specimen_ids(self):
+        with self._open_nwb() as f:
             cell_id = f['processing'][self.PIPELINE_DATASET][
                 'ImageSegmentation']['cell_specimen_ids'].value
         return cell_id
@@ -484,7 +719,11 @@ class BrainObservatoryNwbDataSet(object):
         -------
         session type: string
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
+
+        return self._get_cached('session_type', self._load_session_type)
+
+    def _load_session_type(self):
+        with self._open_nwb() as f:
             session_type = f['general/session_type'].value
         return session_type.decode('utf-8')
 
@@ -496,7 +735,7 @@ class BrainObservatoryNwbDataSet(object):
         max projection: np.ndarray
         '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             max_projection = f['processing'][self.PIPELINE_DATASET]['ImageSegmentation'][
                 'imaging_plane_1']['reference_images']['maximum_intensity_projection_image']['data'].value
         return max_projection
@@ -509,7 +748,10 @@ class BrainObservatoryNwbDataSet(object):
         stimuli: list of strings
         '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        return list(self._get_cached('stimuli', self._load_stimuli))
+
+    def _load_stimuli(self):
+        with self._open_nwb() as f:
             keys = list(f["stimulus/presentation/"].keys())
         return [ k.replace('_stimulus', '') for k in keys ]
 
@@ -519,6 +761,11 @@ class BrainObservatoryNwbDataSet(object):
         sub-tables describing presentation of each stimulus
         '''
 
+        with self:
+            return self._build_master_stimulus_table()
+
+    def _build_master_stimulus_table(self):
+
         epoch_table = self.get_stimulus_epoch_table()
 
         stimulus_table_dict = {}
@@ -554,9 +801,9 @@ class BrainObservatoryNwbDataSet(object):
         '''
 
         if stimulus_name == 'master':
-            return self._get_master_stimulus_table()
+            return self._get_cached('master_stimulus_table', self._get_master_stimulus_table).copy()
 
-        with h5py.File(self.nwb_file, 'r') as nwb_file:
+        with self._open_nwb() as nwb_file:
 
             stimulus_group = _find_stimulus_presentation_group(nwb_file, stimulus_name)
 
@@ -595,7 +842,7 @@ class BrainObservatoryNwbDataSet(object):
         stimulus table: pd.DataFrame
         '''
         stim_name = stimulus_name + "_image_stack"
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             image_stack = f['stimulus']['templates'][stim_name]['data'].value
         return image_stack
 
@@ -694,7 +941,7 @@ class BrainObservatoryNwbDataSet(object):
             List of ROI_Mask objects
         '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             mask_loc = f['processing'][self.PIPELINE_DATASET][
                 'ImageSegmentation']['imaging_plane_1']
             roi_list = f['processing'][self.PIPELINE_DATASET][
@@ -736,7 +983,7 @@ class BrainObservatoryNwbDataSet(object):
 
         meta = {}
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             for memory_key, disk_key in BrainObservatoryNwbDataSet.FILE_METADATA_MAPPING.items():
                 try:
                     v = f[disk_key].value
@@ -803,7 +1050,15 @@ class BrainObservatoryNwbDataSet(object):
     def get_running_speed(self):
         ''' Returns the mouse running speed in cm/s
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
+
+        if self.memmap:
+            return tuple(self._get_shared(('running_speed', 'running_speed_timestamps'),
+                                          self._load_running_speed))
+
+        return self._load_running_speed()
+
+    def _load_running_speed(self):
+        with self._open_nwb() as f:
             dx_ds = f['processing'][self.PIPELINE_DATASET][
                 'BehavioralTimeSeries']['running_speed']
             dxcm = dx_ds['data'].value
@@ -841,7 +1096,7 @@ class BrainObservatoryNwbDataSet(object):
         else:
             location_key = "pupil_location"
         try:
-            with h5py.File(self.nwb_file, 'r') as f:
+            with self._open_nwb() as f:
                 eye_tracking = f['processing'][self.PIPELINE_DATASET][
                     'EyeTracking'][location_key]
                 pupil_location = eye_tracking['data'].value
@@ -861,7 +1116,7 @@ class BrainObservatoryNwbDataSet(object):
             Areas is an (Nx1) array of pupil areas in pixels.
         '''
         try:
-            with h5py.File(self.nwb_file, 'r') as f:
+            with self._open_nwb() as f:
                 pupil_tracking = f['processing'][self.PIPELINE_DATASET][
                     'PupilTracking']['pupil_size']
                 pupil_size = pupil_tracking['data'].value
@@ -876,7 +1131,7 @@ class BrainObservatoryNwbDataSet(object):
         '''
 
         motion_correction = None
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._open_nwb() as f:
             pipeline_ds = f['processing'][self.PIPELINE_DATASET]
 
             # pipeline 0.9 stores this in xy_translations
@@ -902,18 +1157,39 @@ class BrainObservatoryNwbDataSet(object):
 
         return motion_correction
 
+    @contextlib.contextmanager
+    def _released(self):
+        ''' Temporarily closes the persistent read handle so that the file
+        can be opened for writing, then reopens it with the same settings.
+        '''
+
+        with self._open_lock:
+            if self._h5_file is None:
+                yield
+            else:
+                kwargs = self._h5_file_kwargs
+                self._h5_file.close()
+                self._h5_file = None
+                try:
+                    yield
+                finally:
+                    self._h5_file = h5py.File(self.nwb_file, 'r', **kwargs)
+                    self._h5_file_kwargs = kwargs
+
     def save_analysis_dataframes(self, *tables):
-        store = pd.HDFStore(self.nwb_file, mode='a')
-        for k, v in tables:
-            store.put('analysis/%s' % (k), v)
-        store.close()
+        with self._released():
+            store = pd.HDFStore(self.nwb_file, mode='a')
+            for k, v in tables:
+                store.put('analysis/%s' % (k), v)
+            store.close()
 
     def save_analysis_arrays(self, *datasets):
-        with h5py.File(self.nwb_file, 'a') as f:
-            for k, v in datasets:
-                if k in f['analysis']:
-                    del f['analysis'][k]
-                f.create_dataset('analysis/%s' % k, data=v)
+        with self._released():
+            with h5py.File(self.nwb_file, 'a') as f:
+                for k, v in datasets:
+                    if k in f['analysis']:
+                        del f['analysis'][k]
+                    f.create_dataset('analysis/%s' % k, data=v)
 
     @property
     def stimulus_search(self):
@@ -923,9 +1199,32 @@ class BrainObservatoryNwbDataSet(object):
         return self._stimulus_search
 
     def get_stimulus(self, frame_ind):
+        ''' Returns the stimulus presented at an acquisition frame.
+
+        Parameters
+        ----------
+        frame_ind: int or array-like
+            Acquisition frame index, or an array of them
+
+        Returns
+        -------
+        tuple: (search result, template frame).  The search result is the
+        matching (start, end, row) interval of the master stimulus table.  The
+        template frame is None for gratings.  Both are None for spontaneous
+        activity and unregistered frames.  If frame_ind is an array, returns a
+        tuple of two lists with one entry per frame.
+        '''
 
         search_result = self.stimulus_search.search(frame_ind)
 
+        if np.ndim(frame_ind) == 0:
+            return self._stimulus_from_search_result(search_result)
+
+        stimuli = [self._stimulus_from_search_result(r) for r in search_result]
+        return [x[0] for x in stimuli], [x[1] for x in stimuli]
+
+    def _stimulus_from_search_result(self, search_result):
+
         if search_result is None or search_result[2]['stimulus'] == si.SPONTANEOUS_ACTIVITY:
             return None, None
 
@@ -935,10 +1234,138 @@ class BrainObservatoryNwbDataSet(object):
             if curr_stimulus in si.LOCALLY_SPARSE_NOISE_STIMULUS_TYPES + si.NATURAL_MOVIE_STIMULUS_TYPES + [si.NATURAL_SCENES]:
                 curr_frame = search_result[2]['frame']
                 return search_result, self.get_stimulus_template(curr_stimulus)[int(curr_frame), :, :]
-            elif curr_stimulus == si.STATIC_GRATINGS or curr_stimulus == si.DRIFTING_GRATINGS:
+            else:
                 return search_result, None
 
 
+    def get_stimulus_frames(self, frame_indices, chunk_size=None, monitor=None):
+        ''' Generates the stimulus presented at each of an array of acquisition
+        frames, a chunk at a time.
+
+        All frames are resolved to stimulus table rows with one lookup.  For
+        template stimuli (locally sparse noise, natural scenes and natural movies)
+        only the template frames needed by a chunk are read from the file.
+        Grating frames are rendered on demand with monitor.grating_to_screen,
+        as float32 screen-sized images.  Because these are much larger than
+        template frames, grating chunks are further limited to
+        RENDERED_FRAME_CHUNK_NBYTES (at least one frame per chunk).
+        Each chunk covers consecutive entries of frame_indices that show the
+        same stimulus.
+
+        Parameters
+        ----------
+        frame_indices: array-like
+            Acquisition frame indices
+
+        chunk_size: int (optional)
+            Maximum number of frames per chunk.  Defaults to STIMULUS_FRAME_CHUNK_SIZE.
+            A chunk of template frames takes chunk_size * rows * columns bytes
+            (uint8 templates); a chunk of grating frames takes at most
+            RENDERED_FRAME_CHUNK_NBYTES.
+
+        monitor: stimulus_info.Monitor (optional)
+            Monitor used to render gratings.  Defaults to a BrainObservatoryMonitor.
+
+        Returns
+        -------
+        generator of tuples: (positions, stimulus, frames).  positions are
+        the indices of the chunk's entries in frame_indices.  stimulus is the
+        stimulus name.  frames is a (# positions, rows, columns) array.
+        stimulus and frames are None for spontaneous activity and unregistered
+        frames.
+        '''
+        if chunk_size is None:
+            chunk_size = self.STIMULUS_FRAME_CHUNK_SIZE
+
+        frame_indices = np.asarray(frame_indices).reshape(-1)
+        if frame_indices.size == 0:
+            return
+
+        search = self.stimulus_search
+        inds = search.search_indices(frame_indices)
+
+        rows = [None] + [x[2] for x in search.master_bst.data]
+        stimuli = np.array([None if row is None or row['stimulus'] == si.SPONTANEOUS_ACTIVITY
+                            else row['stimulus'] for row in rows], dtype=object)[inds + 1]
+
+        run_starts = np.flatnonzero(stimuli[1:] != stimuli[:-1]) + 1
+        run_bounds = np.concatenate([[0], run_starts, [len(stimuli)]]).astype(int)
+
+        template_stimuli = si.LOCALLY_SPARSE_NOISE_STIMULUS_TYPES + si.NATURAL_MOVIE_STIMULUS_TYPES + [si.NATURAL_SCENES]
+
+        with self:
+            for run_start, run_end in zip(run_bounds[:-1], run_bounds[1:]):
+                stimulus = stimuli[run_start]
+
+                run_chunk_size = chunk_size
+                if stimulus in (si.STATIC_GRATINGS, si.DRIFTING_GRATINGS):
+                    if monitor is None:
+                        monitor = si.BrainObservatoryMonitor()
+                    frame_nbytes = monitor.n_pixels_r * monitor.n_pixels_c * np.dtype(np.float32).itemsize
+                    run_chunk_size = max(1, min(chunk_size, self.RENDERED_FRAME_CHUNK_NBYTES // frame_nbytes))
+
+                for chunk_start in range(run_start, run_end, run_chunk_size):
+                    positions = np.arange(chunk_start, min(chunk_start + run_chunk_size, run_end))
+                    chunk_rows = [rows[ind + 1] for ind in inds[positions]]
+
+                    if stimulus is None:
+                        yield positions, None, None
+                    elif stimulus in template_stimuli:
+                        template_frames = np.array([int(row['frame']) for row in chunk_rows])
+                        yield positions, stimulus, self._read_template_frames(stimulus, template_frames)
+                    elif stimulus in (si.STATIC_GRATINGS, si.DRIFTING_GRATINGS):
+                        yield positions, stimulus, self._render_grating_frames(stimulus, frame_indices[positions],
+                                                                               chunk_rows, monitor)
+                    else:
+                        yield positions, stimulus, None
+
+    def _read_template_frames(self, stimulus, template_frames):
+        ''' Reads the requested frames of a stimulus template, touching only the
+        distinct frames needed, in increasing order. '''
+
+        needed, inverse = np.unique(template_frames, return_inverse=True)
+
+        with self._open_nwb() as f:
+            ds = f['stimulus']['templates'][stimulus + "_image_stack"]['data']
+            data = ds[needed.tolist()]
+
+        return data[inverse]
+
+    def _render_grating_frames(self, stimulus, frame_indices, rows, monitor):
+        ''' Renders the grating shown at each acquisition frame.  Drifting
+        gratings advance their phase by temporal_frequency cycles per second
+        since the start of the sweep.  Blank sweeps are uniform gray. '''
+
+        if stimulus == si.DRIFTING_GRATINGS:
+            timestamps = self.get_fluorescence_timestamps()
+
+        frames = np.empty((len(rows), monitor.n_pixels_r, monitor.n_pixels_c), dtype=np.float32)
+        last_key, image = None, None
+
+        for i, (frame_index, row) in enumerate(zip(frame_indices, rows)):
+            orientation = row['orientation']
+
+            if stimulus == si.DRIFTING_GRATINGS:
+                spatial_frequency = si.DRIFTING_GRATINGS_SPATIAL_FREQUENCY
+                elapsed = timestamps[int(frame_index)] - timestamps[int(row['start'])]
+                phase = (elapsed * row['temporal_frequency']) % 1
+            else:
+                spatial_frequency = row['spatial_frequency']
+                phase = row['phase']
+
+            key = (orientation, spatial_frequency, phase)
+            if not np.all(np.isfinite(key)):
+                frames[i] = si.STIMULUS_GRAY
+                continue
+
+            # consecutive frames of a static grating sweep share one rendering
+            if key != last_key:
+                last_key, image = key, monitor.grating_to_screen(phase, spatial_frequency, orientation)
+            frames[i] = image
+
+        return frames
+
+
 def _find_stimulus_presentation_group(nwb_file,
                                       stimulus_name, 
                                       base_path=_STIMULUS_PRESENTATION_PATH, 
@@ -984,6 +1411,90 @@ def _find_stimulus_presentation_group(nwb_file,
     return matches[0]
 
 
+def map_dataset(ds, file_name=None):
+    ''' Returns a read-only view of a whole h5py dataset without copying it
+    when possible.
+
+    Datasets stored contiguously (no chunking, hence no compression or other
+    filters) with a native byte order are memory-mapped from their offset in
+    the file.  Any other dataset is read into a new read-only array.
+
+    Parameters
+    ----------
+    ds : h5py.Dataset
+        Dataset to map
+    file_name : str, optional
+        Path of the file holding the dataset. Defaults to ds.file.filename
+
+    Returns
+    -------
+    np.ndarray or np.memmap :
+        Read-only array with the contents of the dataset
+
+    '''
+
+    offset = None
+    if ds.chunks is None and ds.size > 0 and ds.dtype.isnative and not ds.dtype.hasobject:
+        offset = ds.id.get_offset()
+
+    if offset is None:
+        array = ds.value
+        if isinstance(array, np.ndarray):
+            array.setflags(write=False)
+        return array
+
+    if file_name is None:
+        file_name = ds.file.filename
+
+    return np.memmap(file_name, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+
+
+def read_dataset_rows(ds, inds, window=(), max_gap_fraction=1.0):
+    ''' Reads rows of an h5py dataset in an arbitrary order, with repeats.
+
+    h5py only accepts strictly increasing index lists and reads them one
+    selection at a time, so the requested rows are sorted and deduplicated
+    before reading and put back into the requested order afterwards.  When
+    the requested rows cover most of the range between the smallest and
+    largest of them, that whole range is read as a single slab instead.
+
+    Parameters
+    ----------
+    ds : h5py.Dataset or np.ndarray
+        Dataset to read from
+    inds : array-like of int
+        Rows to read
+    window : tuple of slice, optional
+        Selection applied to the remaining axes, e.g. (slice(start, end),)
+    max_gap_fraction : float, optional
+        A slab is read when the number of unrequested rows inside it is at
+        most this fraction of the number of requested rows.
+
+    Returns
+    -------
+    np.ndarray :
+        The selected rows, in the order given by inds
+
+    '''
+
+    inds = np.asarray(inds, dtype=int)
+    window = tuple(window)
+
+    if inds.size == 0:
+        shape = np.empty(ds.shape[1:], dtype=bool)[window].shape
+        return np.empty((0,) + shape, dtype=ds.dtype)
+
+    unique_inds, inverse = np.unique(inds, return_inverse=True)
+    first, last = unique_inds[0], unique_inds[-1] + 1
+
+    if (last - first) - len(unique_inds) <= max_gap_fraction * len(unique_inds):
+        rows = ds[(slice(first, last),) + window][unique_inds - first]
+    else:
+        rows = ds[(unique_inds.tolist(),) + window]
+
+    return rows[inverse]
+
+
 def align_running_speed(dxcm, dxtime, timestamps):
     ''' If running speed timestamps differ from fluorescence
     timestamps, adjust by inserting NaNs to running speed.
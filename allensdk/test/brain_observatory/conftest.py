@@ -0,0 +1,85 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import pytest
+from mock import MagicMock
+import numpy as np
+
+
+@pytest.fixture
+def synthetic_dataset(request):
+    ''' Mock data set with noisy traces, sweep responses and alternating
+    blocks of running and stationary behavior.  Parametrize indirectly with
+    a function taking a np.random.RandomState and returning the stimulus
+    table and a (cells, sweeps) array of response amplitudes, which are
+    added to each cell's trace over each sweep.
+    '''
+    rng = np.random.RandomState(0)
+    stim_table, gains = request.param(rng)
+    number_cells = gains.shape[0]
+
+    number_frames = stim_table.end.max() + 100
+    traces = 1.0 + 0.05 * rng.randn(number_cells, number_frames)
+    for sweep, (start, end) in enumerate(zip(stim_table.start, stim_table.end)):
+        traces[:, start:end] += gains[:, sweep, np.newaxis]
+
+    block = max(20, int(np.median(stim_table.end - stim_table.start)))
+    dxcm = np.repeat(rng.rand(number_frames // block + 1) > 0.5, block)[:number_frames] * 10.0
+    dxcm += rng.rand(number_frames) * 0.8 - 0.1
+
+    timestamps = np.arange(number_frames) / 30.0
+
+    dataset = MagicMock(name='dataset')
+    dataset.get_corrected_fluorescence_traces = MagicMock(return_value=(timestamps, traces))
+    dataset.get_dff_traces = MagicMock(return_value=(timestamps, traces))
+    dataset.get_running_speed = MagicMock(return_value=(dxcm, timestamps))
+    dataset.get_stimulus_table = MagicMock(return_value=stim_table)
+    dataset.get_cell_specimen_ids = MagicMock(return_value=np.arange(number_cells) + 1000)
+
+    return dataset
+
+
+@pytest.fixture
+def assert_peak_matches():
+    ''' Returns a function comparing a typed peak table to a legacy one. '''
+
+    def check(peak, expected):
+        assert list(peak.columns) == list(expected.columns)
+        assert not np.any(peak.dtypes == object)
+
+        for column in expected.columns:
+            assert np.allclose(peak[column].values, expected[column].values.astype(float), equal_nan=True)
+
+    return check
@@ -40,6 +40,7 @@ import pytest
 
 from scipy.ndimage.interpolation import zoom
 import scipy.stats as stats
+import scipy.ndimage.filters as filt
 import numpy as np
 
 from allensdk.brain_observatory.receptive_field_analysis import chisquarerf as chi
@@ -307,3 +308,30 @@ def test_locate_median():
     
     obt = chi.locate_median(*where)
     assert(np.allclose( obt , [4, 4] ))
+
+
+def test_chi_square_within_masks(exclusion_mask, events_per_pixel, trials_per_pixel):
+
+    trials_per_pixel = trials_per_pixel.copy()
+    trials_per_pixel[2:, :, 1] = 3
+
+    masks = np.array([ exclusion_mask[:, :, 0], 1 - exclusion_mask[:, :, 0], np.ones((4, 4)) ])
+    obt_p, _ = chi.chi_square_within_masks(masks, events_per_pixel, trials_per_pixel)
+
+    for ii, mask in enumerate(masks):
+        mask = np.repeat(mask[:, :, np.newaxis], 2, axis=2)
+        exp_p, _ = chi.chi_square_within_mask(mask, events_per_pixel, trials_per_pixel)
+        assert(np.allclose( obt_p[:, ii], exp_p ))
+
+
+def test_smooth_sta_stack():
+
+    stack = np.random.RandomState(0).rand(3, 2, 8, 14)
+    obt = chi.smooth_STA(stack)
+
+    # upsample, blur and downsample each image separately
+    for ii in range(3):
+        for jj in range(2):
+            interp = chi.interpolate_RF(stack[ii, jj], 8)
+            exp = chi.deinterpolate_RF(filt.gaussian_filter(interp, 0.75), 14, 8, 8)
+            assert(np.allclose( obt[ii, jj], exp ))
@@ -0,0 +1,111 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import pytest
+import numpy as np
+import pandas as pd
+import scipy.stats as sps
+from mock import MagicMock
+
+from allensdk.brain_observatory.receptive_field_analysis import eventdetection
+from allensdk.brain_observatory.receptive_field_analysis.utilities import smooth
+
+
+def legacy_detect_events(dff_trace, stimulus_table):
+    dff_trace = smooth(dff_trace, 5)
+
+    var_list = []
+    for ii, fi in enumerate(stimulus_table['start'].values):
+        if ii > 0 and stimulus_table.iloc[ii].start == stimulus_table.iloc[ii-1].end:
+            offset = 1
+        else:
+            offset = 0
+
+        trace = dff_trace[fi+1+offset:fi+11+offset]
+        xx = (trace - trace[0])[3] - (trace - trace[0])[0]
+        yy = max((trace - trace[0])[5] - (trace - trace[0])[2],
+                 (trace - trace[0])[6] - (trace - trace[0])[3],
+                 (trace - trace[0])[7] - (trace - trace[0])[4])
+        var_list.append((trace[-1], xx, yy))
+
+    tf, xx, yy = [np.array(v) for v in zip(*var_list)]
+    xx_centered = xx - np.median(xx)
+    yy_centered = yy - np.median(yy)
+
+    q = 100*(1-2*(1-sps.norm.cdf(1)))
+    std_x = np.percentile(np.abs(xx_centered), q)
+    std_y = np.percentile(np.abs(yy_centered), q)
+
+    inds = np.sqrt((xx_centered/std_x)**2+(yy_centered/std_y)**2) < 4
+    Cov_Factor_Inv = np.linalg.inv(np.linalg.cholesky(np.cov(xx_centered[inds], yy_centered[inds])))
+    noise_threshold = max(4 * std_x + np.median(xx), 4 * std_y + np.median(yy))
+
+    z = Cov_Factor_Inv.dot(np.array([xx_centered, yy_centered]))
+    return (np.sqrt((z**2).sum(axis=0)) > 4) & (yy > .05) & (xx < yy) & (tf > noise_threshold/2)
+
+
+@pytest.fixture
+def lsn_data():
+    rng = np.random.RandomState(0)
+    number_of_trials = 500
+    starts = np.cumsum(rng.choice([7, 8], number_of_trials)) + 30
+    ends = starts + 7
+    ends[::5] -= 1
+
+    dff = 0.02 * rng.randn(4, ends[-1] + 40)
+    for trace in dff:
+        for start in starts[rng.rand(number_of_trials) < .05]:
+            trace[start + 3:start + 20] += (.3 + rng.rand()) * np.exp(-np.arange(17) / 8.)
+
+    data = MagicMock()
+    data.get_stimulus_table.return_value = pd.DataFrame({'start': starts, 'end': ends})
+    data.get_dff_traces.return_value = (None, dff)
+
+    return data
+
+
+def test_detect_events_all_cells(lsn_data):
+    dff = lsn_data.get_dff_traces()[1]
+    stimulus_table = lsn_data.get_stimulus_table('locally_sparse_noise')
+
+    events = eventdetection.detect_events_all_cells(lsn_data, 'locally_sparse_noise')
+    assert lsn_data.get_dff_traces.call_count == 2
+
+    assert events.shape == (4, len(stimulus_table))
+    assert events.sum() > 0
+    for cell_index in range(4):
+        expected = legacy_detect_events(dff[cell_index], stimulus_table)
+        assert np.array_equal(events[cell_index], expected)
+        assert np.array_equal(eventdetection.detect_events(lsn_data, cell_index, 'locally_sparse_noise'), expected)
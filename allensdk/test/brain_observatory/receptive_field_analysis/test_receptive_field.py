@@ -0,0 +1,136 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import pytest
+import numpy as np
+import pandas as pd
+from mock import patch, MagicMock
+
+from allensdk.brain_observatory.receptive_field_analysis import receptive_field
+from allensdk.brain_observatory.receptive_field_analysis.utilities import get_A
+from allensdk.brain_observatory.locally_sparse_noise import LocallySparseNoise
+import allensdk.brain_observatory.stimulus_info as si
+
+
+class FakeLsnDataSet(object):
+    ''' Small picklable stand-in for a locally sparse noise session. '''
+
+    def __init__(self, number_of_cells=4, number_of_trials=150, seed=0):
+        rng = np.random.RandomState(seed)
+
+        template = np.full((30, 8, 14), 127, dtype=np.uint8)
+        for frame in template:
+            frame.flat[rng.choice(frame.size, 20, replace=False)] = rng.choice([0, 255], 20)
+
+        starts = 20 + 7 * np.arange(number_of_trials)
+        self.stimulus_table = pd.DataFrame({'frame': rng.randint(0, len(template), number_of_trials),
+                                            'start': starts,
+                                            'end': starts + 7})
+        self.template = template
+        self.number_of_cells = number_of_cells
+
+        # each cell responds to one pixel turning on
+        dff = 0.02 * rng.randn(number_of_cells, starts[-1] + 40)
+        for cell in range(number_of_cells):
+            pixel = rng.randint(template[0].size)
+            for frame, start in zip(self.stimulus_table.frame, starts):
+                if template[frame].flat[pixel] == 255:
+                    dff[cell, start + 6:start + 13] += 1.0
+        self.dff = dff
+
+    def get_stimulus_table(self, stimulus):
+        return self.stimulus_table
+
+    def get_stimulus_template(self, stimulus):
+        return self.template
+
+    def get_dff_traces(self):
+        return np.arange(self.dff.shape[1]) / 30.0, self.dff
+
+
+def _get_A_blur(data, stimulus):
+    # the gaussian-blurred design matrix is not needed to compare serial and parallel runs
+    return get_A(data, stimulus)
+
+
+def _skip_postprocessing(data, rf):
+    return rf
+
+
+@pytest.mark.parametrize('n_jobs', [2, 3])
+def test_compute_receptive_fields_n_jobs(n_jobs):
+    data = FakeLsnDataSet()
+    cell_indices = [0, 1, 2, 3]
+    permuted = [2, 0, 3, 1]
+
+    with patch.object(receptive_field, 'get_A_blur', _get_A_blur), \
+            patch.object(receptive_field, 'run_postprocessing', _skip_postprocessing):
+        serial = receptive_field.compute_receptive_fields_with_postprocessing(
+            data, cell_indices, si.LOCALLY_SPARSE_NOISE, n_jobs=1, alpha=.05, number_of_shuffles=200)
+        parallel = receptive_field.compute_receptive_fields_with_postprocessing(
+            data, cell_indices, si.LOCALLY_SPARSE_NOISE, n_jobs=n_jobs, alpha=.05, number_of_shuffles=200)
+        parallel_permuted = receptive_field.compute_receptive_fields_with_postprocessing(
+            data, permuted, si.LOCALLY_SPARSE_NOISE, n_jobs=n_jobs, alpha=.05, number_of_shuffles=200)
+
+    assert any(rf['event_vector']['data'].any() for rf in serial)
+
+    by_cell = dict(zip(permuted, parallel_permuted))
+    for cell_index, expected, actual in zip(cell_indices, serial, parallel):
+        for rf in (actual, by_cell[cell_index]):
+            assert rf['attrs']['cell_index'] == cell_index
+            assert np.array_equal(rf['event_vector']['data'], expected['event_vector']['data'])
+            for on_off in ('on', 'off'):
+                assert rf[on_off]['pvalues']['data'].shape == (8, 14)
+                assert np.array_equal(rf[on_off]['pvalues']['data'], expected[on_off]['pvalues']['data'])
+                assert np.array_equal(rf[on_off]['fdr_corrected']['data'], expected[on_off]['fdr_corrected']['data'])
+
+
+def test_compute_receptive_fields_empty():
+    assert receptive_field.compute_receptive_fields_with_postprocessing(
+        FakeLsnDataSet(), [], si.LOCALLY_SPARSE_NOISE, n_jobs=2, alpha=.05) == []
+
+
+@pytest.mark.parametrize('n_jobs', [1, 4, None])
+def test_locally_sparse_noise_n_jobs(n_jobs):
+    data = FakeLsnDataSet()
+    lsn = LocallySparseNoise(data, si.LOCALLY_SPARSE_NOISE_8DEG, n_jobs=n_jobs)
+
+    compute = MagicMock(return_value=[{'attrs': {}} for _ in range(data.number_of_cells)])
+    with patch('allensdk.brain_observatory.locally_sparse_noise.compute_receptive_fields_with_postprocessing',
+               compute):
+        rf_data = lsn.get_receptive_field_analysis_data()
+
+    assert compute.call_args[1]['n_jobs'] == n_jobs
+    assert sorted(rf_data.keys()) == [str(i) for i in range(data.number_of_cells)]
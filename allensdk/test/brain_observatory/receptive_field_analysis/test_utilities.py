@@ -0,0 +1,67 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import pytest
+import numpy as np
+
+from allensdk.brain_observatory.receptive_field_analysis import utilities
+
+
+def legacy_shuffle_matrix(event_vector, A, number_of_shuffles, random_state):
+    number_of_events = event_vector.sum()
+    shuffle_data = np.zeros((A.shape[0], number_of_shuffles))
+    for ii in range(number_of_shuffles):
+        size = number_of_events + int(np.round(.1*number_of_events*random_state.randn()))
+        shuffled_event_inds = random_state.choice(range(len(event_vector)), size=size, replace=False)
+
+        b_tmp = np.zeros(len(event_vector), dtype=np.bool)
+        b_tmp[shuffled_event_inds] = True
+        shuffle_data[:, ii] = A[:, b_tmp].sum(axis=1)/float(size)
+
+    return shuffle_data
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 1000])
+def test_get_shuffle_matrix(block_size):
+    random_state = np.random.RandomState(3)
+    A = random_state.rand(20, 300)
+    event_vector = random_state.rand(300) < .1
+
+    expected = legacy_shuffle_matrix(event_vector, A, 25, np.random.RandomState(1))
+    obtained = utilities.get_shuffle_matrix(None, event_vector, A, number_of_shuffles=25,
+                                            random_state=np.random.RandomState(1),
+                                            block_size=block_size)
+
+    assert np.allclose(expected, obtained)
@@ -0,0 +1,142 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from mock import MagicMock
+
+from allensdk.brain_observatory.checkpoint_store import CheckpointStore, file_hash, parameter_fingerprint
+from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
+
+
+@pytest.fixture
+def nwb_file(tmpdir_factory):
+    nwb_file = tmpdir_factory.mktemp('nwb').join('session.nwb')
+    nwb_file.write('not really an nwb file')
+    return str(nwb_file)
+
+
+@pytest.fixture
+def store(tmpdir_factory, nwb_file):
+    path = str(tmpdir_factory.mktemp('checkpoints').join('checkpoint.h5'))
+    return CheckpointStore(path, nwb_file)
+
+
+def test_parameter_fingerprint():
+    assert parameter_fingerprint({'a': 1, 'b': 2}) == parameter_fingerprint({'b': 2, 'a': 1})
+    assert parameter_fingerprint({'a': 1}) != parameter_fingerprint({'a': 2})
+
+
+def test_round_trip(store):
+    sweep_response = pd.DataFrame({'0': [np.arange(3), np.arange(4)]})
+    value = (sweep_response, np.arange(12.).reshape(3, 4), {'x': [1, 2]}, 0.5)
+
+    store.put('drifting_gratings', 'sweep_response', value)
+    obtained = store.get('drifting_gratings', 'sweep_response')
+
+    assert isinstance(obtained, tuple)
+    assert np.array_equal(obtained[0]['0'][1], np.arange(4))
+    assert np.array_equal(obtained[1], value[1])
+    assert obtained[2] == value[2]
+    assert obtained[3] == value[3]
+
+
+def test_keys(store, nwb_file):
+    store.put('drifting_gratings', 'peak', np.arange(3), params={'binsize': 800})
+
+    assert store.has('drifting_gratings', 'peak', params={'binsize': 800})
+    assert not store.has('drifting_gratings', 'peak', params={'binsize': 400})
+    assert not store.has('static_gratings', 'peak', params={'binsize': 800})
+
+    # a different nwb file does not see these results
+    other = CheckpointStore(store.path, nwb_file, nwb_hash='0' * 32)
+    assert not other.has('drifting_gratings', 'peak', params={'binsize': 800})
+
+    assert store.nwb_hash == file_hash(nwb_file)
+
+    with pytest.raises(KeyError):
+        store.get('drifting_gratings', 'response')
+
+
+def test_get_or_compute(store):
+    func = MagicMock(return_value=np.ones(4))
+
+    first = store.get_or_compute('natural_scenes', 'response', func)
+    second = store.get_or_compute('natural_scenes', 'response', func)
+
+    func.assert_called_once_with()
+    assert np.array_equal(first, second)
+
+
+def test_corrupt_checkpoint_file(store):
+    # e.g. a file truncated by a process killed mid-write
+    with open(store.path, 'wb') as f:
+        f.write(np.random.RandomState(0).bytes(5000))
+
+    assert not store.has('natural_scenes', 'response')
+    with pytest.raises(KeyError):
+        store.get('natural_scenes', 'response')
+
+    func = MagicMock(return_value=np.arange(3))
+    value = store.get_or_compute('natural_scenes', 'response', func)
+
+    func.assert_called_once_with()
+    assert np.array_equal(value, np.arange(3))
+    assert np.array_equal(store.get('natural_scenes', 'response'), np.arange(3))
+    assert os.path.exists(store.path + '.corrupt')
+
+
+class CountingAnalysis(StimulusAnalysis):
+    calls = 0
+
+    def get_peak(self):
+        CountingAnalysis.calls += 1
+        return pd.DataFrame({'peak': [1.0, 2.0]})
+
+
+def test_stimulus_analysis_checkpoint(store):
+    data_set = MagicMock()
+
+    first = CountingAnalysis(data_set, checkpoint_store=store)
+    assert first.peak['peak'].tolist() == [1.0, 2.0]
+
+    second = CountingAnalysis(data_set, checkpoint_store=store)
+    assert second.peak['peak'].tolist() == [1.0, 2.0]
+    assert CountingAnalysis.calls == 1
+
+    assert store.has('CountingAnalysis', 'peak', second.checkpoint_params)
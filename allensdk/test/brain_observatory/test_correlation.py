@@ -0,0 +1,103 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import allensdk.brain_observatory.correlation as corr
+import numpy as np
+import pytest
+import scipy.stats as st
+
+
+@pytest.fixture
+def rows():
+    x = np.random.RandomState(0).randint(0, 6, size=(9, 15)).astype(float)
+    x[2] = 3 # constant variable
+    x[6, 4] = np.nan
+
+    return x
+
+
+def test_rank_rows(rows):
+    ranks = corr.rank_rows(rows)
+
+    for row, rank in zip(rows, ranks):
+        if np.isnan(row).any():
+            assert np.all(np.isnan(rank))
+        else:
+            assert np.allclose(rank, st.rankdata(row))
+
+
+DEGENERATE_ROWS = (2, 6)
+
+
+@pytest.mark.parametrize('method,pairwise', [('pearson', st.pearsonr),
+                                             ('spearman', st.spearmanr)])
+@pytest.mark.parametrize('chunk_size', [None, 1, 4])
+def test_correlation_matrix(rows, method, pairwise, chunk_size):
+    c, p = corr.correlation_matrix(rows, corr=method, chunk_size=chunk_size)
+
+    assert np.allclose(c, c.T, equal_nan=True)
+    for i in range(len(rows)):
+        for j in range(len(rows)):
+            if i in DEGENERATE_ROWS or j in DEGENERATE_ROWS:
+                continue
+            expected = pairwise(rows[i], rows[j])
+            assert np.allclose([c[i, j], p[i, j]], expected)
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1, 4])
+def test_pearson_matrix_degenerate_rows(rows, chunk_size):
+    c, p = corr.pearson_matrix(rows, chunk_size=chunk_size)
+
+    # undefined correlations are NaN with p = 1
+    for i in DEGENERATE_ROWS:
+        assert np.all(np.isnan(c[i])) and np.all(np.isnan(c[:, i]))
+        assert np.all(p[i] == 1.0) and np.all(p[:, i] == 1.0)
+
+    # self correlations are (up to rounding) perfect
+    assert np.allclose(p[np.diag_indices(len(rows))][[0, 1, 3, 4, 5, 7, 8]], 0.0)
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1, 4])
+def test_spearman_matrix_degenerate_rows(rows, chunk_size):
+    c, p = corr.spearman_matrix(rows, chunk_size=chunk_size)
+
+    for i in DEGENERATE_ROWS:
+        assert np.all(np.isnan(c[i])) and np.all(np.isnan(c[:, i]))
+        assert np.all(np.isnan(p[i])) and np.all(np.isnan(p[:, i]))
+
+
+def test_correlation_matrix_bad_method(rows):
+    with pytest.raises(Exception):
+        corr.correlation_matrix(rows, corr='kendall')
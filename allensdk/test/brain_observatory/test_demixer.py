@@ -0,0 +1,100 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+import pytest
+import scipy.linalg as linalg
+import scipy.sparse as sparse
+
+import allensdk.brain_observatory.demixer as demixer
+
+
+def legacy_demix_time_dep_masks(raw_traces, stack, masks):
+    N, T = raw_traces.shape
+    num_pixels_in_mask = np.sum(masks, axis=(1, 2))
+    F = (raw_traces.T * num_pixels_in_mask).T
+    flat_masks = sparse.csr_matrix(masks.reshape(N, -1))
+    stack = stack.reshape(T, -1)
+
+    demix_traces = np.zeros((N, T))
+    drop_frames = []
+    for t in range(T):
+        if np.any(F[:, t] != 0):
+            norm_mat = sparse.diags(num_pixels_in_mask / F[:, t], offsets=0)
+            flat_weighted_masks = norm_mat.dot(flat_masks.dot(sparse.diags(stack[t], offsets=0)))
+            overlap = flat_masks.dot(flat_weighted_masks.T).toarray()
+            demix_traces[:, t] = linalg.solve(overlap, F[:, t])
+            drop_frames.append(False)
+        else:
+            drop_frames.append(True)
+
+    return demix_traces, drop_frames
+
+
+@pytest.fixture
+def masks():
+    masks = np.zeros((5, 10, 12), dtype=bool)
+    masks[0, 1:4, 1:4] = True
+    masks[1, 2:6, 3:6] = True
+    masks[2, 5:8, 5:7] = True
+    masks[3, 7:9, 9:11] = True
+    masks[4, 0:2, 9:12] = True
+
+    return masks
+
+
+def test_get_overlap_components(masks):
+    overlapping, isolated = demixer.get_overlap_components(sparse.csr_matrix(masks.reshape(5, -1)))
+
+    assert len(overlapping) == 1
+    assert np.array_equal(overlapping[0], [0, 1, 2])
+    assert np.array_equal(isolated, [3, 4])
+
+
+@pytest.mark.parametrize('block_size,n_jobs', [(1000, 1), (7, 1), (7, 2)])
+def test_demix_time_dep_masks(masks, block_size, n_jobs):
+    rng = np.random.RandomState(0)
+    stack = rng.rand(30, 10, 12) + 1
+    stack[4] = 0
+
+    raw_traces = np.einsum('nij,tij->nt', masks, stack) / masks.sum(axis=(1, 2)).reshape(-1, 1)
+    raw_traces *= rng.rand(*raw_traces.shape) + 0.5
+
+    expected, expected_drop_frames = legacy_demix_time_dep_masks(raw_traces, stack, masks)
+    obtained, obtained_drop_frames = demixer.demix_time_dep_masks(raw_traces, stack, masks,
+                                                                  block_size=block_size, n_jobs=n_jobs)
+
+    assert np.allclose(expected, obtained)
+    assert expected_drop_frames == obtained_drop_frames
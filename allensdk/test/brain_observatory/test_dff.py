@@ -39,6 +39,7 @@ import pytest
 from functools import partial
 from matplotlib.pyplot import Figure
 from mock import patch, MagicMock
+from scipy.ndimage.filters import median_filter
 
 
 def test_movingmode_fast():
@@ -131,6 +132,51 @@ def test_compute_dff_windowed_median():
     assert len(small_frames) == 1
 
 
+def test_compute_dff_windowed_median_n_jobs():
+    x = np.sin(np.arange(0, 200) / np.arange(1, 6).reshape(5, 1)) + 2
+    x += np.random.RandomState(0).rand(5, 200)
+
+    kwargs = dict(median_kernel_long=101, median_kernel_short=11, noise_kernel_length=5)
+
+    noise_stds = []
+    small_frames = []
+    expected = np.array([ dff.compute_dff_windowed_median(row.reshape(1, -1), **kwargs)[0] for row in x ])
+    for row in x:
+        dff.compute_dff_windowed_median(row.reshape(1, -1), noise_stds=noise_stds,
+                                        n_small_baseline_frames=small_frames, **kwargs)
+
+    for n_jobs in [1, 2]:
+        obt_noise_stds = []
+        obt_small_frames = []
+        obtained = dff.compute_dff_windowed_median(x, noise_stds=obt_noise_stds,
+                                                   n_small_baseline_frames=obt_small_frames,
+                                                   n_jobs=n_jobs, **kwargs)
+
+        assert np.array_equal(expected, obtained)
+        assert np.array_equal(noise_stds, obt_noise_stds)
+        assert np.array_equal(small_frames, obt_small_frames)
+
+
+@pytest.mark.parametrize('step', [1, 4, 7])
+def test_strided_median_filter(step):
+    x = np.random.RandomState(0).rand(2, 300) + 1
+    kernel_size = 51
+
+    obtained = dff.strided_median_filter(x, kernel_size, step)
+    assert obtained.shape == x.shape
+
+    # each value lies within step // 2 ranks of the exact median
+    padded = np.zeros((2, 300 + kernel_size - 1))
+    padded[:, kernel_size // 2:-(kernel_size // 2)] = x
+    for row in range(2):
+        for ii in range(300):
+            window = np.sort(padded[row, ii:ii + kernel_size])
+            assert window[kernel_size // 2 - step // 2] <= obtained[row, ii] <= window[kernel_size // 2 + step // 2]
+
+    if step == 1:
+        assert np.array_equal(obtained, median_filter(x, (1, kernel_size), mode='constant'))
+
+
 def test_calculate_dff():
     x = np.array([[1, 5, -2, 3, 1, 10, 1, -2, 30, 5]], dtype=float)
 
@@ -141,7 +187,7 @@ def test_calculate_dff():
                 dff.calculate_dff(x)
     assert mock_makedirs.call_count == 0
     assert mock_save.call_count == 0
-    mock_computation.assert_called_once_with(x)
+    mock_computation.assert_called_once_with(x, n_jobs=1)
 
     with patch("os.makedirs") as mock_makedirs:
         with patch.object(Figure, "savefig") as mock_save:
@@ -165,3 +211,63 @@ def test_calculate_dff():
     dff.calculate_dff(x, dff_computation_cb=computation_cb)
     assert len(noise_stds) == 1
     assert len(small_frames) == 1
+
+
+def test_movingmode_fast_batch():
+    x = np.random.RandomState(0).randn(5, 300) * 4 + np.arange(5).reshape(5, 1) * 3 - 6
+    kernelsize = 40
+
+    expected = np.zeros(x.shape)
+    for row, y in zip(x, expected):
+        dff.movingmode_fast(row, kernelsize, y)
+
+    obtained = np.zeros(x.shape)
+    dff.movingmode_fast(x, kernelsize, obtained)
+
+    assert np.array_equal(expected, obtained)
+
+
+def legacy_movingaverage(x, kernelsize, y):
+    halfsize = int(kernelsize / 2)
+    sumkernel = np.sum(x[0:halfsize])
+    for m in range(0, halfsize):
+        sumkernel = sumkernel + x[m + halfsize]
+        y[m] = sumkernel / (halfsize + m)
+
+    sumkernel = np.sum(x[0:kernelsize])
+    for m in range(halfsize, x.shape[0] - halfsize):
+        sumkernel = sumkernel - x[m - halfsize] + x[m + halfsize]
+        y[m] = sumkernel / kernelsize
+
+    for m in range(x.shape[0] - halfsize, x.shape[0]):
+        sumkernel = sumkernel - x[m - halfsize]
+        y[m] = sumkernel / (halfsize - 1 + (x.shape[0] - m))
+
+
+@pytest.mark.parametrize('kernelsize', [4, 5, 30])
+@pytest.mark.parametrize('dtype', [float, np.float32, int])
+def test_movingaverage(kernelsize, dtype):
+    x = (np.random.RandomState(0).rand(3, 100) * 100).astype(dtype)
+
+    expected = np.zeros(x.shape)
+    for row, y in zip(x, expected):
+        legacy_movingaverage(row, kernelsize, y)
+
+    obtained = np.zeros(x.shape)
+    dff.movingaverage(x, kernelsize, obtained)
+
+    assert np.array_equal(expected, obtained)
+
+
+def test_compute_dff_windowed_mode_batch():
+    x = np.random.RandomState(0).randn(7, 500) * 10 + 200
+    x[2, 10] = np.nan
+
+    expected = dff.compute_dff_windowed_mode(x, 100, 50, batch_size=1)
+    obtained = dff.compute_dff_windowed_mode(x, 100, 50, batch_size=3)
+
+    assert np.all(np.isnan(obtained[2]))
+    assert np.array_equal(expected[~np.isnan(expected)], obtained[~np.isnan(obtained)])
+
+    with pytest.raises(ValueError):
+        dff.compute_dff_windowed_mode(x, 100, 50, batch_size=0)
@@ -38,6 +38,9 @@ from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
 
 import pytest
 from mock import patch, MagicMock
+import numpy as np
+import pandas as pd
+import scipy.stats as st
 
 
 @pytest.fixture
@@ -162,3 +165,102 @@ def test_harness(dataset, trigger):
 
     assert dg._dxcm is DriftingGratings._PRELOAD
     assert dg._dxtime is DriftingGratings._PRELOAD
+
+
+def drifting_gratings_stimulus(rng):
+    number_cells = 6
+
+    conditions = [(ori, tf) for ori in range(0, 360, 45) for tf in (1, 2, 4, 8, 15)] * 8
+    conditions += [(np.nan, np.nan)] * 10
+    conditions = [conditions[i] for i in rng.permutation(len(conditions))]
+
+    starts = 100 + 90 * np.arange(len(conditions))
+    stim_table = pd.DataFrame({'orientation': [c[0] for c in conditions],
+                               'temporal_frequency': [c[1] for c in conditions],
+                               'start': starts,
+                               'end': starts + 60})
+
+    gains = np.zeros((number_cells, len(stim_table)))
+    for nc in range(number_cells):
+        preferred = (stim_table.orientation == 45 * nc).values
+        gains[nc, preferred] = 0.3 * rng.rand(preferred.sum())
+
+    return stim_table, gains
+
+
+def legacy_get_peak(dg):
+    peak = pd.DataFrame(index=range(dg.numbercells), columns=('ori_dg', 'tf_dg', 'reliability_dg',
+                                                              'osi_dg', 'dsi_dg', 'peak_dff_dg',
+                                                              'ptest_dg', 'p_run_dg', 'run_modulation_dg',
+                                                              'cv_os_dg', 'cv_ds_dg', 'tf_index_dg',
+                                                              'cell_specimen_id'))
+    cids = dg.data_set.get_cell_specimen_ids()
+    stim_table = dg.stim_table
+    msr = dg.mean_sweep_response
+
+    orivals_rad = np.deg2rad(dg.orivals)
+    for nc in range(dg.numbercells):
+        cell_peak = np.where(dg.response[:, 1:, nc, 0] == np.nanmax(dg.response[:, 1:, nc, 0]))
+        prefori = cell_peak[0][0]
+        preftf = cell_peak[1][0] + 1
+        peak.cell_specimen_id.iloc[nc] = cids[nc]
+        peak.ori_dg.iloc[nc] = prefori
+        peak.tf_dg.iloc[nc] = preftf
+
+        pref = dg.response[prefori, preftf, nc, 0]
+        orth = (dg.response[np.mod(prefori + 2, 8), preftf, nc, 0] +
+                dg.response[np.mod(prefori - 2, 8), preftf, nc, 0]) / 2
+        null = dg.response[np.mod(prefori + 4, 8), preftf, nc, 0]
+
+        tuning = dg.response[:, preftf, nc, 0]
+        tuning = np.where(tuning > 0, tuning, 0)
+        peak.cv_os_dg.iloc[nc] = np.abs((tuning * np.exp(1j * 2 * orivals_rad)).sum()) / tuning.sum()
+        peak.cv_ds_dg.iloc[nc] = np.abs((tuning * np.exp(1j * orivals_rad)).sum()) / tuning.sum()
+        peak.osi_dg.iloc[nc] = (pref - orth) / (pref + orth)
+        peak.dsi_dg.iloc[nc] = (pref - null) / (pref + null)
+        peak.peak_dff_dg.iloc[nc] = pref
+
+        groups = []
+        for ori in dg.orivals:
+            for tf in dg.tfvals[1:]:
+                groups.append(msr[(stim_table.temporal_frequency == tf) & (stim_table.orientation == ori)][str(nc)])
+        groups.append(msr[stim_table.temporal_frequency == 0][str(nc)])
+        _, peak.ptest_dg.iloc[nc] = st.f_oneway(*groups)
+
+        pref_rows = (stim_table.temporal_frequency == dg.tfvals[preftf]) & \
+            (stim_table.orientation == dg.orivals[prefori])
+        subset = msr[pref_rows]
+        subset_stat = subset[subset.dx < 1]
+        subset_run = subset[subset.dx >= 1]
+        if (len(subset_run) > 2) & (len(subset_stat) > 2):
+            _, peak.p_run_dg.iloc[nc] = st.ttest_ind(subset_run[str(nc)], subset_stat[str(nc)], equal_var=False)
+            run_mean, stat_mean = subset_run[str(nc)].mean(), subset_stat[str(nc)].mean()
+            if run_mean > stat_mean:
+                peak.run_modulation_dg.iloc[nc] = (run_mean - stat_mean) / np.abs(run_mean)
+            elif run_mean < stat_mean:
+                peak.run_modulation_dg.iloc[nc] = -1 * ((stat_mean - run_mean) / np.abs(stat_mean))
+
+        subset = dg.sweep_response[pref_rows]
+        corr_matrix = np.empty((len(subset), len(subset)))
+        for i in range(len(subset)):
+            for j in range(len(subset)):
+                corr_matrix[i, j], _ = st.pearsonr(subset[str(nc)].iloc[i][30:90], subset[str(nc)].iloc[j][30:90])
+        corr_matrix[np.tril_indices(len(subset))] = np.nan
+        peak.reliability_dg.iloc[nc] = np.nanmean(corr_matrix)
+
+        tf_tuning = dg.response[prefori, 1:, nc, 0]
+        trials = msr[(stim_table.temporal_frequency != 0) &
+                     (stim_table.orientation == dg.orivals[prefori])][str(nc)].values
+        sse_part = np.sqrt(np.sum((trials - trials.mean()) ** 2) / (len(trials) - 5))
+        peak.tf_index_dg.iloc[nc] = np.ptp(tf_tuning) / (np.ptp(tf_tuning) + 2 * sse_part)
+
+    return peak
+
+
+@pytest.mark.parametrize('synthetic_dataset', [drifting_gratings_stimulus], indirect=True)
+def test_get_peak_regression(synthetic_dataset, assert_peak_matches):
+    dg = DriftingGratings(synthetic_dataset)
+    peak = dg.get_peak()
+
+    assert_peak_matches(peak, legacy_get_peak(dg))
+    assert peak.p_run_dg.notnull().any()
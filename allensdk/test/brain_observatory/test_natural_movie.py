@@ -37,7 +37,9 @@ from allensdk.brain_observatory.natural_movie import NaturalMovie
 from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
 import pytest
 from mock import patch, MagicMock
+import numpy as np
 import pandas as pd
+import scipy.stats as st
 
 
 @pytest.fixture
@@ -142,3 +144,76 @@ def test_harness(dataset, trigger):
 
     assert nm._dxcm is NaturalMovie._PRELOAD
     assert nm._dxtime is NaturalMovie._PRELOAD
+
+
+def natural_movie_stimulus(rng):
+    number_cells = 5
+    movie_length = 90
+
+    # the stimulus table has one row per movie frame; repeats start at frame 0
+    starts = 50 + np.arange(10) * (movie_length + 3)
+    stim_table = pd.DataFrame({'frame': np.tile(np.arange(movie_length), 10),
+                               'start': (starts[:, np.newaxis] + np.arange(movie_length)).ravel()})
+    stim_table['end'] = stim_table['start'] + 1
+
+    movie_response = rng.rand(number_cells, movie_length) * np.arange(number_cells)[:, np.newaxis]
+    gains = np.tile(movie_response, 10)
+
+    return stim_table, gains
+
+
+def legacy_get_sweep_response(nm):
+    sweep_response = pd.DataFrame(index=nm.stim_table.index.values,
+                                  columns=np.array(range(nm.numbercells)).astype(str))
+    for index, row in nm.stim_table.iterrows():
+        for nc in range(nm.numbercells):
+            sweep_response[str(nc)][index] = nm.dfftraces[nc, row.start:row.start + nm.sweeplength]
+    return sweep_response
+
+
+def legacy_get_peak(nm):
+    peak_movie = pd.DataFrame(index=range(nm.numbercells), columns=('peak', 'response_reliability', 'cell_specimen_id'))
+    cids = nm.data_set.get_cell_specimen_ids()
+    sweep_response = legacy_get_sweep_response(nm)
+
+    for nc in range(nm.numbercells):
+        peak_movie.cell_specimen_id.iloc[nc] = cids[nc]
+        peak_movie.peak.iloc[nc] = np.argmax(sweep_response[str(nc)].mean())
+
+        corr_matrix = np.empty((10, 10))
+        for i in range(10):
+            for j in range(10):
+                corr_matrix[i, j], _ = st.pearsonr(sweep_response[str(nc)].iloc[i], sweep_response[str(nc)].iloc[j])
+        corr_matrix[np.tril_indices(10)] = np.nan
+        peak_movie.response_reliability.iloc[nc] = np.nanmean(corr_matrix)
+
+    return peak_movie
+
+
+@pytest.mark.parametrize('synthetic_dataset', [natural_movie_stimulus], indirect=True)
+def test_get_sweep_response_regression(synthetic_dataset):
+    nm = NaturalMovie(synthetic_dataset, 'natural_movie_one')
+
+    expected = legacy_get_sweep_response(nm)
+    sweep_response = nm.get_sweep_response()
+
+    assert nm.sweep_response_tensor.shape == (10, 5, nm.sweeplength)
+    assert list(sweep_response.columns) == list(expected.columns)
+    assert list(sweep_response.index) == list(expected.index)
+    for (i, j), trace in np.ndenumerate(expected.values):
+        assert np.array_equal(sweep_response.values[i, j], trace)
+
+
+@pytest.mark.parametrize('synthetic_dataset', [natural_movie_stimulus], indirect=True)
+def test_get_peak_regression(synthetic_dataset):
+    nm = NaturalMovie(synthetic_dataset, 'natural_movie_one')
+
+    expected = legacy_get_peak(nm)
+    peak = nm.get_peak()
+
+    assert list(peak.columns) == ['peak_nm1', 'response_reliability_nm1', 'cell_specimen_id']
+    assert not np.any(peak.dtypes == object)
+
+    assert np.array_equal(peak.peak_nm1.values, expected.peak.values.astype(int))
+    assert np.allclose(peak.response_reliability_nm1.values, expected.response_reliability.values.astype(float))
+    assert np.array_equal(peak.cell_specimen_id.values, expected.cell_specimen_id.values.astype(int))
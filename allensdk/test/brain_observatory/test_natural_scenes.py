@@ -37,6 +37,9 @@ from allensdk.brain_observatory.natural_scenes import NaturalScenes
 from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
 import pytest
 from mock import patch, MagicMock
+import numpy as np
+import pandas as pd
+import scipy.stats as st
 
 
 @pytest.fixture
@@ -161,3 +164,98 @@ def test_harness(dataset, trigger):
 
     assert ns._dxcm is NaturalScenes._PRELOAD
     assert ns._dxtime is NaturalScenes._PRELOAD
+
+
+def natural_scenes_stimulus(rng):
+    number_cells = 6
+    number_images = 118
+
+    frames = np.repeat(np.arange(-1, number_images), 20)
+    frames = frames[rng.permutation(len(frames))]
+
+    starts = 100 + 7 * np.arange(len(frames))
+    stim_table = pd.DataFrame({'frame': frames,
+                               'start': starts,
+                               'end': starts + 7})
+
+    image_gains = 0.3 * rng.rand(number_cells, number_images)
+    gains = image_gains[:, frames] * rng.rand(number_cells, len(frames))
+    gains[:, frames < 0] = 0
+
+    return stim_table, gains
+
+
+def legacy_get_peak(ns):
+    peak = pd.DataFrame(index=range(ns.numbercells), columns=('scene_ns', 'reliability_ns', 'peak_dff_ns',
+                                                              'ptest_ns', 'p_run_ns', 'run_modulation_ns',
+                                                              'time_to_peak_ns',
+                                                              'cell_specimen_id', 'image_selectivity_ns'))
+    cids = ns.data_set.get_cell_specimen_ids()
+    stim_table = ns.stim_table
+    msr = ns.mean_sweep_response
+
+    for nc in range(ns.numbercells):
+        nsp = np.argmax(ns.response[1:, nc, 0])
+        peak.cell_specimen_id.iloc[nc] = cids[nc]
+        peak.scene_ns.iloc[nc] = nsp
+        peak.peak_dff_ns.iloc[nc] = ns.response[nsp + 1, nc, 0]
+
+        groups = [msr[stim_table.frame == (im - 1)][str(nc)].values for im in range(ns.number_scenes)]
+        _, peak.ptest_ns.iloc[nc] = st.f_oneway(*groups)
+
+        test = ns.sweep_response[stim_table.frame == nsp][str(nc)].mean()
+        peak.time_to_peak_ns.iloc[nc] = (np.argmax(test) - ns.interlength) / ns.acquisition_rate
+
+        subset = msr[stim_table.frame == nsp]
+        subset_run = subset[subset.dx >= 1]
+        subset_stat = subset[subset.dx < 1]
+        if (len(subset_run) > 4) & (len(subset_stat) > 4):
+            _, peak.p_run_ns.iloc[nc] = st.ttest_ind(subset_run[str(nc)], subset_stat[str(nc)], equal_var=False)
+            run_mean, stat_mean = subset_run[str(nc)].mean(), subset_stat[str(nc)].mean()
+            if run_mean > stat_mean:
+                peak.run_modulation_ns.iloc[nc] = (run_mean - stat_mean) / np.abs(run_mean)
+            elif run_mean < stat_mean:
+                peak.run_modulation_ns.iloc[nc] = -1 * ((stat_mean - run_mean) / np.abs(stat_mean))
+
+        subset = ns.sweep_response[stim_table.frame == nsp]
+        corr_matrix = np.empty((len(subset), len(subset)))
+        for i in range(len(subset)):
+            for j in range(len(subset)):
+                corr_matrix[i, j], _ = st.pearsonr(subset[str(nc)].iloc[i][28:42], subset[str(nc)].iloc[j][28:42])
+        corr_matrix[np.tril_indices(len(subset))] = np.nan
+        peak.reliability_ns.iloc[nc] = np.nanmean(corr_matrix)
+
+        fmin = ns.response[1:, nc, 0].min()
+        fmax = ns.response[1:, nc, 0].max()
+        rtj = np.empty((1000, 1))
+        for j in range(1000):
+            thresh = fmin + j * ((fmax - fmin) / 1000.)
+            rtj[j] = (ns.response[1:119, nc, 0] > thresh).mean()
+        peak.image_selectivity_ns.iloc[nc] = 1 - (2 * rtj.mean())
+
+    return peak
+
+
+@pytest.mark.parametrize('synthetic_dataset', [natural_scenes_stimulus], indirect=True)
+def test_get_peak_regression(synthetic_dataset, assert_peak_matches):
+    ns = NaturalScenes(synthetic_dataset)
+    peak = ns.get_peak()
+
+    assert_peak_matches(peak, legacy_get_peak(ns))
+    assert peak.p_run_ns.notnull().any()
+
+
+@pytest.mark.parametrize('responses', [
+    np.random.RandomState(1).rand(118, 4),
+    np.tile(np.arange(118.0), (3, 1)).T,
+    np.ones((118, 2)),
+    np.array([[0.0, 0.1 * i] for i in range(11)])
+])
+def test_get_image_selectivity(responses):
+    expected = []
+    for nc in range(responses.shape[1]):
+        fmin, fmax = responses[:, nc].min(), responses[:, nc].max()
+        thresholds = fmin + np.arange(1000) * ((fmax - fmin) / 1000.)
+        expected.append(1 - 2 * (responses[:, nc][:, np.newaxis] > thresholds).mean())
+
+    assert np.allclose(NaturalScenes.get_image_selectivity(responses), expected)
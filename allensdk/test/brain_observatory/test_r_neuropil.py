@@ -0,0 +1,87 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+import pytest
+from scipy.linalg import solve_banded
+
+import allensdk.brain_observatory.r_neuropil as r_neuropil
+
+
+@pytest.fixture
+def traces():
+    rng = np.random.RandomState(0)
+
+    af1 = r_neuropil.alpha_filter()
+    af2 = r_neuropil.alpha_filter(alpha=0.1, beta=0.5)
+
+    F_C = np.array([ np.convolve(af1, rng.rand(400) < 0.05)[:400] for _ in range(3) ])
+    F_N = np.array([ np.convolve(af2, rng.rand(400) < 0.1)[:400] for _ in range(3) ]) + 1
+    r = np.array([ 0.3, 0.8, 1.4 ]).reshape(3, 1)
+
+    return F_C + r * F_N + 0.01 * rng.randn(3, 400), F_N
+
+
+def test_estimate_errors(traces):
+    F_M, F_N = traces
+
+    ns = r_neuropil.NeuropilSubtract()
+    ns.set_F(F_M[0], F_N[0])
+
+    rs = np.array([ 0.0, 0.5, 1.7 ])
+    obtained = ns.estimate_errors(rs)
+
+    for r, error in zip(rs, obtained):
+        fold_errors = []
+        for fi in range(ns.folds):
+            F_C = solve_banded((1, 1), ns.ab, ns.F_M[fi] - r * ns.F_N[fi])
+            fold_errors.append(r_neuropil.error_calc(ns.F_M[fi], ns.F_N[fi], F_C, r))
+
+        assert np.isclose(error, np.mean(fold_errors))
+        assert np.isclose(error, ns.estimate_error(r))
+
+
+@pytest.mark.parametrize('n_jobs,batch_size', [(1, 2), (2, 50)])
+def test_estimate_contamination_ratios_batch(traces, n_jobs, batch_size):
+    F_M, F_N = traces
+
+    expected = [ r_neuropil.estimate_contamination_ratios(m, n) for m, n in zip(F_M, F_N) ]
+    obtained = r_neuropil.estimate_contamination_ratios_batch(F_M, F_N, n_jobs=n_jobs, batch_size=batch_size)
+
+    assert len(obtained) == len(expected)
+    for exp, obt in zip(expected, obtained):
+        assert set(exp) == set(obt)
+        assert np.isclose(exp['r'], obt['r'])
+        assert np.allclose(exp['err_vals'], obt['err_vals'])
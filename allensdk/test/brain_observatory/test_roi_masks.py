@@ -34,6 +34,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import numpy as np
+import pytest
+from scipy.ndimage.morphology import binary_dilation
 import allensdk.brain_observatory.roi_masks as roi_masks
 
 
@@ -77,3 +79,62 @@ def test_init_by_pixels_large():
     npx = len(np.where(a)[0])
     assert npx == len(np.where(m.get_mask_plane())[0])
 
+
+
+def test_create_mask_weight_matrix():
+    a = np.array([[0, 0], [2, 1], [1, 2]])
+    m0 = roi_masks.create_roi_mask(3, 3, [0, 0, 0, 0], pix_list=a)
+    m1 = roi_masks.create_roi_mask(3, 3, [0, 0, 0, 0], pix_list=a[1:])
+
+    weights = roi_masks.create_mask_weight_matrix([m0, m1], 3, 3)
+    assert np.array_equal(weights.toarray().reshape(2, 3, 3),
+                          [m0.get_mask_plane(), m1.get_mask_plane()])
+
+    weights = roi_masks.create_mask_weight_matrix([m0, m1], 3, 3, valid_masks=[False, True])
+    assert weights[0].nnz == 0
+    assert np.array_equal(weights[1].toarray().reshape(3, 3), m1.get_mask_plane())
+
+
+@pytest.mark.parametrize('read_ahead', [False, True])
+def test_calculate_traces(read_ahead):
+    stack = np.random.RandomState(0).rand(25, 10, 12)
+
+    masks = []
+    for left in range(0, 12, 3):
+        array = np.zeros((10, 12), dtype=bool)
+        array[2:5, left:left + 2] = True
+        array[7, left] = True
+        masks.append(roi_masks.create_roi_mask(12, 10, [0, 0, 0, 0], roi_mask=array, label=str(left)))
+    masks[1].mask[:] = False
+
+    traces = roi_masks.calculate_traces(stack, masks, block_size=7, read_ahead=read_ahead)
+
+    for mask, trace in zip(masks, traces):
+        plane = mask.get_mask_plane() > 0
+        if plane.any():
+            assert np.allclose(trace, stack[:, plane].mean(axis=1))
+        else:
+            assert np.all(np.isnan(trace))
+
+
+@pytest.mark.parametrize('border', [[0, 0, 0, 0], [2, 3, 20, 4]])
+def test_create_neuropil_masks(border):
+    h, w = 40, 50
+    rois = []
+    for i, (y, x) in enumerate([(1, 1), (20, 25), (22, 30), (38, 48)]):
+        array = np.zeros((h, w), dtype=bool)
+        array[y:y + 2, x:x + 3] = True
+        rois.append(roi_masks.create_roi_mask(w, h, border, roi_mask=array, label=str(i)))
+    combined = roi_masks.create_roi_mask_array(rois).max(axis=0)
+
+    masks = roi_masks.create_neuropil_masks(rois, border, combined, [r.label for r in rois])
+
+    for roi, mask in zip(rois, masks):
+        # the reference construction dilates over the whole frame
+        dilated = binary_dilation(roi.get_mask_plane() > 0, structure=np.ones((3, 3)), iterations=13)
+        expected = roi_masks.NeuropilMask(w, h, roi.label, roi.mask_group)
+        expected.init_by_mask(border, dilated > combined)
+
+        assert mask.label == roi.label
+        assert (mask.x, mask.y, mask.width, mask.height) == (expected.x, expected.y, expected.width, expected.height)
+        assert np.array_equal(mask.mask, expected.mask)
@@ -37,7 +37,10 @@ import pytest
 from mock import patch
 from allensdk.core.brain_observatory_nwb_data_set import BrainObservatoryNwbDataSet
 from allensdk.brain_observatory.session_analysis import SessionAnalysis
+import allensdk.brain_observatory.session_analysis as sa_module
 import os
+import signal
+import time
 
 
 _orig_get_stimulus_table = BrainObservatoryNwbDataSet.get_stimulus_table
@@ -136,3 +139,121 @@ def test_session_get_session_type_c(session_c):
     session_type = session_c.nwb.get_session_type()
 
     assert session_type == 'three_session_C'
+
+
+@pytest.mark.parametrize('n_threads', [1, 3])
+def test_run_stages(n_threads, tmpdir_factory):
+    save_path = str(tmpdir_factory.mktemp('session').join('out.h5'))
+
+    with patch('allensdk.core.brain_observatory_nwb_data_set.BrainObservatoryNwbDataSet.get_metadata',
+               return_value={}):
+        sa = SessionAnalysis('missing.nwb', save_path, n_threads=n_threads)
+
+    done = []
+    sa.run_stages([(name, lambda name=name: done.append(name)) for name in ['a', 'b', 'c']])
+
+    assert sorted(done) == ['a', 'b', 'c']
+    assert set(sa.stage_timings.keys()) == set(['a', 'b', 'c'])
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_run_session_analyses_failures(n_jobs, tmpdir_factory):
+    save_dir = tmpdir_factory.mktemp('sessions')
+    nwb_paths = ['missing_one.nwb', 'missing_two.nwb']
+    save_paths = [str(save_dir.join('one.h5')), str(save_dir.join('two.h5'))]
+
+    results = sa_module.run_session_analyses(nwb_paths, save_paths, n_jobs=n_jobs)
+
+    assert [r['nwb_path'] for r in results] == nwb_paths
+    for r in results:
+        assert r['metrics'] is None
+        assert r['error'] is not None
+
+
+def test_run_session_analyses(tmpdir_factory):
+    save_dir = tmpdir_factory.mktemp('sessions')
+
+    def fake_run(self, plot_flag=False, save_flag=True):
+        if self.nwb.nwb_file == 'bad.nwb':
+            raise IOError("bad file")
+        self.run_stage('analysis', lambda: None)
+        return self.nwb.nwb_file
+
+    with patch('allensdk.core.brain_observatory_nwb_data_set.BrainObservatoryNwbDataSet.get_metadata',
+               return_value={}), patch.object(SessionAnalysis, 'run', fake_run):
+        results = sa_module.run_session_analyses(['good.nwb', 'bad.nwb'],
+                                                 [str(save_dir.join('good.h5')), str(save_dir.join('bad.h5'))])
+
+    assert results[0]['metrics'] == 'good.nwb'
+    assert results[0]['error'] is None
+    assert list(results[0]['stage_timings'].keys()) == ['analysis']
+
+    assert results[1]['metrics'] is None
+    assert 'bad file' in results[1]['error']
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGKILL'), reason="requires SIGKILL")
+def test_run_session_analyses_dead_workers(tmpdir_factory):
+    save_dir = tmpdir_factory.mktemp('sessions')
+
+    def fake_run(self, plot_flag=False, save_flag=True):
+        if self.nwb.nwb_file == 'killed.nwb':
+            os.kill(os.getpid(), signal.SIGKILL)
+        elif self.nwb.nwb_file == 'hung.nwb':
+            time.sleep(60)
+        return self.nwb.nwb_file
+
+    nwb_paths = ['good.nwb', 'killed.nwb', 'hung.nwb', 'good_too.nwb']
+    save_paths = [str(save_dir.join(os.path.splitext(p)[0] + '.h5')) for p in nwb_paths]
+
+    with patch('allensdk.core.brain_observatory_nwb_data_set.BrainObservatoryNwbDataSet.get_metadata',
+               return_value={}), patch.object(SessionAnalysis, 'run', fake_run):
+        results = sa_module.run_session_analyses(nwb_paths, save_paths, n_jobs=2, session_timeout=3)
+
+    assert [r['nwb_path'] for r in results] == nwb_paths
+    assert results[0]['metrics'] == 'good.nwb'
+    assert results[3]['metrics'] == 'good_too.nwb'
+
+    assert results[1]['metrics'] is None
+    assert 'exited with code' in results[1]['error']
+
+    assert results[2]['metrics'] is None
+    assert 'timed out' in results[2]['error']
+
+
+class _Stop(Exception):
+    pass
+
+
+@pytest.mark.parametrize('session', ['session_c', 'session_c2'])
+@pytest.mark.parametrize('lsn_n_jobs', [1, 8, None])
+def test_lsn_n_jobs(session, lsn_n_jobs, tmpdir_factory):
+    save_path = str(tmpdir_factory.mktemp('sessions').join('out.h5'))
+    calls = []
+
+    def fake_lsn(data_set, stimulus, **kwargs):
+        calls.append(kwargs)
+        raise _Stop()
+
+    with patch('allensdk.core.brain_observatory_nwb_data_set.BrainObservatoryNwbDataSet.get_metadata',
+               return_value={}), patch.object(sa_module, 'LocallySparseNoise', fake_lsn):
+        sa = SessionAnalysis('fake.nwb', save_path, lsn_n_jobs=lsn_n_jobs)
+        with pytest.raises(_Stop):
+            getattr(sa, session)()
+
+    assert calls[0]['n_jobs'] == lsn_n_jobs
+
+
+def test_run_session_analyses_lsn_n_jobs(tmpdir_factory):
+    save_dir = tmpdir_factory.mktemp('sessions')
+
+    def fake_run(self, plot_flag=False, save_flag=True):
+        return self.lsn_n_jobs
+
+    with patch('allensdk.core.brain_observatory_nwb_data_set.BrainObservatoryNwbDataSet.get_metadata',
+               return_value={}), patch.object(SessionAnalysis, 'run', fake_run):
+        results = sa_module.run_session_analyses(['a.nwb', 'b.nwb'],
+                                                 [str(save_dir.join('a.h5')), str(save_dir.join('b.h5'))],
+                                                 n_jobs=2, lsn_n_jobs=4)
+
+    assert [r['metrics'] for r in results] == [4, 4]
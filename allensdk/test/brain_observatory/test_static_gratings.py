@@ -37,6 +37,9 @@ from allensdk.brain_observatory.static_gratings import StaticGratings
 from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
 import pytest
 from mock import patch, MagicMock
+import numpy as np
+import pandas as pd
+import scipy.stats as st
 
 
 @pytest.fixture
@@ -196,3 +199,121 @@ def test_harness(dataset, trigger):
 
     assert sg._dxcm is StaticGratings._PRELOAD
     assert sg._dxtime is StaticGratings._PRELOAD
+
+
+def static_gratings_stimulus(rng):
+    number_cells = 6
+
+    conditions = [(ori, sf, phase)
+                  for ori in range(0, 180, 30)
+                  for sf in (0.02, 0.04, 0.08, 0.16, 0.32)
+                  for phase in (0, 0.25, 0.5, 0.75)] * 12
+    conditions += [(np.nan, np.nan, np.nan)] * 20
+    conditions = [conditions[i] for i in rng.permutation(len(conditions))]
+
+    starts = 100 + 7 * np.arange(len(conditions))
+    stim_table = pd.DataFrame({'orientation': [c[0] for c in conditions],
+                               'spatial_frequency': [c[1] for c in conditions],
+                               'phase': [c[2] for c in conditions],
+                               'start': starts,
+                               'end': starts + 7})
+
+    gains = np.zeros((number_cells, len(stim_table)))
+    for nc in range(number_cells):
+        preferred = ((stim_table.orientation == 30 * nc) & (stim_table.phase == 0.25 * (nc % 4))).values
+        gains[nc, preferred] = 0.3 * rng.rand(preferred.sum())
+
+    return stim_table, gains
+
+
+def legacy_get_peak(sg):
+    peak = pd.DataFrame(index=range(sg.numbercells), columns=('ori_sg', 'sf_sg', 'phase_sg', 'reliability_sg',
+                                                              'osi_sg', 'peak_dff_sg', 'ptest_sg', 'time_to_peak_sg',
+                                                              'cell_specimen_id', 'p_run_sg', 'cv_os_sg',
+                                                              'run_modulation_sg', 'sf_index_sg'))
+    cids = sg.data_set.get_cell_specimen_ids()
+    stim_table = sg.stim_table
+    msr = sg.mean_sweep_response
+
+    orivals_rad = np.deg2rad(sg.orivals)
+    for nc in range(sg.numbercells):
+        cell_peak = np.where(sg.response[:, 1:, :, nc, 0] == np.nanmax(sg.response[:, 1:, :, nc, 0]))
+        pref_ori = cell_peak[0][0]
+        pref_sf = cell_peak[1][0] + 1
+        pref_phase = cell_peak[2][0]
+        peak.cell_specimen_id.iloc[nc] = cids[nc]
+        peak.ori_sg.iloc[nc] = pref_ori
+        peak.sf_sg.iloc[nc] = pref_sf
+        peak.phase_sg.iloc[nc] = pref_phase
+
+        pref = sg.response[pref_ori, pref_sf, pref_phase, nc, 0]
+        orth = sg.response[np.mod(pref_ori + 3, 6), pref_sf, pref_phase, nc, 0]
+        tuning = sg.response[:, pref_sf, pref_phase, nc, 0]
+        tuning = np.where(tuning > 0, tuning, 0)
+        peak.cv_os_sg.iloc[nc] = np.abs((tuning * np.exp(1j * 2 * orivals_rad)).sum()) / tuning.sum()
+        peak.osi_sg.iloc[nc] = (pref - orth) / (pref + orth)
+        peak.peak_dff_sg.iloc[nc] = pref
+
+        groups = []
+        for ori in sg.orivals:
+            for sf in sg.sfvals[1:]:
+                for phase in sg.phasevals:
+                    groups.append(msr[(stim_table.spatial_frequency == sf) & (stim_table.orientation == ori) &
+                                      (stim_table.phase == phase)][str(nc)])
+        groups.append(msr[stim_table.spatial_frequency == 0][str(nc)])
+        _, peak.ptest_sg.iloc[nc] = st.f_oneway(*groups)
+
+        pref_rows = (stim_table.orientation == sg.orivals[pref_ori]) & \
+            (stim_table.spatial_frequency == sg.sfvals[pref_sf]) & \
+            (stim_table.phase == sg.phasevals[pref_phase])
+
+        test = sg.sweep_response[pref_rows][str(nc)].mean()
+        peak.time_to_peak_sg.iloc[nc] = (np.argmax(test) - sg.interlength) / sg.acquisition_rate
+
+        subset = msr[pref_rows]
+        subset_run = subset[subset.dx >= 1]
+        subset_stat = subset[subset.dx < 1]
+        if (len(subset_run) > 4) & (len(subset_stat) > 4):
+            _, peak.p_run_sg.iloc[nc] = st.ttest_ind(subset_run[str(nc)], subset_stat[str(nc)], equal_var=False)
+            run_mean, stat_mean = subset_run[str(nc)].mean(), subset_stat[str(nc)].mean()
+            if run_mean > stat_mean:
+                peak.run_modulation_sg.iloc[nc] = (run_mean - stat_mean) / np.abs(run_mean)
+            elif run_mean < stat_mean:
+                peak.run_modulation_sg.iloc[nc] = -1 * ((stat_mean - run_mean) / np.abs(stat_mean))
+
+        subset = sg.sweep_response[pref_rows]
+        corr_matrix = np.empty((len(subset), len(subset)))
+        for i in range(len(subset)):
+            for j in range(len(subset)):
+                corr_matrix[i, j], _ = st.pearsonr(subset[str(nc)].iloc[i][28:42], subset[str(nc)].iloc[j][28:42])
+        corr_matrix[np.tril_indices(len(subset))] = np.nan
+        peak.reliability_sg.iloc[nc] = np.nanmean(corr_matrix)
+
+        sf_tuning = sg.response[pref_ori, 1:, pref_phase, nc, 0]
+        trials = msr[(stim_table.spatial_frequency != 0) & (stim_table.orientation == sg.orivals[pref_ori]) &
+                     (stim_table.phase == sg.phasevals[pref_phase])][str(nc)].values
+        sse_part = np.sqrt(np.sum((trials - trials.mean()) ** 2) / (len(trials) - 5))
+        peak.sf_index_sg.iloc[nc] = np.ptp(sf_tuning) / (np.ptp(sf_tuning) + 2 * sse_part)
+
+    return peak
+
+
+@pytest.mark.parametrize('synthetic_dataset', [static_gratings_stimulus], indirect=True)
+def test_get_peak_regression(synthetic_dataset, assert_peak_matches):
+    sg = StaticGratings(synthetic_dataset)
+    peak = sg.get_peak()
+
+    assert_peak_matches(peak, legacy_get_peak(sg))
+    assert peak.p_run_sg.notnull().any()
+
+
+@pytest.mark.parametrize('synthetic_dataset', [static_gratings_stimulus], indirect=True)
+def test_get_response_unpresented_conditions(synthetic_dataset):
+    sg = StaticGratings(synthetic_dataset)
+    response = sg.get_response()
+
+    # blank sweeps are only ever coded as orientation 0, spatial frequency 0
+    assert sg.sfvals[0] == 0
+    assert np.all(np.isnan(response[1:, 0, :, :, :2]))
+    assert np.all(response[1:, 0, :, :, 2] == 0)
+    assert np.all(np.isfinite(response[1:, 1:, :, :, 2]))
@@ -36,6 +36,9 @@
 from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
 import pytest
 from mock import patch, MagicMock
+import numpy as np
+import pandas as pd
+import scipy.stats as st
 
 
 @pytest.fixture
@@ -132,9 +135,167 @@ def test_harness(dataset,
         assert sa._dxcm is not StimulusAnalysis._PRELOAD
         assert sa._dxtime is not StimulusAnalysis._PRELOAD
 
-        get_speed_tuning.assert_called_once_with(binsize=800)
+        get_speed_tuning.assert_called_once_with(binsize=800,
+                                                 number_of_shuffles=200,
+                                                 seed=None)
         assert sa._binned_dx_sp is not StimulusAnalysis._PRELOAD
         assert sa._binned_cells_sp is not StimulusAnalysis._PRELOAD
         assert sa._binned_dx_vis is not StimulusAnalysis._PRELOAD
         assert sa._binned_cells_vis is not StimulusAnalysis._PRELOAD
         assert sa._peak_run is not StimulusAnalysis._PRELOAD
+
+
+def test_speed_tuning_parameters(dataset):
+    with patch('allensdk.brain_observatory.stimulus_analysis.StimulusAnalysis.get_speed_tuning',
+               mock_speed_tuning()) as get_speed_tuning:
+        sa = StimulusAnalysis(dataset, speed_tuning_shuffles=50, speed_tuning_seed=7)
+        print(sa.peak_run)
+
+        get_speed_tuning.assert_called_once_with(binsize=800,
+                                                 number_of_shuffles=50,
+                                                 seed=7)
+
+    default_params = StimulusAnalysis(dataset).checkpoint_params
+    assert sa.checkpoint_params['speed_tuning_shuffles'] == 50
+    assert sa.checkpoint_params['speed_tuning_seed'] == 7
+    assert default_params['speed_tuning_shuffles'] == 200
+    assert default_params['speed_tuning_seed'] is None
+
+
+def legacy_sweep_response(sa):
+    sweep_response = pd.DataFrame(index=sa.stim_table.index.values,
+                                  columns=list(map(str, range(sa.numbercells))) + ['dx'])
+    response_end = sa.interlength + sa.sweeplength + sa.extralength
+
+    for index, row in sa.stim_table.iterrows():
+        start = int(row['start'] - sa.interlength)
+        end = int(row['start'] + sa.sweeplength + sa.interlength)
+
+        for nc in range(sa.numbercells):
+            temp = sa.celltraces[nc, start:end]
+            sweep_response[str(nc)][index] = 100 * ((temp / np.mean(temp[:sa.interlength])) - 1)
+        sweep_response['dx'][index] = sa.dxcm[start:end]
+
+    mean_sweep_response = sweep_response.applymap(lambda x: np.mean(x[sa.interlength:response_end]))
+    pval = sweep_response.applymap(lambda x: st.f_oneway(x[:sa.interlength], x[sa.interlength:response_end])[1])
+
+    return sweep_response, mean_sweep_response, pval
+
+
+@pytest.fixture
+def sweep_analysis(dataset):
+    rng = np.random.RandomState(0)
+
+    sa = StimulusAnalysis(dataset)
+    sa._numbercells = 4
+    sa._celltraces = rng.rand(4, 1000) + 1.0
+    sa._dxcm = rng.rand(990) * 3.0
+    sa._dxcm[100] = np.nan
+
+    # the last sweep's running speed window extends past the end of dxcm
+    starts = np.arange(40, 990, 25)
+    sa._stim_table = pd.DataFrame({'start': starts, 'end': starts + 10},
+                                  index=np.arange(len(starts)) + 3)
+    sa.interlength = 20
+    sa.sweeplength = 10
+    sa.extralength = 5
+
+    return sa
+
+
+def test_sweep_response_tensor(sweep_analysis):
+    tensor = sweep_analysis.sweep_response_tensor
+
+    assert tensor.shape == (len(sweep_analysis.stim_table), 5, 50)
+    assert tensor.flags['C_CONTIGUOUS']
+    assert np.isnan(tensor[-1, -1, -1])
+
+
+def test_get_sweep_response(sweep_analysis):
+    expected = legacy_sweep_response(sweep_analysis)
+    sweep_response, mean_sweep_response, pval = sweep_analysis.get_sweep_response()
+
+    for old, new in zip(expected[1:], (mean_sweep_response, pval)):
+        assert list(old.columns) == list(new.columns)
+        assert np.all(old.index == new.index)
+        assert np.allclose(old.values.astype(float), new.values, equal_nan=True)
+
+    for (i, j), trace in np.ndenumerate(expected[0].values):
+        assert np.allclose(trace, sweep_response.values[i, j], equal_nan=True)
+
+    assert np.shares_memory(sweep_response['0'].iloc[0], sweep_analysis.sweep_response_tensor)
+
+
+def test_sweep_response_to_tensor(sweep_analysis):
+    sweep_response, _, _ = legacy_sweep_response(sweep_analysis)
+    tensor = StimulusAnalysis.sweep_response_to_tensor(sweep_response)
+
+    assert np.allclose(tensor, sweep_analysis.sweep_response_tensor, equal_nan=True)
+
+
+def test_get_condition_codes():
+    stim_table = pd.DataFrame({'orientation': [0.0, 45.0, 90.0, 45.0, 30.0],
+                               'temporal_frequency': [1.0, 2.0, 1.0, 1.0, 1.0]})
+
+    codes = StimulusAnalysis.get_condition_codes(stim_table,
+                                                 [('orientation', np.array([0, 45, 90])),
+                                                  ('temporal_frequency', np.array([1, 2]))])
+
+    assert np.all(codes == [0, 3, 4, 2, -1])
+
+
+def test_get_condition_response(dataset):
+    sa = StimulusAnalysis(dataset)
+    sa._numbercells = 2
+    sa._mean_sweep_response = pd.DataFrame({'0': [1.0, 2.0, 3.0, 4.0, 5.0],
+                                            '1': [1.0, np.nan, 1.0, 2.0, 0.0],
+                                            'dx': [0.0, 0.0, 0.0, 0.0, 0.0]})
+    sa._pval = pd.DataFrame({'0': [0.01, 0.5, 0.01, 0.01, 0.5],
+                             '1': [0.5, 0.5, 0.5, np.nan, 0.01],
+                             'dx': [1.0, 1.0, 1.0, 1.0, 1.0]})
+
+    codes = np.array([0, 0, 0, 1, -1])
+    membership = StimulusAnalysis.get_condition_membership(codes, 3)
+    response = sa.get_condition_response(membership, 0.05)
+
+    for condition in range(2):
+        subset_response = sa.mean_sweep_response[codes == condition]
+        subset_pval = sa.pval[codes == condition]
+        assert np.allclose(response[condition, :, 0], subset_response.mean(axis=0))
+        assert np.allclose(response[condition, :, 1],
+                           subset_response.std(axis=0) / np.sqrt(len(subset_response)),
+                           equal_nan=True)
+        assert np.allclose(response[condition, :, 2], (subset_pval < 0.05).sum(axis=0))
+
+    # a condition that was never presented has no significant trials, as pd.DataFrame.apply(ptest) gave
+    assert np.all(np.isnan(response[2, :, :2]))
+    assert np.all(response[2, :, 2] == 0)
+
+
+def test_get_speed_bins():
+    dx_sorted = np.array([0.1, 0.2, 0.5, 1.5, 2.0, 3.0, 4.0, 5.0])
+
+    bin_starts, bin_ends = StimulusAnalysis.get_speed_bins(dx_sorted, 2, 4)
+
+    assert np.all(bin_starts == [0, 3, 5, 7])
+    assert np.all(bin_ends == [3, 5, 7, 8])
+
+
+def test_get_shuffled_bin_means():
+    celltraces = np.random.RandomState(1).rand(3, 50)
+    order = np.random.RandomState(2).permutation(50)
+    bin_starts = np.array([0, 20, 30, 40, 50])
+    bin_ends = np.array([20, 30, 40, 50, 50])
+
+    # force several batches
+    means = StimulusAnalysis.get_shuffled_bin_means(celltraces, order, bin_starts, bin_ends,
+                                                    7, np.random.RandomState(3), max_batch_elements=300)
+
+    rng = np.random.RandomState(3)
+    for shuffle in range(7):
+        shuffled_sorted = celltraces[:, rng.permutation(50)][:, order]
+        for i, (start, end) in enumerate(zip(bin_starts, bin_ends)):
+            if start == end:
+                assert np.all(np.isnan(means[:, i, shuffle]))
+            else:
+                assert np.allclose(means[:, i, shuffle], shuffled_sorted[:, start:end].mean(axis=1))
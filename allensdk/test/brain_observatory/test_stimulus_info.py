@@ -2,7 +2,8 @@ import pytest
 import numpy as np
 import os
 from allensdk.core.brain_observatory_nwb_data_set import BrainObservatoryNwbDataSet, si
-import numpy as np
+import pandas as pd
+from mock import MagicMock
 from pkg_resources import resource_filename  # @UnresolvedImport
 NWB_FLAVORS = []
 
@@ -38,6 +39,64 @@ def test_BinaryIntervalSearchTree_shared_endpoint():
     assert bist.search(1)[2] == 'A'
     assert bist.search(1.5)[2] == 'B'
 
+def test_BinaryIntervalSearchTree_search_indices():
+
+    bist = si.BinaryIntervalSearchTree([(0, 1, 'A'), (1, 2, 'B'), (4, 5, 'C'), (7, 7, 'D')])
+    points = np.array([[-1, 0, 1, 1.5], [3, 4.5, 7, 8]])
+    expected = np.array([[-1, 0, 0, 1], [-1, 2, 3, -1]])
+    assert np.array_equal(bist.search_indices(points), expected)
+
+    with pytest.raises(KeyError):
+        bist.search(3)
+
+
+@pytest.fixture
+def stimulus_search_dataset():
+    # two epochs; fine-grain intervals with gaps, and a long gap at the end of the second epoch
+    epoch_df = pd.DataFrame({'stimulus': ['a', 'b'], 'start': [10, 60], 'end': [40, 5060]})
+    master_df = pd.DataFrame({'stimulus': ['a', 'a', 'a', 'b', 'b'],
+                              'frame': [0, 1, 2, 0, 1],
+                              'start': [10, 15, 25, 60, 62],
+                              'end': [15, 20, 30, 61, 70]})
+
+    data_set = MagicMock(name='data_set')
+    data_set.get_stimulus_epoch_table = MagicMock(return_value=epoch_df)
+    data_set.get_stimulus_table = MagicMock(return_value=master_df)
+
+    return data_set
+
+
+def legacy_search(s, fi):
+    try:
+        return s.master_bst.search(fi)
+    except KeyError:
+        try:
+            s.epoch_bst.search(fi)
+            if fi < s.epoch_df.iloc[0]['start']:
+                return None
+            return legacy_search(s, fi - 1)
+        except KeyError:
+            return None
+
+
+def test_StimulusSearch_frames(stimulus_search_dataset):
+
+    s = si.StimulusSearch(stimulus_search_dataset)
+    frames = np.arange(0, 200)
+
+    results = s.search(frames)
+    assert len(results) == len(frames)
+    for fi, result in zip(frames, results):
+        assert result is legacy_search(s, fi)
+        assert s.search(fi) is result
+
+    # gap frames resolve to the most recent interval without recursing back through the gap
+    assert s.search(5000)[2]['frame'] == 1
+    assert s.search(5060) is None
+    assert s.search(45) is None
+    assert s.search(22)[2]['frame'] == 1
+
+
 def test_pixels_to_visual_degrees():
     m = si.BrainObservatoryMonitor()
     np.testing.assert_almost_equal(m.pixels_to_visual_degrees(1), 0.103270443661,10)
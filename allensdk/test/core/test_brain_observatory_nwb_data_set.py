@@ -34,6 +34,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import functools
+import threading
 import numpy as np
 from pkg_resources import resource_filename  # @UnresolvedImport
 from allensdk.core.brain_observatory_nwb_data_set import BrainObservatoryNwbDataSet, si
@@ -41,6 +42,8 @@ import allensdk.core.brain_observatory_nwb_data_set as bonds
 import pytest
 import os
 import h5py
+import mock
+import pandas as pd
 
 from allensdk.brain_observatory.brain_observatory_exceptions import MissingStimulusException
 
@@ -358,3 +361,280 @@ def test_find_stimulus_presentation_group_duplicate(stim_pres_h5):
 
     with pytest.raises(MissingStimulusException):
         obt = bonds._find_stimulus_presentation_group(stim_pres_h5, stimulus_name)
+
+
+@pytest.fixture
+def trace_nwb(tmpdir_factory):
+    file_name = str(tmpdir_factory.mktemp('nwb').join('traces.nwb'))
+
+    pipeline = 'processing/{}'.format(BrainObservatoryNwbDataSet.PIPELINE_DATASET)
+    n_cells, n_frames = 5, 40
+    rng = np.random.RandomState(0)
+
+    with h5py.File(file_name, 'w') as f:
+        f['general/session_type'] = np.string_(si.THREE_SESSION_A)
+        f['general/generated_by'] = np.array([b'pipeline', b'2.0'])
+        f['{}/ImageSegmentation/cell_specimen_ids'.format(pipeline)] = np.arange(n_cells) * 10 + 100
+        f['{}/Fluorescence/imaging_plane_1/timestamps'.format(pipeline)] = np.arange(n_frames) / 30.0
+        f['{}/Fluorescence/imaging_plane_1/data'.format(pipeline)] = rng.rand(n_cells, n_frames)
+        f['{}/Fluorescence/imaging_plane_1_demixed_signal/data'.format(pipeline)] = rng.rand(n_cells, n_frames)
+        f['{}/Fluorescence/imaging_plane_1_neuropil_response/data'.format(pipeline)] = rng.rand(n_cells, n_frames)
+        f['{}/Fluorescence/imaging_plane_1_neuropil_response/r'.format(pipeline)] = rng.rand(n_cells)
+        f['{}/DfOverF/imaging_plane_1/timestamps'.format(pipeline)] = np.arange(n_frames) / 30.0
+        f['{}/DfOverF/imaging_plane_1/data'.format(pipeline)] = rng.rand(n_cells, n_frames)
+        f.create_group('analysis')
+
+    return file_name
+
+
+def test_open_persistent_handle(trace_nwb):
+    data_set = BrainObservatoryNwbDataSet(trace_nwb)
+    assert not data_set.is_open
+
+    _, expected = data_set.get_corrected_fluorescence_traces()
+    ids = data_set.get_cell_specimen_ids()
+    assert not data_set.is_open
+
+    with data_set as ds:
+        assert ds is data_set
+        assert data_set.is_open
+
+        with mock.patch('h5py.File') as h5_file:
+            _, obtained = data_set.get_corrected_fluorescence_traces()
+            _, dff = data_set.get_dff_traces(ids[1:3])
+            h5_file.assert_not_called()
+
+        with data_set:
+            pass
+        assert data_set.is_open
+        assert data_set.__getstate__()['_h5_file'] is None
+
+        data_set.save_analysis_arrays(('fish', np.arange(3)))
+        assert data_set.is_open
+
+    assert not data_set.is_open
+    assert np.array_equal(obtained, expected)
+    assert dff.shape == (2, 40)
+
+    with h5py.File(trace_nwb, 'r') as f:
+        assert np.array_equal(f['analysis/fish'].value, np.arange(3))
+
+
+def test_open_handle_shared_between_threads(trace_nwb):
+    data_set = BrainObservatoryNwbDataSet(trace_nwb)
+    _, expected = data_set.get_dff_traces()
+
+    # a reader keeps the borrowed handle alive when its owner closes it
+    data_set.open()
+    with data_set._open_nwb() as f:
+        data_set.close()
+        assert data_set.is_open
+        assert f['analysis'] is not None
+    assert not data_set.is_open
+
+    errors = []
+    done = threading.Event()
+
+    def open_and_close():
+        while not done.is_set():
+            with data_set:
+                pass
+
+    def read():
+        try:
+            for _ in range(500):
+                _, dff = data_set.get_dff_traces()
+                assert np.array_equal(dff, expected)
+        except Exception as e:
+            errors.append(e)
+
+    opener = threading.Thread(target=open_and_close)
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    opener.start()
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    done.set()
+    opener.join()
+
+    assert errors == []
+    assert not data_set.is_open
+
+
+def test_metadata_is_cached(trace_nwb):
+    data_set = BrainObservatoryNwbDataSet(trace_nwb)
+
+    ids = data_set.get_cell_specimen_ids()
+    timestamps = data_set.get_fluorescence_timestamps()
+    session_type = data_set.get_session_type()
+
+    with mock.patch('h5py.File') as h5_file:
+        ids[0] = -1
+        assert np.array_equal(data_set.get_cell_specimen_ids(), np.arange(5) * 10 + 100)
+        assert np.array_equal(data_set.get_fluorescence_timestamps(), timestamps)
+        assert data_set.get_session_type() == session_type == si.THREE_SESSION_A
+        h5_file.assert_not_called()
+
+
+@pytest.mark.parametrize('inds', [[3, 1, 1, 4], [0, 19], [7], []])
+@pytest.mark.parametrize('window', [(), (slice(2, 9),)])
+def test_read_dataset_rows(mem_h5, inds, window):
+    data = np.arange(20 * 12).reshape((20, 12))
+    ds = mem_h5.create_dataset('data', data=data)
+
+    obtained = bonds.read_dataset_rows(ds, inds, window)
+    expected = data[(np.array(inds, dtype=int),) + window]
+
+    assert obtained.shape == expected.shape
+    assert np.array_equal(obtained, expected)
+
+
+def test_get_traces_subset(trace_nwb):
+    data_set = BrainObservatoryNwbDataSet(trace_nwb)
+    ids = data_set.get_cell_specimen_ids()
+    subset = [ids[3], ids[0], ids[3]]
+
+    assert data_set.get_cell_specimen_indices(subset) == [3, 0, 3]
+    with pytest.raises(ValueError):
+        data_set.get_cell_specimen_indices([ids[0], -1])
+
+    timestamps, all_traces = data_set.get_corrected_fluorescence_traces()
+    obt_timestamps, obt_traces = data_set.get_corrected_fluorescence_traces(subset, start_frame=5, end_frame=12)
+
+    assert np.array_equal(obt_timestamps, timestamps[5:12])
+    assert np.allclose(obt_traces, all_traces[[3, 0, 3], 5:12])
+
+    timestamps, all_dff = data_set.get_dff_traces()
+    obt_timestamps, obt_dff = data_set.get_dff_traces(start_frame=30)
+
+    assert np.array_equal(obt_timestamps, timestamps[30:])
+    assert np.array_equal(obt_dff, all_dff[:, 30:])
+
+
+def test_map_dataset(tmpdir_factory):
+    file_name = str(tmpdir_factory.mktemp('nwb').join('map.h5'))
+    data = np.arange(24, dtype=np.float32).reshape((4, 6))
+
+    with h5py.File(file_name, 'w') as f:
+        f.create_dataset('contiguous', data=data)
+        f.create_dataset('compressed', data=data, compression='gzip')
+
+    with h5py.File(file_name, 'r') as f:
+        mapped = bonds.map_dataset(f['contiguous'])
+        loaded = bonds.map_dataset(f['compressed'])
+
+    assert isinstance(mapped, np.memmap)
+    assert not isinstance(loaded, np.memmap)
+
+    for obt in mapped, loaded:
+        assert np.array_equal(obt, data)
+        assert not obt.flags.writeable
+
+
+def test_memmap_mode(trace_nwb):
+    expected = BrainObservatoryNwbDataSet(trace_nwb)
+    data_set = BrainObservatoryNwbDataSet(trace_nwb, memmap=True)
+    ids = data_set.get_cell_specimen_ids()
+
+    _, dff = data_set.get_dff_traces()
+    _, dff_again = data_set.get_dff_traces()
+    assert isinstance(dff, np.memmap)
+    assert dff is dff_again
+    assert not dff.flags.writeable
+    assert np.array_equal(dff, expected.get_dff_traces()[1])
+
+    _, fc = data_set.get_corrected_fluorescence_traces()
+    _, fc_again = data_set.get_corrected_fluorescence_traces()
+    assert fc is fc_again
+    assert not fc.flags.writeable
+    assert np.allclose(fc, expected.get_corrected_fluorescence_traces()[1])
+
+    _, fc_subset = data_set.get_corrected_fluorescence_traces([ids[4], ids[1]], start_frame=3, end_frame=7)
+    assert np.allclose(fc_subset, fc[[4, 1], 3:7])
+
+    # shared arrays are only kept while someone holds them
+    del fc, fc_again
+    assert 'corrected_fluorescence' not in data_set._shared_arrays
+
+
+@pytest.fixture
+def stimulus_nwb(trace_nwb):
+    with h5py.File(trace_nwb, 'a') as f:
+        f['stimulus/templates/natural_scenes_image_stack/data'] = np.arange(5 * 4 * 6).reshape(5, 4, 6)
+
+    epoch_df = pd.DataFrame({'stimulus': [si.NATURAL_SCENES, si.DRIFTING_GRATINGS,
+                                          si.STATIC_GRATINGS, si.SPONTANEOUS_ACTIVITY],
+                             'start': [2, 12, 26, 34],
+                             'end': [11, 25, 33, 39]})
+    master_df = pd.DataFrame({'stimulus': [si.NATURAL_SCENES] * 4 + [si.DRIFTING_GRATINGS] * 2 +
+                                          [si.STATIC_GRATINGS] * 2 + [si.SPONTANEOUS_ACTIVITY],
+                              'frame': [3, 1, 3, 0] + [np.nan] * 5,
+                              'orientation': [np.nan] * 4 + [90, np.nan, 30, 60, np.nan],
+                              'temporal_frequency': [np.nan] * 4 + [2, np.nan] + [np.nan] * 3,
+                              'spatial_frequency': [np.nan] * 6 + [0.04, 0.08, np.nan],
+                              'phase': [np.nan] * 6 + [0.25, 0.5, np.nan],
+                              'start': [2, 4, 6, 8, 12, 20, 26, 29, 34],
+                              'end': [4, 6, 8, 10, 20, 24, 29, 32, 39]})
+
+    tables = mock.MagicMock(name='data_set')
+    tables.get_stimulus_epoch_table = mock.MagicMock(return_value=epoch_df)
+    tables.get_stimulus_table = mock.MagicMock(return_value=master_df)
+
+    data_set = BrainObservatoryNwbDataSet(trace_nwb)
+    data_set._stimulus_search = si.StimulusSearch(tables)
+
+    return data_set
+
+
+def test_get_stimulus_frames(stimulus_nwb):
+    data_set = stimulus_nwb
+    frame_indices = np.concatenate([np.arange(40), [9, 3]])
+
+    monitor = mock.MagicMock(n_pixels_r=2, n_pixels_c=3)
+    monitor.grating_to_screen = mock.MagicMock(
+        side_effect=lambda phase, spatial_frequency, orientation: np.full((2, 3), orientation + phase))
+
+    # room for two rendered 2 x 3 float32 frames
+    data_set.RENDERED_FRAME_CHUNK_NBYTES = 2 * 2 * 3 * 4
+
+    chunks = list(data_set.get_stimulus_frames(frame_indices, chunk_size=3, monitor=monitor))
+    assert not data_set.is_open
+
+    positions = np.concatenate([c[0] for c in chunks])
+    assert np.array_equal(positions, np.arange(len(frame_indices)))
+    assert all(len(c[0]) <= 3 for c in chunks)
+    assert all(len(c[0]) <= 2 for c in chunks
+               if c[1] in (si.STATIC_GRATINGS, si.DRIFTING_GRATINGS))
+    assert any(len(c[0]) == 3 for c in chunks if c[1] == si.NATURAL_SCENES)
+
+    template = data_set.get_stimulus_template(si.NATURAL_SCENES)
+    timestamps = data_set.get_fluorescence_timestamps()
+    for chunk_positions, stimulus, frames in chunks:
+        for position, frame in zip(chunk_positions, frames if frames is not None else [None] * len(chunk_positions)):
+            frame_index = frame_indices[position]
+            search_result, expected = data_set.get_stimulus(frame_index)
+
+            if search_result is None:
+                assert stimulus is None and frame is None
+                continue
+
+            assert stimulus == search_result[2]['stimulus']
+            row = search_result[2]
+            if stimulus == si.NATURAL_SCENES:
+                assert np.array_equal(frame, expected)
+            elif stimulus == si.STATIC_GRATINGS:
+                assert np.allclose(frame, row['orientation'] + row['phase'])
+            elif np.isnan(row['orientation']):
+                assert np.allclose(frame, si.STIMULUS_GRAY)
+            else:
+                phase = ((timestamps[frame_index] - timestamps[int(row['start'])]) * 2) % 1
+                assert np.allclose(frame, 90 + phase)
+
+    # static grating sweeps are rendered once per sweep within a chunk, not once per frame
+    static_calls = [c for c in monitor.grating_to_screen.call_args_list if c[0][2] in (30, 60)]
+    static_chunks = [c for c in chunks if c[1] == si.STATIC_GRATINGS]
+    assert len(static_calls) <= len(static_chunks) + 1
+    assert len(static_calls) < sum(len(c[0]) for c in static_chunks)
+
+    assert list(data_set.get_stimulus_frames(np.array([], dtype=int), monitor=monitor)) == []
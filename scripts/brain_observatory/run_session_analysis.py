@@ -10,12 +10,14 @@ def main():
     parser.add_argument("output_h5")
 
     parser.add_argument("--plot", action='store_true')
+    parser.add_argument("--lsn-n-jobs", type=int, default=1,
+                        help="number of processes used to compute locally sparse noise receptive fields")
 
     args = parser.parse_args()
     logging.basicConfig()
     logging.getLogger().setLevel(logging.DEBUG)
 
-    run_session_analysis(args.input_nwb, args.output_h5, args.plot)
+    run_session_analysis(args.input_nwb, args.output_h5, args.plot, lsn_n_jobs=args.lsn_n_jobs)
 
 
 if __name__ == '__main__':